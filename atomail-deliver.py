@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Delivers a message from stdin to a feed, through an AtoMail delivery
+  daemon (started with atomail.py --listen).
+
+  The arguments are the arguments of atomail.py in pipe mode, and are
+  passed to the daemon as they are. The daemon is reached on the unix
+  domain socket given by the ATOMAIL_SOCKET environment variable (by
+  default ~/.atomail/socket). Only a few small modules are imported, so a
+  delivery starts a lot faster than atomail.py itself. If no daemon is
+  running, atomail.py is run instead, so no messages are lost.
+
+  The exit status is 0 if the daemon accepted the message, and 1 if it
+  did not (e.g. because of invalid arguments).
+
+  Usage: atomail-deliver.py [options] file
+"""
+
+import sys, os, socket
+
+DEFAULT_SOCKET = '~/.atomail/socket'
+
+def encode(text) :
+  if isinstance(text, bytes) :
+    return text
+  return text.encode('utf-8', 'surrogateescape')
+
+def deliver(args) :
+  path = os.environ.get('ATOMAIL_SOCKET') or os.path.expanduser(DEFAULT_SOCKET)
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try :
+    connection.connect(path)
+  except socket.error :
+    connection.close()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'atomail.py')
+    os.execv(sys.executable, [sys.executable, script] + args)
+  try :
+    # The number of arguments, the NUL-terminated working directory and
+    # arguments, and the message
+    arguments = [os.getcwd()] + args
+    connection.sendall(encode(str(len(arguments))) + b'\n' + b''.join([encode(argument) + b'\0' for argument in arguments]))
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    while True :
+      data = stdin.read(65536)
+      if not data :
+        break
+      connection.sendall(data)
+    connection.shutdown(socket.SHUT_WR)
+    chunks = []
+    while True :
+      chunk = connection.recv(4096)
+      if not chunk :
+        break
+      chunks.append(chunk)
+  finally :
+    connection.close()
+  reply = b''.join(chunks)
+  if reply.startswith(b'OK') :
+    return 0
+  sys.stderr.write((reply or b'ERROR No answer from daemon\n').decode('utf-8', 'replace'))
+  return 1
+
+if __name__ == "__main__" :
+  sys.exit(deliver(sys.argv[1:]))
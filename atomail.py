@@ -16,7 +16,7 @@
     http://el-tramo.be/software/atomail
 """
 
-__all__ = ['MessageFeed', 'MailSource', 'PipeSource', 'MailboxSource', 'IMAPSource', 'POP3Source', 'NNTPSource', 'ATOM_NS' ]
+__all__ = ['MessageFeed', 'MailSource', 'PipeSource', 'MailboxSource', 'IMAPSource', 'POP3Source', 'NNTPSource', 'MergedSource', 'ATOM_NS' ]
 __author__ = 'Remko Tronçon'
 __version__ = '0.10'
 __copyright__ = """
@@ -44,11 +44,34 @@ __copyright__ = """
 # Imports
 ################################################################################
 
-import sys, os.path, optparse, datetime, email, email.header, email.Utils, re, xml
-import string, logging, md5, math
+import sys, os.path, optparse, datetime, email, email.header, email.parser, email.utils, re, xml
+import logging, warnings, hashlib, math, mmap, binascii, quopri, tempfile, io
 from xml.dom import minidom
-import nntplib, imaplib, poplib, mailbox
-import cgi
+import xml.parsers.expat, xml.sax.saxutils
+import imaplib, poplib, mailbox, sqlite3
+import time, calendar, threading, heapq, fcntl, socket, select, stat, signal, errno, struct, pwd, grp
+import gzip, json, contextlib, cProfile, multiprocessing, shutil, copy
+if sys.version_info[0] >= 3 :
+  import queue, configparser, email.policy
+  from urllib.parse import quote, unquote
+else :
+  import Queue as queue, ConfigParser as configparser
+  from urllib import quote, unquote
+try :
+  with warnings.catch_warnings() :
+    # Deprecated in Python 3.11, and removed in Python 3.13
+    warnings.simplefilter('ignore', DeprecationWarning)
+    import nntplib
+except ImportError :
+  nntplib = None
+try :
+  import brotli
+except ImportError :
+  brotli = None
+try :
+  import tracemalloc
+except ImportError :
+  tracemalloc = None
 
 ################################################################################
 # Constants
@@ -60,7 +83,11 @@ PROGRAM_USAGESTRING = "usage: %prog [options] file"
 PROGRAM_VERSIONSTRING = PROGRAM_NAME + ' ' + __version__ + '\nWritten by ' + __author__ + '\n' + 'For more information, please visit ' + PROGRAM_URI
 
 ATOM_NS = 'http://www.w3.org/2005/Atom'
+HISTORY_NS = 'http://purl.org/syndication/history/1.0'
 DEFAULT_ENCODING = "iso8859-1" # This will be used to decode headers if no encoding is specified. Should probably be smarter about this. See usage for more info
+XMLNS_RE = re.compile(br'\sxmlns(?::[\w.-]+)?="[^"]*"')
+BACKFILL_CHUNK_SIZE = 8 * 1024 * 1024
+IMAP_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
 ################################################################################
 # Auxiliary functions and classes
@@ -73,89 +100,704 @@ class TZ(datetime.tzinfo) :
   def utcoffset(self, dt) : 
     return datetime.timedelta(minutes=math.floor(self.seconds/60))
 
+if sys.version_info[0] >= 3 :
+  class RawHeaderPolicy(email.policy.Compat32) :
+    """A message policy that returns header values as they are in the 
+    message. Only the headers that end up in the feed are decoded, by 
+    decode_header()."""
+
+    def header_fetch_parse(self, name, value) :
+      return value
+
+  MESSAGE_POLICY = RawHeaderPolicy()
+
+  def parse_message(data) :
+    """Parses a message from its raw bytes"""
+    return email.parser.BytesParser(policy=MESSAGE_POLICY).parsebytes(data)
+
+  def parse_header(data) :
+    """Parses the header of a message from its raw bytes"""
+    return email.parser.BytesHeaderParser(policy=MESSAGE_POLICY).parsebytes(data)
+
+  def header_bytes(value) :
+    """Returns the raw bytes of a header value"""
+    return value.encode('utf-8', 'surrogateescape')
+
+  def read_stdin() :
+    """Returns the raw bytes from stdin"""
+    return sys.stdin.buffer.read()
+
+  def url_unquote(text) :
+    """Decodes a URL-encoded string"""
+    return unquote(text, errors='surrogateescape')
+else :
+  def parse_message(data) :
+    """Parses a message from its raw bytes"""
+    return email.parser.Parser().parsestr(data)
+
+  def parse_header(data) :
+    """Parses the header of a message from its raw bytes"""
+    return email.parser.HeaderParser().parsestr(data)
+
+  def header_bytes(value) :
+    """Returns the raw bytes of a header value"""
+    return value
+
+  def read_stdin() :
+    """Returns the raw bytes from stdin"""
+    return sys.stdin.read()
+
+  def url_unquote(text) :
+    """Decodes a URL-encoded string"""
+    return unquote(text.encode('utf-8'))
+
 def message_id(message) :
-  hash = md5.new()
+  hash = hashlib.md5()
+  # Folded headers end their lines with CRLF when they come from a network
+  # source, and with LF when they come from a local mailbox
   if message['From'] :
-    hash.update(message['From'])
+    hash.update(header_bytes(message['From']).replace(b'\r\n', b'\n'))
   if message['Subject'] :
-    hash.update(message['Subject'])
+    hash.update(header_bytes(message['Subject']).replace(b'\r\n', b'\n'))
   if message['Date'] :
-    hash.update(message['Date'])
+    hash.update(header_bytes(message['Date']).replace(b'\r\n', b'\n'))
   return hash.hexdigest()
 
+def message_mid(message) :
+  """Returns the (RFC 5322) Message-ID of a message, without angle brackets"""
+  mid = message['Message-ID']
+  if mid :
+    mid = mid.strip().lstrip('<').rstrip('>').strip()
+  return mid or None
+
+def message_key(message) :
+  """Returns a key that is the same for all copies of a message: its 
+  Message-ID, or its message id (see message_id()) if it has none"""
+  return message_mid(message) or message_id(message)
+
 def message_date(message) :
-  date = email.Utils.parsedate_tz(message["Date"])
-  print(date)
+  """Returns the date of a message (as a datetime object).
+
+  Messages without a (valid) Date header get the time they were received:
+  the date of their newest Received header, or otherwise the current time.
+  They are then neither the first to be trimmed, nor outdated."""
+  date = None
+  if message["Date"] :
+    date = email.utils.parsedate_tz(message["Date"])
+  if date == None :
+    logging.warning('Unable to parse date \'' + str(message['Date']) + '\'')
+    received = message.get_all('Received')
+    if received :
+      date = email.utils.parsedate_tz(received[0].rpartition(';')[2])
   if date != None :
-    return datetime.datetime(date[0],date[1],date[2],date[3],date[4],date[5],0,TZ(date[9]))
+    return datetime.datetime(date[0],date[1],date[2],date[3],date[4],date[5],0,TZ(date[9] or 0))
   else :
-    logging.warning('Unable to parse date \'' + message['Date'] + '\'')
-    return datetime.datetime(datetime.MINYEAR,1,1)
+    return current_datetime()
+
+def message_outdated(message, since) :
+  """Checks whether a message was sent before a given time"""
+  return since is not None and message_date(message) < since
 
-def message_contents(message, default_charset) :
-  contents = []
+def message_header(text) :
+  """Parses only the header of a message"""
+  end = text.find(b'\n\n')
+  if end >= 0 :
+    text = text[:end + 1]
+  return parse_header(text)
+
+def message_content_part(message) :
+  """Returns the preferred content part of a message: the first HTML part,
+  or otherwise the first plain text part.
+
+  Only the headers of the parts are looked at. Attachments are skipped."""
   if message.is_multipart() :
+    preferred = None
     for submessage in message.get_payload() :
-      contents += message_contents(submessage, default_charset)
-  else :
-    payload = message.get_payload(decode=True)
-    if payload : 
-      content = unicode(payload, get_charset(message, default_charset), "replace")
-      content_type = message.get_content_type()
-      if content_type == 'text/plain' :
-        contents = [('text',content)]
-      if content_type == 'text/html' :
-        contents = [('html',content)]
+      if is_attachment(submessage) :
+        continue
+      part = message_content_part(submessage)
+      if part and part.get_content_type() == 'text/html' :
+        return part
+      preferred = preferred or part
+    return preferred
+  elif message.get_content_type() in ('text/plain', 'text/html') :
+    return message
+  return None
+
+def is_attachment(part) :
+  """Checks whether a MIME part is an attachment"""
+  return part.get('Content-Disposition', '').split(';')[0].strip().lower() == 'attachment'
+
+def part_filename(part) :
+  """Returns the filename of a MIME part (or None if it has none).
+
+  RFC 2231 encoded filenames are decoded like get_filename() does, and 
+  other ones by decode_header(), since they may contain RFC 2047 encoded 
+  words. A filename is never decoded twice."""
+  filename = part.get_param('filename', None, 'content-disposition')
+  if filename is None :
+    filename = part.get_param('name', None)
+  if filename is None :
+    return None
+  if isinstance(filename, tuple) :
+    return email.utils.collapse_rfc2231_value(filename).strip()
+  return decode_header(filename.strip(), '')
+
+def decode_payload(part, max_bytes=0) :
+  """Decodes the payload of a (non-multipart) part.
+
+  If max_bytes is positive, only the start of the payload is decoded, and at 
+  most max_bytes bytes are returned."""
+  payload = part.get_payload()
+  if max_bytes <= 0 or len(payload) <= max_bytes :
+    return part.get_payload(decode=True)
+  if not isinstance(payload, bytes) :
+    # Python 3 keeps the payload as (escaped) text
+    payload = header_bytes(payload)
+  encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+  try :
+    if encoding == 'base64' :
+      # Every 4 characters encode 3 bytes. Leave room for line breaks.
+      data = re.sub(b'[^A-Za-z0-9+/]', b'', payload[:max_bytes * 3 // 2 + 4])
+      data = binascii.a2b_base64(data[:len(data) - len(data) % 4])
+    elif encoding == 'quoted-printable' :
+      data = quopri.decodestring(payload[:max_bytes * 3])
+    else :
+      data = payload
+  except binascii.Error :
+    logging.warning('Unable to decode payload')
+    data = b''
+  logging.debug('Truncating payload of ' + str(len(payload)) + ' bytes')
+  return data[:max_bytes]
+
+def message_content(message, default_charset, max_bytes=0) :
+  """Returns the type ('html' or 'text') and the decoded text of the 
+  preferred content of a message, or None if there is no such content. 
+  
+  Only the preferred part is decoded, up to max_bytes bytes."""
+  part = message_content_part(message)
+  if not part :
+    return None
+  payload = decode_payload(part, max_bytes)
+  if not payload :
+    logging.warning('Missing payload in message')
+    return None
+  content = payload.decode(get_charset(part, default_charset), "replace")
+  if part.get_content_type() == 'text/html' :
+    return ('html', content)
+  return ('text', content)
+
+def mbox_offsets(data, start, end) :
+  """Returns the offsets of the messages (i.e. From_ lines) in a part of an
+  mbox file, from the last to the first"""
+  while True :
+    index = data.rfind(b'\nFrom ', start, end)
+    if index < 0 :
+      break
+    yield index + 1
+    end = index
+  if data[start:start + 5] == b'From ' and (start == 0 or data[start - 1:start] == b'\n') :
+    yield start
+
+def mbox_chunks(data, size) :
+  """Splits an mbox file into parts of about size bytes, at message 
+  boundaries. Returns a list of (start, end) offsets."""
+  chunks = []
+  start = 0
+  while start < len(data) :
+    end = data.find(b'\nFrom ', start + size - 1)
+    end = len(data) if end < 0 else end + 1
+    chunks.append((start, end))
+    start = end
+  return chunks
+
+def document_prefix(data) :
+  """Returns the XML declaration and the start tag of the root element of 
+  a serialized document"""
+  start = data.find(b'?>')
+  start = start + 2 if start >= 0 else 0
+  return data[:data.find(b'>', data.find(b'<', start)) + 1]
+
+def overview_message(poster, subject, date, id) :
+  """Creates a message with the headers from an NNTP overview"""
+  # An empty message, with the same policy as parsed messages
+  message = parse_header(b'')
+  message['From'] = poster
+  message['Subject'] = subject
+  message['Date'] = date
+  message['Message-ID'] = id
+  return message
+
+def write_file(filename, data) :
+  """Replaces the contents of a file, keeping its permissions.
+
+  The data is written to a temporary file first, so that readers never see
+  a partially written file. Text is written as UTF-8."""
+  if not isinstance(data, bytes) :
+    data = data.encode('utf-8')
+  temporary_filename = filename + '.tmp'
+  out = open(temporary_filename, 'wb')
+  try :
+    out.write(data)
+  finally :
+    out.close()
+  if os.path.exists(filename) :
+    os.chmod(temporary_filename, stat.S_IMODE(os.stat(filename).st_mode))
+  os.rename(temporary_filename, filename)
+
+def file_signature(filename) :
+  """Returns the inode, size and modification time of a file (or None if it
+  does not exist), to check whether another process replaced it"""
+  try :
+    info = os.stat(filename)
+  except OSError :
+    return None
+  return (info.st_ino, info.st_size, info.st_mtime)
+
+def writable_by(path, uid) :
+  """Returns whether the user with the given ID may write to a file or 
+  directory, judging by its owner, group and mode"""
+  if uid == 0 :
+    return True
+  info = os.stat(path)
+  if info.st_uid == uid :
+    return bool(info.st_mode & stat.S_IWUSR)
+  try :
+    user = pwd.getpwuid(uid)
+    groups = [user.pw_gid] + [group.gr_gid for group in grp.getgrall() if user.pw_name in group.gr_mem]
+  except KeyError :
+    groups = []
+  if info.st_gid in groups :
+    return bool(info.st_mode & stat.S_IWGRP)
+  return bool(info.st_mode & stat.S_IWOTH)
+
+def make_directory(path) :
+  """Creates a directory (and its parents), unless it exists. Other 
+  processes may be creating it at the same time."""
+  try :
+    os.makedirs(path)
+  except OSError as e :
+    if e.errno != errno.EEXIST or not os.path.isdir(path) :
+      raise
+
+def spool_data(directory, data) :
+  """Stores data in a new file of a spool directory, and returns its name.
+
+  The file is written to the tmp subdirectory first, and then moved to the
+  new subdirectory, so that readers of the spool never see partial files."""
+  for subdirectory in ('tmp', 'new') :
+    make_directory(os.path.join(directory, subdirectory))
+  name = '%.6f.%d.%s' % (time.time(), os.getpid(), socket.gethostname())
+  temporary_filename = os.path.join(directory, 'tmp', name)
+  out = open(temporary_filename, 'wb')
+  try :
+    out.write(data)
+  finally :
+    out.close()
+  os.rename(temporary_filename, os.path.join(directory, 'new', name))
+  return name
+
+def gzip_data(data) :
+  """Compresses data in the gzip format"""
+  buffer = io.BytesIO()
+  file = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buffer, mtime=0)
+  try :
+    file.write(data)
+  finally :
+    file.close()
+  return buffer.getvalue()
+
+def uid_set(uids) :
+  """Returns an IMAP sequence set (e.g. '1:3,5') for a list of UIDs"""
+  ranges = []
+  for uid in sorted(uids) :
+    if ranges and ranges[-1][1] == uid - 1 :
+      ranges[-1][1] = uid
     else :
-      logging.warning('Missing payload in message')
-  return contents
+      ranges.append([uid, uid])
+  return ','.join([str(x) if x == y else str(x) + ':' + str(y) for (x, y) in ranges])
+
+def imap_date(date) :
+  """Returns a date in the format of IMAP search keys (e.g. '4-Jan-2016')"""
+  return str(date.day) + '-' + IMAP_MONTHS[date.month - 1] + '-' + str(date.year)
+
+def imap_quote(text) :
+  """Returns an IMAP quoted string (e.g. a mailbox name)"""
+  return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def imap_unquote(data) :
+  """Returns the text of an IMAP quoted string or atom (as bytes)"""
+  data = data.strip()
+  if data[:1] == b'"' :
+    data = re.sub(br'\\(.)', br'\1', data[1:-1])
+  return data
+
+def imap_literals(data) :
+  """Returns a dictionary with the first literal of every message UID in 
+  the data of a FETCH response"""
+  result = {}
+  literal = None
+  for item in data :
+    if isinstance(item, tuple) :
+      # The UID may come before or after the literal
+      m = re.search(br'UID (\d+)', item[0])
+      if m :
+        result[int(m.group(1))] = item[1]
+        literal = None
+      else :
+        literal = item[1]
+    elif item and literal is not None :
+      m = re.search(br'UID (\d+)', item)
+      if m :
+        result[int(m.group(1))] = literal
+      literal = None
+  return result
 
 def current_datetime() :
   now = datetime.datetime.now()
-  current_tz = round(float((datetime.datetime.now() - datetime.datetime.utcnow()).seconds)/3600)
-  if current_tz > 12 :
-    current_tz -= 24
+  current_tz = int(round(float((datetime.datetime.now() - datetime.datetime(*time.gmtime()[:6])).seconds)/60)) * 60
+  if current_tz > 12 * 3600 :
+    current_tz -= 24 * 3600
   return now.replace(tzinfo=TZ(current_tz))
 
 def from_atom_date(date) :
   microseconds = 0
   timezone = 0
   suffix = date[19:]
-  m = re.match("(\.(?P<microseconds>\d+))?(?P<timezone>(\+|-)\d\d)?",suffix)
+  m = re.match(r"(\.(?P<microseconds>\d+))?(Z|(?P<sign>\+|-)(?P<hours>\d\d)(:?(?P<minutes>\d\d))?)?",suffix)
   if m != None :
     if m.group('microseconds') :
       microseconds = int(m.group('microseconds'))
-    if m.group('timezone') :
-      timezone = int(m.group('timezone'))
+    if m.group('sign') :
+      timezone = int(m.group('hours')) * 3600 + int(m.group('minutes') or 0) * 60
+      if m.group('sign') == '-' :
+        timezone = -timezone
   return datetime.datetime(int(date[0:4]),int(date[5:7]),int(date[8:10]),int(date[11:13]),int(date[14:16]),int(date[17:19]),microseconds,TZ(timezone))
 
-def entry_date(entry) :
-  updated_nodes = entry.getElementsByTagName('updated')
-  if updated_nodes :
-    date = from_atom_date(updated_nodes[0].childNodes[0].data)
-  else :
-    date = datetime.datetime(datetime.MINYEAR,1,1)
-  return date
-
 def decode_header(header, default) :
-  decoded_header = ""
-  for (result, encoding) in email.header.decode_header(header if header else default) :
+  decoded_header = u""
+  header = header if header else default
+  if not isinstance(header, bytes) :
+    # Python 3 keeps the raw bytes of a header as escaped text. Decode them 
+    # like Python 2 does.
+    header = header_bytes(header).decode(DEFAULT_ENCODING)
+  for (result, encoding) in email.header.decode_header(header) :
+    if not isinstance(result, bytes) :
+      # Python 3 returns headers without encoded words as they are
+      decoded_header += result
+      continue
     # Some mails don't have an encoding in the header, yet they do encode the
     # header. We should do trial and error here, but for now assume it's 
     # Iso8859-1.
     if not encoding :
       encoding = DEFAULT_ENCODING
-    decoded_header += result.decode(encoding, "ignore") if encoding else result
+    decoded_header += result.decode(encoding, "ignore")
   return decoded_header
 
 def get_charset(message, default="ascii"):
   if message.get_content_charset() :
     return message.get_content_charset()
   elif message.get_charset() :
-    return message.get_charset()
+    return str(message.get_charset())
   else :
     return default
 
+################################################################################
+# Statistics
+################################################################################
+
+class Stats :
+  """Timings and counters of the stages of a feed update.
+
+  For every stage (such as 'fetch' or 'write'), the number of times it ran, 
+  the total time it took, and the number of bytes it handled are kept. A 
+  disabled Stats object does not record anything, so the feed and the 
+  sources can always report to their stats. The sources of a MergedSource
+  report from several threads. The time of a stage does not include the 
+  time of the stages it runs, so the times add up."""
+
+  def __init__(self, enabled=True) :
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.start = time.time()
+    self.stages = {}
+    self.counters = {}
+    self.allocations = []
+
+  def add(self, stage, seconds=0.0, count=1, bytes=0) :
+    """Records that a stage ran"""
+    if self.enabled :
+      with self.lock :
+        totals = self.stages.setdefault(stage, [0, 0.0, 0])
+        totals[0] += count
+        totals[1] += seconds
+        totals[2] += bytes
+
+  def count(self, name, value=1) :
+    """Increases a counter"""
+    if self.enabled :
+      with self.lock :
+        self.counters[name] = self.counters.get(name, 0) + value
+
+  def seconds(self, *stages) :
+    """Returns the total time recorded for the given stages"""
+    with self.lock :
+      return sum([self.stages[stage][1] for stage in stages if stage in self.stages])
+
+  @contextlib.contextmanager
+  def timer(self, stage, count=1, bytes=0) :
+    """Records the time it takes to run a block of code as a stage"""
+    start = time.time()
+    try :
+      yield
+    finally :
+      self.add(stage, time.time() - start, count, bytes)
+
+  def iterate(self, stage, items) :
+    """Iterates over strings, recording the time it takes to get each of 
+    them as a stage"""
+    items = iter(items)
+    while True :
+      start = time.time()
+      try :
+        item = next(items)
+      except StopIteration :
+        return
+      self.add(stage, time.time() - start, bytes=len(item))
+      yield item
+
+  def report(self, feed) :
+    """Returns the statistics as a dictionary"""
+    report = {
+        'feed' : feed,
+        'start' : self.start,
+        'seconds' : time.time() - self.start,
+        'stages' : dict([(stage, {'count' : count, 'seconds' : seconds, 'bytes' : bytes}) for (stage, (count, seconds, bytes)) in self.stages.items()]),
+        'counters' : self.counters }
+    if self.allocations :
+      report['allocations'] = self.allocations
+    return report
+
+  def write_json(self, filename, feed) :
+    """Saves the statistics as JSON"""
+    write_file(filename, json.dumps(self.report(feed), indent=2, sort_keys=True) + '\n')
+
+  def write_prometheus(self, filename, feed) :
+    """Saves the statistics in the format of the Prometheus textfile 
+    collector"""
+    report = self.report(feed)
+    label = 'feed="' + feed.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    lines = []
+    def metric(name, type, help, values) :
+      lines.append('# HELP atomail_' + name + ' ' + help)
+      lines.append('# TYPE atomail_' + name + ' ' + type)
+      for (labels, value) in values :
+        lines.append('atomail_' + name + '{' + ','.join([label] + labels) + '} ' + repr(value))
+    stages = sorted(report['stages'].items())
+    metric('last_update_timestamp_seconds', 'gauge', 'The time the last update of the feed started', [([], report['start'])])
+    metric('update_seconds', 'gauge', 'The duration of the last update of the feed', [([], report['seconds'])])
+    metric('stage_seconds', 'gauge', 'The time spent in a stage of the last update', [(['stage="' + stage + '"'], values['seconds']) for (stage, values) in stages])
+    metric('stage_count', 'gauge', 'The number of times a stage ran in the last update', [(['stage="' + stage + '"'], values['count']) for (stage, values) in stages])
+    metric('stage_bytes', 'gauge', 'The number of bytes handled by a stage in the last update', [(['stage="' + stage + '"'], values['bytes']) for (stage, values) in stages])
+    for (name, value) in sorted(report['counters'].items()) :
+      metric(name, 'gauge', 'The number of ' + name.replace('_', ' ') + ' in the last update', [([], value)])
+    write_file(filename, '\n'.join(lines) + '\n')
+
+  @contextlib.contextmanager
+  def profile(self, filename) :
+    """Runs a block of code with the profiler (if a filename is given), and
+    saves the profile to the file.
+
+    If tracemalloc is available, the peak memory use and the places that
+    allocated the most memory are recorded as well."""
+    if not filename :
+      yield
+      return
+    profiler = cProfile.Profile()
+    if tracemalloc :
+      tracemalloc.start()
+    profiler.enable()
+    try :
+      yield
+    finally :
+      profiler.disable()
+      logging.info('Writing profile to ' + filename)
+      profiler.dump_stats(filename)
+      if tracemalloc :
+        self.count('peak_memory_bytes', tracemalloc.get_traced_memory()[1])
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        self.allocations = [{'location' : str(statistic.traceback), 'bytes' : statistic.size, 'count' : statistic.count} for statistic in statistics]
+        tracemalloc.stop()
+
+NO_STATS = Stats(enabled=False)
+
+
+################################################################################
+# Feed entries
+################################################################################
+
+class FeedEntry(object) :
+  """An entry of a message feed.
+
+  Entries that were read from a feed file are kept as a span of raw bytes in
+  that file, and are only parsed when they are needed. Entries that were
+  created by the program are kept as DOM elements."""
+
+  __slots__ = ['id', 'mid', 'updated', 'published', 'element', 'filename', 'start', 'end', 'prefix']
+
+  def __init__(self, id, mid, updated, published=None, element=None, filename=None, start=0, end=0, prefix=b'') :
+    self.id = id
+    self.mid = mid
+    self.updated = updated
+    self.published = published
+    self.element = element
+    self.filename = filename
+    self.start = start
+    self.end = end
+    self.prefix = prefix
+
+  def date(self) :
+    """Returns the date of the message of the entry (as a datetime object).
+
+    Entries without a published time use their updated time."""
+    if self.published or self.updated :
+      return from_atom_date(self.published or self.updated)
+    return datetime.datetime(datetime.MINYEAR,1,1,tzinfo=TZ())
+
+  def data(self) :
+    """Returns the raw bytes of the entry in its feed file"""
+    file = open(self.filename, 'rb')
+    try :
+      file.seek(self.start)
+      return file.read(self.end - self.start)
+    finally :
+      file.close()
+
+  def copyable(self, prefix) :
+    """Checks whether the raw bytes of the entry can be copied as they are
+    into a UTF-8 encoded document with the given prefix (i.e. the XML 
+    declaration and the start tag of the root element). This is the case if
+    the entry is UTF-8 encoded, and the namespaces declared on the root of
+    its own document are declared in the same way on the new root."""
+    if self.element or not self.filename :
+      return False
+    encoding = re.match(br'<\?xml[^>]*encoding="([^"]*)"', self.prefix)
+    if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8') :
+      return False
+    return set(XMLNS_RE.findall(self.prefix)) <= set(XMLNS_RE.findall(prefix))
+
+  def parse(self, doc) :
+    """Returns the entry as a DOM element of the given document"""
+    if not self.element :
+      entry_doc = minidom.parseString(self.prefix + self.data() + b'</feed>')
+      self.element = doc.importNode(entry_doc.documentElement.firstChild, True)
+      entry_doc.unlink()
+    return self.element
+
+
+class FeedReader :
+  """Reads a feed file without building a DOM of its entries.
+
+  The file is scanned with expat. The toplevel elements other than entries 
+  are collected into a (small) document, and for each entry, only the id,
+  the dates and the Message-ID are kept, together with the location of the
+  entry in the file."""
+
+  CHUNK_SIZE = 65536
+  
+  def __init__(self, filename) :
+    self.filename = filename
+    self.declaration = b''
+    self.encoding = 'utf-8'
+    self.root = b''
+    self.header = []
+    self.entries = []
+
+  def read(self) :
+    """Scans the file, and returns the header document and the entries"""
+    file = open(self.filename, 'rb')
+    try :
+      self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally :
+      file.close()
+    try :
+      self.parser = xml.parsers.expat.ParserCreate()
+      self.parser.ordered_attributes = True
+      self.parser.XmlDeclHandler = self.handle_declaration
+      self.parser.StartElementHandler = self.handle_start
+      self.parser.EndElementHandler = self.handle_end
+      self.parser.buffer_text = True
+      self.depth = 0
+      self.entry = None
+      self.text = None
+      for offset in range(0, len(self.data), self.CHUNK_SIZE) :
+        self.parser.Parse(self.data[offset:offset + self.CHUNK_SIZE], False)
+      self.parser.Parse(b'', True)
+      doc = minidom.parseString(self.declaration + self.root + b''.join(self.header) + b'</' + self.root_name + b'>')
+      prefix = self.declaration + self.root
+      for entry in self.entries :
+        entry.prefix = prefix
+      return (doc, self.entries)
+    finally :
+      self.data.close()
+
+  def element_end(self, name) :
+    """Returns the offset of the end of the element that is being closed"""
+    index = self.parser.CurrentByteIndex
+    tag = b'</' + name.encode('utf-8')
+    if self.data[index:index + len(tag)] == tag :
+      return self.data.find(b'>', index) + 1
+    # Empty element
+    return index
+
+  def handle_declaration(self, version, encoding, standalone) :
+    self.declaration = b'<?xml version="' + version.encode('utf-8') + b'"'
+    if encoding :
+      self.declaration += b' encoding="' + encoding.encode('utf-8') + b'"'
+      self.encoding = encoding.lower()
+    self.declaration += b'?>'
+
+  def handle_start(self, name, attributes) :
+    self.depth += 1
+    if self.depth == 1 :
+      self.root_name = name.encode('utf-8')
+      self.root = b'<' + self.root_name
+      for i in range(0, len(attributes), 2) :
+        self.root += b' ' + attributes[i].encode('utf-8') + b'="' + xml.sax.saxutils.escape(attributes[i+1], {'"' : '&quot;'}).encode('utf-8') + b'"'
+      self.root += b'>'
+    elif self.depth == 2 :
+      self.start = self.parser.CurrentByteIndex
+      if name == 'entry' :
+        self.entry = FeedEntry(None, None, None, filename=self.filename)
+    elif self.depth == 3 and self.entry :
+      if name in ('id', 'updated', 'published') :
+        self.text = []
+        self.parser.CharacterDataHandler = self.handle_data
+      elif name == 'link' :
+        attributes = dict(zip(attributes[0::2], attributes[1::2]))
+        if attributes.get('rel') == 'via' and attributes.get('href', '').startswith('mid:') :
+          self.entry.mid = url_unquote(attributes['href'][4:])
+
+  def handle_end(self, name) :
+    if self.depth == 2 :
+      end = self.element_end(name)
+      if self.entry :
+        self.entry.start = self.start
+        self.entry.end = end
+        self.entries.append(self.entry)
+        self.entry = None
+      else :
+        self.header.append(self.data[self.start:end])
+    elif self.depth == 3 and self.text is not None :
+      setattr(self.entry, name, ''.join(self.text))
+      self.text = None
+      self.parser.CharacterDataHandler = None
+    self.depth -= 1
+
+  def handle_data(self, data) :
+    self.text.append(data)
+
+
 ################################################################################
 # MessageFeed 
 ################################################################################
@@ -163,28 +805,67 @@ def get_charset(message, default="ascii"):
 class MessageFeed :
   """A class representing an (Atom) feed of messages"""
 
-  def __init__(self, filename, uri, title, max_items, max_time, strip_subject) :
-    """Initialize the feed"""
+  def __init__(self, filename, uri, title, max_items, max_time, strip_subject, max_content_size=0, blobs=None, blob_threshold=0, archive_size=0, precompress=False, validators=False, stats=None) :
+    """Initialize the feed.
+
+    If a BlobStore is given, attachments and inline parts of messages are 
+    stored in it, as are contents larger than blob_threshold characters.
+
+    If archive_size is positive, trimmed entries are moved to archive 
+    documents of at most archive_size entries (RFC 5005), instead of being
+    thrown away.
+
+    If precompress is set, compressed copies of the feed are saved next to
+    it, and if validators is set, a file with its ETag and Last-Modified 
+    HTTP headers.
+
+    The time spent in the stages of an update is recorded in the given 
+    Stats object."""
     logging.info('Initializing the message feed')
     self.filename = filename
+    self.uri = uri
+    self.title = title
+    self.archive_size = archive_size
+    self.precompress = precompress
+    self.validators = validators
+    self.max_content_size = max_content_size
+    self.blobs = blobs
+    self.blob_threshold = blob_threshold
     self.max_items = max_items
     self.max_time = max_time
     self.strip_subject = strip_subject
+    self.stats = stats or NO_STATS
+    self.stats.count('messages_added', 0)
+    self.stats.count('messages_removed', 0)
     self.doc = xml.dom.minidom.getDOMImplementation().createDocument(ATOM_NS, 'feed', None)
     self.doc.documentElement.setAttribute('xmlns',ATOM_NS)
     self.set_id(uri)
     self.set_updated(datetime.datetime(datetime.MINYEAR,1,1))
+    self.entries = []
+    self.encoding = 'utf-8'
+    self.modified = True
     if os.path.isfile(self.filename) :
       logging.info('Reading feed from ' + self.filename)
       try : 
-        self.doc = minidom.parse(self.filename)
-        self.doc.normalize()
+        reader = FeedReader(self.filename)
+        with self.stats.timer('load', bytes=os.path.getsize(self.filename)) :
+          (doc, self.entries) = reader.read()
+        self.stats.count('feed_entries', len(self.entries))
+        self.doc.unlink()
+        self.doc = doc
+        self.encoding = reader.encoding
+        self.modified = False
       except :
          logging.warning('Unable to parse feed. Resetting the file.')
     else :
       logging.info('Creating new file ' + self.filename)
+    self.feed_id = [x for x in self.doc.documentElement.getElementsByTagName('id') if x.parentNode == self.doc.documentElement][0].childNodes[0].data
+    self.index_entries()
+    header = self.doc.documentElement.toxml()
     self.set_link(uri)
     self.set_title(title)
+    if self.doc.documentElement.toxml() != header :
+      self.modified = True
     
     
   def __del__(self) :
@@ -195,18 +876,44 @@ class MessageFeed :
   def add_message(self, message) :
     """Adds a new message to the feed"""
     logging.info('Adding new message to the feed')
-
+    # Without the time of the stages of create_entry()
+    nested = self.stats.seconds('attachments', 'extract')
+    start = time.time()
+    self.add_entry(self.create_entry(message))
+    self.stats.add('add', time.time() - start - (self.stats.seconds('attachments', 'extract') - nested))
+
+  def add_entry(self, entry) :
+    """Adds an entry (created by create_entry(), possibly of another 
+    instance of the feed) to the feed"""
+    self.entries.append(entry)
+    self.entry_ids.add(entry.id)
+    if entry.mid :
+      self.message_ids.add(entry.mid)
+    self.modified = True
+    self.stats.count('messages_added')
+
+  def create_entry(self, message) :
+    """Returns a new entry for a message, without adding it to the feed"""
     # Create a new entry
     entry = self.doc.createElement('entry')
     
     # ID
+    entry_id = self.feed_id + '#' + message_id(message)
     id = self.doc.createElement('id')
-    id.appendChild(self.doc.createTextNode(self.id() + '#' + message_id(message)))
+    id.appendChild(self.doc.createTextNode(entry_id))
     entry.appendChild(id)
 
+    # Message-ID
+    mid = message_mid(message)
+    if mid :
+      via = self.doc.createElement('link')
+      via.setAttribute('rel', 'via')
+      via.setAttribute('href', 'mid:' + quote(header_bytes(mid), '@'))
+      entry.appendChild(via)
+
     # Author
     from_address = decode_header(message["From"], "Anonymous")
-    (name,address) = email.Utils.parseaddr(from_address)
+    (name,address) = email.utils.parseaddr(from_address)
     author = self.doc.createElement('author')
     author_name = self.doc.createElement('name')
     if name and address :
@@ -228,43 +935,97 @@ class MessageFeed :
     logging.debug('Published: ' + date.isoformat())
     
     # Updated
+    updated_text = current_datetime().isoformat()
     updated = self.doc.createElement('updated')
-    updated.appendChild(self.doc.createTextNode(current_datetime().isoformat()))
+    updated.appendChild(self.doc.createTextNode(updated_text))
     entry.appendChild(updated)
     
     # Subject
     title = self.doc.createElement('title')
     title_text = decode_header(message["Subject"], "(No Subject)")
     if self.strip_subject :
-      title_text = re.sub('\[[a-zA-Z0-9:_\. -]*\]\s*','',title_text)
+      title_text = re.sub(r'\[[a-zA-Z0-9:_\. -]*\]\s*','',title_text)
     title.appendChild(self.doc.createTextNode(title_text))
     entry.appendChild(title)
     logging.debug('Title: ' + title_text)
 
+    # Attachments
+    references = {}
+    if self.blobs :
+      with self.stats.timer('attachments') :
+        references = self.add_attachments(entry, message)
+
     # Content
     content = self.doc.createElement('content')
-    contents = message_contents(message, get_charset(message))
+    with self.stats.timer('extract') :
+      contents = message_content(message, get_charset(message), self.max_content_size)
     if contents :
       # Add the preferred content
-      contents.sort(lambda x, y : cmp(x,y))
-      (content_type,content_text) = contents[0]
+      (content_type,content_text) = contents
 
       # Replace text content with HTML counterpart (if there is none)
       # According to the spec, all whitespace in 'text' content can be collapsed. Since
       # mails are typically formatted, we don't want this, so we use preformatted
       if content_type == "text":
         content_type = "html"
-        content_text = "<pre>" + cgi.escape(content_text) + "</pre>"
-
-      content.setAttribute('type',content_type)
-      content.appendChild(self.doc.createTextNode(content_text))
+        content_text = "<pre>" + xml.sax.saxutils.escape(content_text) + "</pre>"
+
+      # Refer to the stored inline parts
+      for (reference, uri) in references.items() :
+        content_text = content_text.replace(reference, uri)
+
+      if self.blobs and self.blob_threshold > 0 and len(content_text) > self.blob_threshold :
+        # Store large contents separately. Atom requires a summary then.
+        logging.debug('Storing content of ' + str(len(content_text)) + ' characters')
+        # These are the only blobs stored as HTML, so readers render them
+        uri = self.blobs.store(content_text.encode('utf-8'), 'text/html', '.html')
+        content.setAttribute('type', 'text/html')
+        content.setAttribute('src', uri)
+        summary = self.doc.createElement('summary')
+        summary.appendChild(self.doc.createTextNode(title_text))
+        entry.appendChild(summary)
+      else :
+        content.setAttribute('type',content_type)
+        content.appendChild(self.doc.createTextNode(content_text))
     else :
       logging.warning('No valid contents found')
       content.appendChild(self.doc.createTextNode(title_text))
     entry.appendChild(content)
-
-    # Add the entry to the feed
-    self.doc.documentElement.appendChild(entry)
+    return FeedEntry(entry_id, mid, updated_text, date.isoformat(), element=entry)
+
+  def add_attachments(self, entry, message) :
+    """Stores the parts of a message other than its content in the blob 
+    store.
+
+    Attachments are added to the entry as enclosure links. Returns a 
+    dictionary with the URI of every inline part, by 'cid:' reference."""
+    references = {}
+    content_part = message_content_part(message)
+    for part in message.walk() :
+      if part.is_multipart() or part is content_part :
+        continue
+      if part.get_content_maintype() == 'text' and not is_attachment(part) :
+        # Alternative versions of the content
+        continue
+      data = part.get_payload(decode=True)
+      if not data :
+        continue
+      filename = part_filename(part)
+      uri = self.blobs.store(data, part.get_content_type())
+      content_id = part.get('Content-ID')
+      if content_id and not is_attachment(part) :
+        references['cid:' + content_id.strip().lstrip('<').rstrip('>')] = uri
+      else :
+        logging.debug('Adding enclosure ' + uri)
+        link = self.doc.createElement('link')
+        link.setAttribute('rel', 'enclosure')
+        link.setAttribute('href', uri)
+        link.setAttribute('type', part.get_content_type())
+        link.setAttribute('length', str(len(data)))
+        if filename :
+          link.setAttribute('title', filename)
+        entry.appendChild(link)
+    return references
 
   def set_generator(self) :
     """Updates the generator (program) of this feed"""
@@ -276,36 +1037,54 @@ class MessageFeed :
 
   def id(self) :
     """Returns the unique identifier of this feed"""
-    return filter(lambda x : x.parentNode == self.doc.documentElement, self.doc.documentElement.getElementsByTagName('id'))[0].childNodes[0].data
+    return self.feed_id
+
+  def index_entries(self) :
+    """Builds the index of entry ids and Message-IDs used by contains()"""
+    self.entry_ids = set()
+    self.message_ids = set()
+    for entry in self.entries :
+      if entry.id :
+        self.entry_ids.add(entry.id)
+      if entry.mid :
+        self.message_ids.add(entry.mid)
   
   def contains_message(self, message) :
-    id = message_id(message)
-    feed_id = self.id()
-    for entry in self.doc.getElementsByTagName('entry') :
-      for entry_id_element in entry.getElementsByTagName('id') :
-        entry_id = entry_id_element.childNodes[0].data
-        if entry_id == feed_id + '#' + id :
-          return True
-    return False
+    """Checks whether a message is already in the feed"""
+    with self.stats.timer('dedup') :
+      return self.contains(message_id(message), message_mid(message))
+
+  def contains_entry(self, entry) :
+    """Checks whether the feed contains an entry with the same id or 
+    Message-ID as the given one"""
+    return entry.id in self.entry_ids or (entry.mid is not None and entry.mid in self.message_ids)
+
+  def contains(self, id, mid=None) :
+    """Checks whether the feed contains an entry with the given message id
+    (as computed by message_id()), or with the given (RFC 5322) Message-ID"""
+    if self.feed_id + '#' + id in self.entry_ids :
+      return True
+    return mid is not None and mid in self.message_ids
 
   def updated(self) :
     """Returns the last time this feed was updated (as a datetime object)"""
-    return from_atom_date(filter(lambda x : x.parentNode == self.doc.documentElement, self.doc.documentElement.getElementsByTagName('updated'))[0].childNodes[0].data)
+    return from_atom_date([x for x in self.doc.documentElement.getElementsByTagName('updated') if x.parentNode == self.doc.documentElement][0].childNodes[0].data)
 
   def set_id(self, id) :
     """Sets the unique identifier of this feed"""
     self.set_element_text('id', id)
+    self.feed_id = id
     
   def set_title(self, title) :
     """Sets the title of this feed"""
     self.set_element_text('title', title)
     
-  def set_link(self, uri) :
-    """Sets the URI of this feed"""
+  def set_link(self, uri, rel='self') :
+    """Sets the URI of this feed, or another link with the given relation"""
     link = self.doc.createElement('link')
-    link.setAttribute('rel', 'self')
+    link.setAttribute('rel', rel)
     link.setAttribute('href', uri)
-    self.replace_element(link)
+    self.replace_element(link, lambda x : x.getAttribute('rel') == rel)
 
   def set_element_text(self,tagname,value) :
     """Sets the text contents of a toplevel element of this feed to this string"""
@@ -313,12 +1092,16 @@ class MessageFeed :
     text.appendChild(self.doc.createTextNode(value))
     self.replace_element(text)
 
-  def replace_element(self,element) :
-    """Replaces a toplevel element in the feed"""
+  def replace_element(self,element,match=None) :
+    """Replaces a toplevel element in the feed. 
+    
+    If a match function is given, only the elements for which it returns 
+    True are considered."""
     # Try to find the relevant node node
-    nodes = filter(lambda x : x.parentNode == self.doc.documentElement, self.doc.documentElement.getElementsByTagName(element.tagName))
+    nodes = [x for x in self.doc.documentElement.getElementsByTagName(element.tagName) if x.parentNode == self.doc.documentElement and (not match or match(x))]
     if nodes :
       self.doc.documentElement.replaceChild(element,nodes[0])
+      return
     
     # Create a new node (before the entries)
     entries = self.doc.documentElement.getElementsByTagName('entry')
@@ -327,25 +1110,89 @@ class MessageFeed :
     else :
       self.doc.documentElement.appendChild(element)
   
+  def remove_entries(self, entries) :
+    """Removes the given entries from the feed"""
+    for entry in entries :
+      self.entry_ids.discard(entry.id)
+      self.message_ids.discard(entry.mid)
+    removed = set(entries)
+    self.entries = [entry for entry in self.entries if entry not in removed]
+    if removed :
+      self.modified = True
+      self.stats.count('messages_removed', len(removed))
+
   def trim_entries(self) :
-    """Removes all the redundant and outdated entries"""
+    """Removes all the redundant and outdated entries, and returns them"""
     logging.info('Trimming entries')
-    entries = self.doc.documentElement.getElementsByTagName('entry')
-    entries.sort(lambda x, y : cmp(entry_date(x),entry_date(y)))
+    entries = sorted(self.entries, key=lambda x : x.date())
+    removed = []
 
     # Trim based on the maximum number of items
     if self.max_items > 0 :
       while len(entries) > self.max_items :
         logging.debug('Removing redundant entry')
-        self.doc.documentElement.removeChild(entries.pop(0))
+        removed.append(entries.pop(0))
     
     # Trim based on the maximum time elapsed
     if self.max_time > 0 :
       max_datetime = current_datetime() - datetime.timedelta(minutes=self.max_time)
-      while entries and entry_date(entries[0]) < max_datetime :
+      while entries and entries[0].date() < max_datetime :
         logging.debug('Removing outdated entry')
-        self.doc.documentElement.removeChild(entries.pop(0))
+        removed.append(entries.pop(0))
+
+    self.remove_entries(removed)
+    return removed
       
+  def archive_filename(self, number) :
+    """Returns the filename of an archive document"""
+    (root, extension) = os.path.splitext(self.filename)
+    return root + '-' + str(number) + extension
+
+  def archive_uri(self, number) :
+    """Returns the URI of an archive document"""
+    (root, extension) = os.path.splitext(self.uri)
+    return root + '-' + str(number) + extension
+
+  def archive_page(self, number) :
+    """Opens an archive document of this feed"""
+    page = MessageFeed(self.archive_filename(number), self.archive_uri(number), self.title, 0, -1, False, precompress=self.precompress, validators=self.validators)
+    page.doc.documentElement.setAttribute('xmlns:fh', HISTORY_NS)
+    page.replace_element(page.doc.createElement('fh:archive'))
+    page.set_link(self.uri, 'current')
+    if number > 1 :
+      page.set_link(self.archive_uri(number - 1), 'prev-archive')
+    return page
+
+  def archive_entries(self, entries) :
+    """Moves entries to the archive documents of this feed.
+
+    The archive documents are numbered from the oldest (1) to the newest. 
+    Entries are added to the newest document until it is full. A full 
+    document is given a link to the next one when that one is created, and
+    is never written again afterwards."""
+    number = 1
+    while os.path.exists(self.archive_filename(number + 1)) :
+      number += 1
+    page = self.archive_page(number)
+    logging.info('Archiving ' + str(len(entries)) + ' entries to ' + page.filename)
+    for entry in sorted(entries, key=lambda x : x.date()) :
+      if len(page.entries) >= self.archive_size :
+        page.set_link(self.archive_uri(number + 1), 'next-archive')
+        page.set_updated(current_datetime())
+        # Changes to the header do not mark a feed as modified
+        page.modified = True
+        page.save()
+        number += 1
+        page = self.archive_page(number)
+        logging.info('Starting archive ' + page.filename)
+      if entry.element :
+        entry.element = page.doc.importNode(entry.element, True)
+      page.entries.append(entry)
+      page.modified = True
+    page.set_updated(current_datetime())
+    page.save()
+    self.set_link(self.archive_uri(number), 'prev-archive')
+
   def set_updated(self, time) :
     """Sets the updated time as a datetime object."""
     self.set_element_text('updated', time.isoformat())
@@ -354,14 +1201,223 @@ class MessageFeed :
     """Saves this feed to file.
 
     The generator is updated, and the elements are trimmed before the feed
-    is saved"""
+    is saved. If no entries were added or removed, and the header did not 
+    change, the file is left alone. 
+
+    Only the header and the new entries are serialized. The entries that 
+    were read from the file are copied from it as they are (unless the file
+    is not UTF-8 encoded). Afterwards, all entries refer to their location
+    in the new file."""
     logging.info('Saving feed')
+    with self.stats.timer('trim') :
+      removed = self.trim_entries()
+    if self.archive_size > 0 and removed :
+      self.archive_entries(removed)
+    if not self.modified :
+      logging.info('Feed unchanged. Not writing ' + self.filename)
+      # Repair side files that are missing, or older than the feed (e.g. 
+      # because writing them failed)
+      mtime = os.path.getmtime(self.filename)
+      if any([not os.path.exists(name) or os.path.getmtime(name) < mtime for name in self.side_files()]) :
+        file = open(self.filename, 'rb')
+        try :
+          self.save_side_files(file.read())
+        finally :
+          file.close()
+      return
     self.set_generator()
-    self.trim_entries()
+    start = time.time()
+    header = self.doc.toxml('utf-8')
+    prefix = document_prefix(header)
+    footer = header.rindex(b'</')
+    parts = [header[:footer]]
+    offset = footer
+    spans = []
+    sources = {}
+    try :
+      for entry in self.entries :
+        if entry.copyable(prefix) :
+          if entry.filename not in sources :
+            file = open(entry.filename, 'rb')
+            try :
+              sources[entry.filename] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            finally :
+              file.close()
+          data = sources[entry.filename][entry.start:entry.end]
+        else :
+          data = entry.parse(self.doc).toxml('utf-8')
+        parts.append(data)
+        spans.append((entry, offset, offset + len(data)))
+        offset += len(data)
+    finally :
+      for source in sources.values() :
+        source.close()
+    parts.append(header[footer:])
+    data = b''.join(parts)
+    self.stats.add('serialize', time.time() - start, bytes=len(data))
+    start = time.time()
     logging.info('Writing feed to file ' + self.filename)
-    out = open(self.filename, 'w')
-    out.write(self.doc.toxml('utf-8'))
-    out.close()
+    write_file(self.filename, data)
+    self.save_side_files(data)
+    self.stats.add('write', time.time() - start, bytes=len(data))
+    self.modified = False
+    self.encoding = 'utf-8'
+    for (entry, start, end) in spans :
+      entry.filename = self.filename
+      entry.start = start
+      entry.end = end
+      entry.prefix = prefix
+      entry.element = None
+
+
+  def side_files(self) :
+    """Returns the names of the files that are saved next to the feed"""
+    names = []
+    if self.precompress :
+      names.append(self.filename + '.gz')
+      if brotli :
+        names.append(self.filename + '.br')
+    if self.validators :
+      names.append(self.filename + '.headers')
+    return names
+
+  def save_side_files(self, data) :
+    """Saves the compressed copies and the validators of the feed, given
+    the data of the saved feed file. They are only written after the feed
+    itself, so they never describe a feed that was not saved."""
+    if self.precompress :
+      logging.info('Writing compressed feed to file ' + self.filename + '.gz')
+      write_file(self.filename + '.gz', gzip_data(data))
+      if brotli :
+        logging.info('Writing compressed feed to file ' + self.filename + '.br')
+        write_file(self.filename + '.br', brotli.compress(data))
+    if self.validators :
+      write_file(self.filename + '.headers', 'ETag: "' + hashlib.sha1(data).hexdigest() + '"\nLast-Modified: ' + email.utils.formatdate(os.path.getmtime(self.filename), usegmt=True) + '\n')
+
+
+################################################################################
+# BlobStore
+################################################################################
+
+class BlobStore :
+  """A directory of files that are referred to from feed entries, such as 
+  attachments.
+
+  Every blob is stored under the SHA-1 hash of its data, so identical blobs
+  are only stored once. The directory needs to be published under the 
+  given base URI. Since the data comes from the sender of a message, only
+  the content types in EXTENSIONS, which web servers do not execute or 
+  render as active content, get their own extension; all other blobs 
+  (including HTML, SVG and scripts) are stored as .bin files. The filename
+  of an attachment is never used. The only exception are large message
+  contents, which are stored as UTF-8 .html files, and therefore need the
+  directory to be served with a charset of UTF-8 and a sandboxing
+  Content-Security-Policy."""
+
+  EXTENSIONS = {
+      'text/plain' : '.txt', 'image/jpeg' : '.jpg', 'image/png' : '.png', 
+      'image/gif' : '.gif', 'image/webp' : '.webp', 'application/pdf' : '.pdf', 
+      'application/zip' : '.zip', 'audio/mpeg' : '.mp3', 'video/mp4' : '.mp4' }
+
+  def __init__(self, directory, uri) :
+    self.directory = directory
+    self.uri = uri if uri.endswith('/') else uri + '/'
+    make_directory(directory)
+
+  def extension(self, content_type) :
+    """Returns the filename extension for a blob"""
+    return self.EXTENSIONS.get((content_type or '').lower(), '.bin')
+
+  def store(self, data, content_type, extension=None) :
+    """Stores a blob, and returns its URI. The extension overrides the one 
+    of the content type."""
+    name = hashlib.sha1(data).hexdigest() + (extension or self.extension(content_type))
+    path = os.path.join(self.directory, name)
+    if not os.path.exists(path) :
+      logging.debug('Storing blob ' + name)
+      (fd, temporary_filename) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+      try :
+        os.write(fd, data)
+      finally :
+        os.close(fd)
+      os.chmod(temporary_filename, 0o644)
+      os.rename(temporary_filename, path)
+    return self.uri + name
+
+
+################################################################################
+# SyncState
+################################################################################
+
+class SyncState :
+  """A persistent store for the synchronization state of message sources.
+
+  The state is kept in a small SQLite file, and allows sources to only
+  retrieve the messages that arrived since the previous run. Every source 
+  keeps its state under its own key, so several sources can share a file.
+  For each source, the store holds named values (such as the last seen 
+  article number), and a set of keys (such as the seen POP3 UIDLs).
+
+  Changes only become persistent when commit() is called, which should
+  happen after the feed is saved. The store can be used by several threads
+  (such as the sources of a MergedSource)."""
+
+  def __init__(self, filename) :
+    logging.info('Opening synchronization state ' + filename)
+    self.lock = threading.RLock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute('CREATE TABLE IF NOT EXISTS value (source TEXT, name TEXT, value TEXT, PRIMARY KEY (source, name))')
+    self.db.execute('CREATE TABLE IF NOT EXISTS seen (source TEXT, key TEXT, PRIMARY KEY (source, key))')
+
+  def get(self, source, name, default=None) :
+    """Returns a value of the state of a source"""
+    with self.lock :
+      row = self.db.execute('SELECT value FROM value WHERE source = ? AND name = ?', (source, name)).fetchone()
+      if row :
+        return row[0]
+      return default
+
+  def set(self, source, name, value) :
+    """Sets a value of the state of a source"""
+    with self.lock :
+      self.db.execute('INSERT OR REPLACE INTO value VALUES (?, ?, ?)', (source, name, str(value)))
+
+  def keys(self, source) :
+    """Returns the set of keys seen by a source"""
+    with self.lock :
+      return set([row[0] for row in self.db.execute('SELECT key FROM seen WHERE source = ?', (source,))])
+
+  def add_keys(self, source, keys) :
+    """Adds keys to the set of keys seen by a source"""
+    with self.lock :
+      self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', [(source, key) for key in keys])
+
+  def remove_keys(self, source, keys) :
+    """Removes keys from the set of keys seen by a source"""
+    with self.lock :
+      self.db.executemany('DELETE FROM seen WHERE source = ? AND key = ?', [(source, key) for key in keys])
+
+  def reset(self, source) :
+    """Forgets the complete state of a source"""
+    with self.lock :
+      self.db.execute('DELETE FROM value WHERE source = ?', (source,))
+      self.db.execute('DELETE FROM seen WHERE source = ?', (source,))
+
+  def commit(self) :
+    """Makes the changes to the state persistent"""
+    logging.info('Saving synchronization state')
+    with self.lock :
+      self.db.commit()
+
+  def rollback(self) :
+    """Discards the changes since the last commit"""
+    with self.lock :
+      self.db.rollback()
+
+  def close(self) :
+    """Closes the store, discarding uncommitted changes"""
+    with self.lock :
+      self.db.close()
 
 
 ################################################################################
@@ -372,155 +1428,948 @@ class MailSource :
   """An abstract class used to retrieve mail messages from a certain source.
   
   Subclasses must implement the messages() function, which retrieves the
-  messages from the concrete source."""
-
-  def messages(self) :
-    """Retrieve all messages (in reverse order)"""
+  messages from the concrete source. 
+  
+  If the source has a SyncState, it only retrieves the messages that 
+  arrived since the state was last committed, and records its new state 
+  under its key. The time spent probing, fetching and parsing messages is 
+  recorded in its Stats object."""
+
+  state = None
+  key = None
+  stats = NO_STATS
+
+  def messages(self, known=None, since=None, limit=0) :
+    """Retrieve all messages (in reverse order)
+
+    known is an optional function that checks whether a message (of which
+    only the From, Subject, Date and Message-ID headers need to be present)
+    is already known. Sources can use it to avoid retrieving messages that
+    are already in the feed. The retrieval stops at the first known message.
+
+    If since is given, messages that were sent before that time are skipped,
+    and if limit is positive, at most limit messages are retrieved. Sources
+    check these cutoffs as early as they can, but the caller still needs to
+    check the dates of the messages it gets."""
     pass
 
 class PipeSource(MailSource) :
   """A class that retrieves messages from stdin"""
 
-  def messages(self) :
+  def messages(self, known=None, since=None, limit=0) :
     logging.info('Reading message from stdin')
-    return [email.message_from_file(sys.stdin)]
+    return [parse_message(read_stdin())]
+
+  def spool(self, directory) :
+    """Stores the message from stdin in a spool directory (see 
+    spool_data())"""
+    logging.info('Spooling message from stdin to ' + directory)
+    spool_data(directory, read_stdin())
+
+
+class SpoolSource(MailSource) :
+  """A class that retrieves the messages from a spool directory.
+  
+  All spooled messages are returned, newest first, except the ones that are
+  known already. After the feed is saved, remove() deletes the messages 
+  that were read (returned, known, or outdated) from the spool. Messages
+  beyond the limit stay in the spool."""
+
+  def __init__(self, directory) :
+    self.directory = os.path.join(directory, 'new')
+    self.files = []
+
+  def pending(self) :
+    """Checks whether there are messages in the spool"""
+    return os.path.isdir(self.directory) and any([not name.startswith('.') for name in os.listdir(self.directory)])
+
+  def messages(self, known=None, since=None, limit=0) :
+    logging.info('Reading spooled messages from ' + self.directory)
+    if not os.path.isdir(self.directory) :
+      return
+    names = sorted([name for name in os.listdir(self.directory) if not name.startswith('.')], reverse=True)
+    logging.debug(str(len(names)) + ' spooled messages')
+    self.files = []
+    count = 0
+    for name in names :
+      if limit > 0 and count >= limit :
+        break
+      message_file = open(os.path.join(self.directory, name), 'rb')
+      try :
+        message = parse_message(message_file.read())
+      finally :
+        message_file.close()
+      self.files.append(name)
+      if known and known(message) :
+        logging.info('Spooled message ' + name + ' already known')
+        continue
+      if message_outdated(message, since) :
+        logging.debug('Spooled message ' + name + ' outdated')
+        continue
+      count += 1
+      yield message
+
+  def remove(self) :
+    """Removes the messages that were read from the spool"""
+    for name in self.files :
+      try :
+        os.remove(os.path.join(self.directory, name))
+      except OSError :
+        pass
+    self.files = []
+
+
+class BufferSource(MailSource) :
+  """A class that retrieves messages that are kept in memory, such as the 
+  messages received by a DeliveryServer.
+
+  Like a SpoolSource, it returns all messages, newest first, except the 
+  ones that are known already, and messages that were received more than
+  once. After the feed is saved, clear() forgets 
+  the returned messages."""
+
+  def __init__(self) :
+    self.texts = []
+    self.count = 0
+
+  def add(self, text) :
+    """Adds a message (as bytes)"""
+    self.texts.append(text)
+
+  def messages(self, known=None, since=None, limit=0) :
+    logging.info('Reading ' + str(len(self.texts)) + ' buffered messages')
+    self.count = len(self.texts)
+    count = 0
+    seen = set()
+    for text in reversed(self.texts[:self.count]) :
+      if limit > 0 and count >= limit :
+        break
+      with self.stats.timer('parse', bytes=len(text)) :
+        message = parse_message(text)
+      if not message :
+        logging.warning('Unable to parse message:\n' + text.decode('ascii', 'replace'))
+        continue
+      id = message_key(message)
+      if (known and known(message)) or id in seen :
+        logging.info('Buffered message already known')
+        continue
+      seen.add(id)
+      if message_outdated(message, since) :
+        logging.debug('Buffered message outdated')
+        continue
+      count += 1
+      yield message
+
+  def clear(self) :
+    """Forgets the messages that were read"""
+    del self.texts[:self.count]
+    self.count = 0
 
 
 class MailboxSource(MailSource) :
   """A class that retrieves messages from a mailbox file.
   
   The type of the mailbox file needs to be specified as a mailbox class.
+
+  Messages are read lazily, newest first. Message boundaries in mbox files 
+  are found by scanning backwards from the end of the (memory-mapped) file.
+  With a SyncState, the offsets of the messages are cached, together with
+  the size and modification time of the file, so that the next run only 
+  scans the part that was appended. Maildir messages are read in order 
+  of modification time. With a SyncState, the names of the Maildir 
+  messages that were seen are cached, together with the modification times
+  of the new and cur directories: if neither directory changed, the 
+  Maildir is not even listed, and otherwise only the messages that were 
+  not seen before are read. Only the header of a message is parsed to check 
+  whether it is known or outdated; the rest is only parsed if it is needed.
   """
   
-  def __init__(self, filename, type) :
+  def __init__(self, filename, type, state=None) :
     logging.info('Initializing mailbox source (file=' + filename + ',type=' + type.__name__ + ')')
     self.type = type
     self.filename = filename
+    self.state = state
+    self.key = 'file://' + os.path.abspath(filename)
     
-  def messages(self) :
+  def messages(self, known=None, since=None, limit=0) :
     logging.info('Reading mails from ' + self.filename) 
     if self.type == mailbox.Maildir:
-      file = self.filename
-    else:
-      file = open(self.filename,'r')
-    mbox = self.type(file, email.message_from_file)
-    mails = []
-    mail = mbox.next()
-    while mail != None :
-      mails.append(mail)
-      mail = mbox.next()
-    mails.reverse()
-    return mails
+      texts = self.maildir_texts()
+    else :
+      texts = self.mbox_texts()
+    count = 0
+    for text in self.stats.iterate('fetch', texts) :
+      if limit > 0 and count >= limit :
+        break
+      with self.stats.timer('probe') :
+        header = message_header(text)
+        if known and known(header) :
+          logging.info('Message already known')
+          break
+        if message_outdated(header, since) :
+          logging.debug('Skipping outdated message')
+          continue
+      with self.stats.timer('parse', bytes=len(text)) :
+        message = parse_message(text)
+      if message :
+        count += 1
+        yield message
+      else :
+        logging.warning('Unable to parse message:\n' + text.decode('ascii', 'replace'))
+
+  def mbox_texts(self) :
+    if not os.path.getsize(self.filename) :
+      return
+    file = open(self.filename, 'rb')
+    try :
+      data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally :
+      file.close()
+    try :
+      if self.state :
+        (offsets, start) = self.mbox_index(data)
+        logging.debug('Skipping ' + str(start) + ' bytes')
+        offsets = reversed([offset for offset in offsets if offset >= start])
+      else :
+        offsets = mbox_offsets(data, 0, len(data))
+      end = len(data)
+      for offset in offsets :
+        # Skip the From_ line
+        yield data[data.find(b'\n', offset, end) + 1:end]
+        end = offset
+    finally :
+      data.close()
+
+  def mbox_index(self, data) :
+    """Returns the offsets of all the messages in an mbox file, and the offset
+    from which messages were added since the previous run"""
+    size = len(data)
+    mtime = repr(os.path.getmtime(self.filename))
+    cached_size = int(self.state.get(self.key, 'size', 0))
+    offsets = [int(offset) for offset in self.state.get(self.key, 'offsets', '').split()]
+    if cached_size == size and self.state.get(self.key, 'mtime') == mtime :
+      return (offsets, size)
+    # Only scan the appended part if the file still looks the same
+    if not (0 < cached_size < size and offsets and data[offsets[-1]:offsets[-1] + 5] == b'From ' and data[cached_size - 1:cached_size + 5] == b'\nFrom ') :
+      logging.debug('Rebuilding mailbox index')
+      cached_size = 0
+      offsets = []
+    tail = list(mbox_offsets(data, cached_size, size))
+    tail.reverse()
+    offsets += tail
+    self.state.set(self.key, 'size', size)
+    self.state.set(self.key, 'mtime', mtime)
+    self.state.set(self.key, 'offsets', ' '.join(map(str, offsets)))
+    return (offsets, cached_size)
+
+  def maildir_texts(self) :
+    if self.state :
+      mtimes = self.maildir_mtimes()
+      if all([mtime and self.state.get(self.key, directory + '_mtime') == mtime for (directory, mtime) in mtimes.items()]) :
+        logging.debug('Maildir unchanged')
+        return
+      for (directory, mtime) in mtimes.items() :
+        self.state.set(self.key, directory + '_mtime', mtime)
+    files = []
+    for directory in ('new', 'cur') :
+      path = os.path.join(self.filename, directory)
+      for name in os.listdir(path) :
+        if not name.startswith('.') :
+          files.append(os.path.join(path, name))
+    if self.state :
+      keys = dict([(os.path.basename(file).split(':')[0], file) for file in files])
+      seen = self.state.keys(self.key)
+      self.state.remove_keys(self.key, seen.difference(keys))
+      self.state.add_keys(self.key, keys)
+      files = [file for (key, file) in keys.items() if key not in seen]
+    mtimes = []
+    for file in files :
+      try :
+        mtimes.append((os.path.getmtime(file), file))
+      except OSError :
+        # The message was moved in the meantime
+        pass
+    mtimes.sort(reverse=True)
+    for (mtime, file) in mtimes :
+      try :
+        message_file = open(file, 'rb')
+      except IOError :
+        continue
+      try :
+        text = message_file.read()
+      finally :
+        message_file.close()
+      yield text
+
+  def maildir_mtimes(self) :
+    """Returns the modification times of the new and cur directories of the
+    Maildir, as they are cached in the state"""
+    now = time.time()
+    mtimes = {}
+    for directory in ('new', 'cur') :
+      mtime = os.stat(os.path.join(self.filename, directory)).st_mtime
+      # A message delivered in the same tick of the clock as the listing 
+      # would not change the time, so recent times are not trusted
+      mtimes[directory] = repr(mtime) if mtime < now - 2 else ''
+    return mtimes
 
 
 class POP3Source(MailSource) :
-  """A class that retrieves messages from a POP3 server."""
+  """A class that retrieves messages from a POP3 server.
+
+  Messages with a UIDL that was seen in a previous run are skipped. The 
+  headers of the other messages are first probed with TOP, and a message is
+  only retrieved if it is not known yet, and not outdated."""
   
-  def __init__(self, host, port, user, password, ssl=False) :
+  def __init__(self, host, port, user, password, ssl=False, state=None, connection=None) :
     logging.info('Initializing POP3 client')
+    self.state = state
+    self.key = 'pop://' + user + '@' + host + ':' + str(port or '')
+    self.pop = connection or POP3Source.connect(host, port, user, password, ssl)
+
+  @staticmethod
+  def connect(host, port, user, password, ssl=False) :
+    """Returns an authenticated POP3 connection"""
     if ssl :
       pop = poplib.POP3_SSL
     else :
       pop = poplib.POP3
     if port :
-      self.pop = pop(host,port)
+      connection = pop(host,port)
     else :
-      self.pop = pop(host)
+      connection = pop(host)
     logging.info('Authenticating')
-    self.pop.user(user)
-    self.pop.pass_(password)
+    connection.user(user)
+    connection.pass_(password)
+    return connection
 
-  def messages(self) :
-    logging.info('Retrieving POP3 list')
-    nb_messages = len(self.pop.list()[1])
+  def messages(self, known=None, since=None, limit=0) :
+    logging.info('Retrieving POP3 status')
+    nb_messages = self.pop.stat()[0]
     logging.debug(str(nb_messages) + ' messages waiting')
-    while nb_messages > 0 :
-      message_text = ''
-      for j in self.pop.retr(nb_messages)[1]:
-        message_text += j + '\n'
-      message = email.message_from_string(message_text)
+    numbers = list(range(1, nb_messages + 1))
+    if self.state :
+      # Skip the messages with a UIDL that was seen before
+      try :
+        uids = dict([line.decode('ascii').split(' ', 1) for line in self.pop.uidl()[1]])
+        seen = self.state.keys(self.key)
+        self.state.remove_keys(self.key, seen.difference(uids.values()))
+        self.state.add_keys(self.key, uids.values())
+        numbers = [number for number in numbers if uids[str(number)] not in seen]
+        logging.debug(str(len(numbers)) + ' new messages')
+      except poplib.error_proto :
+        logging.warning('Server does not support UIDL')
+    probe = known is not None or since is not None
+    count = 0
+    while numbers and (limit <= 0 or count < limit) :
+      nb_messages = numbers.pop()
+      if probe :
+        try :
+          with self.stats.timer('probe') :
+            header = parse_header(b'\n'.join(self.pop.top(nb_messages, 0)[1]))
+            if known and known(header) :
+              logging.info('Message ' + str(nb_messages) + ' already known')
+              break
+            if message_outdated(header, since) :
+              logging.debug('Message ' + str(nb_messages) + ' outdated')
+              continue
+        except poplib.error_proto :
+          logging.warning('Server does not support TOP')
+          probe = False
+      start = time.time()
+      message_text = b'\n'.join(self.pop.retr(nb_messages)[1]) + b'\n'
+      self.stats.add('fetch', time.time() - start, bytes=len(message_text))
+      with self.stats.timer('parse', bytes=len(message_text)) :
+        message = parse_message(message_text)
       if message :
+        count += 1
         yield message
       else :
-        logging.warn('Unable to parse message:\n' + message_text)
-      nb_messages -= 1
+        logging.warning('Unable to parse message:\n' + message_text.decode('ascii', 'replace'))
 
 
 class NNTPSource(MailSource) :
-  """A class that retrieves messages from an NNTP server."""
+  """A class that retrieves messages from an NNTP server.
+
+  The overview database (XOVER) is used to check whether articles are 
+  known or outdated, for a range of articles at a time. Only the new 
+  articles are retrieved, with a bounded number of ARTICLE commands in 
+  flight. At most the max_articles newest articles of the group are 
+  considered."""
+
+  OVERVIEW_BATCH_SIZE = 100
+  PIPELINE_SIZE = 4
 
-  def __init__(self, host, port, group, user, password) :
+  def __init__(self, host, port, group, user, password, state=None, max_articles=1000, connection=None) :
     logging.info('Initializing NNTP client')
+    self.state = state
+    self.key = 'news://' + host + ':' + str(port or '') + '/' + group
+    self.max_articles = max_articles
+    self.nntp = connection or NNTPSource.connect(host, port, user, password)
+    self.group = group
+
+  @staticmethod
+  def connect(host, port, user, password) :
+    """Returns an (authenticated) NNTP connection"""
     if port :
-      self.nntp = nntplib.NNTP(host,port,user=user,password=password)
+      return nntplib.NNTP(host,port,user=user,password=password)
     else :
-      self.nntp = nntplib.NNTP(host,user=user,password=password)
-    self.group = group
+      return nntplib.NNTP(host,user=user,password=password)
 
-  def messages(self) :
+  def messages(self, known=None, since=None, limit=0) :
     logging.info('Retrieving article list')
     result = self.nntp.group(self.group)
     first = int(result[2])
     last = int(result[3])
-    while last >= first :
-      logging.debug('Retrieving header of article ' + str(last))
+    if self.state :
+      # Only retrieve the articles after the last one seen
+      first = max(first, int(self.state.get(self.key, 'last', 0)) + 1)
+      self.state.set(self.key, 'last', max(last, first - 1))
+    if self.max_articles > 0 :
+      first = max(first, last - self.max_articles + 1)
+    remaining = limit if limit > 0 else -1
+    while last >= first and remaining :
+      start = max(first, last - self.OVERVIEW_BATCH_SIZE + 1)
+      numbers = []
+      found_known = False
       try :
-        head = string.join(self.nntp.head(str(last))[3],'\n')
-        message = email.message_from_string(head)
-        body = string.join(self.nntp.body(str(last))[3],'\n')
-        message = email.message_from_string(head + '\n' + body)
-        if message :
-          yield message
-        else :
-          logging.warn('Unable to parse message:\n' + head + '\n' + body)
-      except nntplib.NNTPTemporaryError :
-        pass
-      last -= 1
+        logging.debug('Retrieving overview of articles ' + str(start) + '-' + str(last))
+        with self.stats.timer('probe') :
+          overview = self.nntp.xover(str(start), str(last))[1]
+          overview.sort(key=lambda x : -int(x[0]))
+          for item in overview :
+            if isinstance(item[1], dict) :
+              # Python 3 returns the fields by name
+              (number, fields) = item
+              header = overview_message(fields.get('from'), fields.get('subject'), fields.get('date'), fields.get('message-id'))
+            else :
+              (number, subject, poster, date, id) = item[:5]
+              header = overview_message(poster, subject, date, id)
+            if known and known(header) :
+              logging.info('Article ' + str(number) + ' already known')
+              found_known = True
+              break
+            if message_outdated(header, since) :
+              logging.debug('Article ' + str(number) + ' outdated')
+              continue
+            numbers.append(int(number))
+      except nntplib.NNTPPermanentError :
+        logging.debug('Overview not available')
+        numbers = list(range(last, start - 1, -1))
+      if remaining > 0 :
+        numbers = numbers[:remaining]
+      for message in self.articles(numbers) :
+        remaining -= 1
+        yield message
+      if found_known :
+        break
+      last = start - 1
 
+  def articles(self, numbers) :
+    """Retrieves a list of articles.
+    
+    A batch of ARTICLE commands is sent before the responses are read."""
+    # Python 3 made the low-level commands private
+    putcmd = getattr(self.nntp, 'putcmd', None) or self.nntp._putcmd
+    getlongresp = getattr(self.nntp, 'getlongresp', None) or self.nntp._getlongresp
+    for i in range(0, len(numbers), self.PIPELINE_SIZE) :
+      batch = numbers[i:i + self.PIPELINE_SIZE]
+      logging.debug('Retrieving articles ' + ','.join(map(str, batch)))
+      for number in batch :
+        putcmd('ARTICLE ' + str(number))
+      # Read all responses before yielding, so that the connection is in a 
+      # consistent state when the caller stops
+      messages = []
+      start = time.time()
+      for number in batch :
+        try :
+          text = b'\n'.join(getlongresp()[1])
+          self.stats.add('fetch', time.time() - start, bytes=len(text))
+          with self.stats.timer('parse', bytes=len(text)) :
+            message = parse_message(text)
+          if message :
+            messages.append(message)
+          else :
+            logging.warning('Unable to parse message:\n' + text.decode('ascii', 'replace'))
+        except nntplib.NNTPTemporaryError :
+          logging.debug('Article ' + str(number) + ' not available')
+        start = time.time()
+      for message in messages :
+        yield message
 
-class IMAPSource(MailSource) :
-  """A class that retrieves messages from an IMAP server."""
 
-  def __init__(self, host, port, user, password, mailbox, ssl=False) :
+class IMAPSource(MailSource) :
+  """A class that retrieves messages from one or more IMAP mailboxes.
+
+  The mailboxes are given as a list of names, which may contain the '*' and
+  '%' wildcards of the LIST command. All mailboxes are read over the same
+  connection, and the commands for the different mailboxes are pipelined.
+  With a synchronization state, STATUS is used to skip the mailboxes that
+  did not receive any messages since the previous run.
+
+  The server only searches for messages that arrived in the requested time
+  window. The headers needed to check whether a message is known are
+  fetched first, for a batch of messages of every mailbox at a time. The
+  new messages of all mailboxes are merged, newest first, and messages
+  that are in more than one mailbox are only retrieved once. Only the
+  bodies of new messages are fetched, again in batches, and optionally
+  only up to a maximum size. Mailboxes are opened with EXAMINE, and all
+  fetches use BODY.PEEK, so messages are not marked as seen.
+
+  Pipelining and IDLE use internal methods of imaplib (tested with Python 
+  2.7 and 3.6 to 3.13). Without them, the commands are sent one at a time,
+  and new messages are checked for with NOOP."""
+
+  # The internal methods of imaplib needed for pipelining and IDLE
+  INTERNALS = all([hasattr(imaplib.IMAP4, name) for name in ('_command', '_command_complete', '_untagged_response', '_new_tag', '_get_response')])
+  HEADER_FIELDS = 'FROM SUBJECT DATE MESSAGE-ID'
+  HEADER_BATCH_SIZE = 100
+  BODY_BATCH_SIZE = 10
+  # RFC 2177 asks clients to renew IDLE at least every 29 minutes
+  IDLE_TIMEOUT = 29 * 60
+
+  def __init__(self, host, port, user, password, mailbox=None, ssl=False, state=None, max_size=0, connection=None) :
     logging.info('Initializing IMAP client')
+    self.state = state
+    self.max_size = max_size
+    # The key of the state of every mailbox is this key followed by its name
+    self.key = 'imap://' + user + '@' + host + ':' + str(port or '') + '/'
+    self.imap = connection or IMAPSource.connect(host, port, user, password, ssl)
+    self.selected = None
+    if not mailbox :
+      mailbox = ['INBOX']
+    elif not isinstance(mailbox, list) :
+      mailbox = [mailbox]
+    self.mailboxes = self.list(mailbox)
+
+  @staticmethod
+  def connect(host, port, user, password, ssl=False) :
+    """Returns an authenticated IMAP connection"""
     if ssl :
       imap = imaplib.IMAP4_SSL
     else :
       imap = imaplib.IMAP4
     if port :
-      self.imap = imap(host,port)
+      connection = imap(host,port)
     else :
-      self.imap = imap(host)
+      connection = imap(host)
     logging.info('Authenticating')
-    self.imap.login(user,password)
-    if mailbox :
-      logging.info('Opening mailbox \'' + mailbox + '\'')
-      self.imap.select(mailbox=mailbox)
+    connection.login(user,password)
+    return connection
+
+  def list(self, patterns) :
+    """Returns the names of the mailboxes that match a list of names and
+    patterns"""
+    names = []
+    for pattern in patterns :
+      if '*' in pattern or '%' in pattern :
+        logging.info('Listing mailboxes matching \'' + pattern + '\'')
+        typ, data = self.imap.list('""', imap_quote(pattern))
+        matches = []
+        for item in data :
+          if not item :
+            continue
+          # The name may be sent as a literal
+          m = re.match(br'\(([^)]*)\) (?:"(?:[^"\\]|\\.)*"|NIL) ?(.*)$', item[0] if isinstance(item, tuple) else item)
+          if not m or b'\\noselect' in m.group(1).lower() :
+            continue
+          name = item[1] if isinstance(item, tuple) else imap_unquote(m.group(2))
+          if not isinstance(name, str) :
+            name = name.decode('ascii', 'replace')
+          matches.append(name)
+        if not matches :
+          logging.warning('No mailboxes match \'' + pattern + '\'')
+      else :
+        matches = [pattern]
+      names += [name for name in matches if name not in names]
+    return names
+
+  def pipeline(self, commands) :
+    """Sends a list of commands at once, and then reads all their responses.
+
+    A command is a tuple with the mailbox it applies to (or None), the name
+    of the command (e.g. 'STATUS' or 'UID FETCH'), and its arguments.
+    Mailboxes are opened (read-only) where needed. Returns the untagged
+    response data of every command, or None for the commands that failed."""
+    if not self.INTERNALS :
+      return [self.run(*command) for command in commands]
+    sent = []
+    for command in commands :
+      (mailbox, words, args) = (command[0], command[1].split(), list(command[2:]))
+      if mailbox is not None and mailbox != self.selected :
+        logging.debug('Opening mailbox \'' + mailbox + '\'')
+        sent.append((self.imap._command('EXAMINE', imap_quote(mailbox)), 'EXAMINE', None, mailbox))
+        self.selected = mailbox
+        # Let imaplib accept the commands that follow, before the mailbox
+        # is actually open
+        self.imap.state = 'SELECTED'
+        self.imap.is_readonly = True
+      sent.append((self.imap._command(*(words + args)), words[0], words[-1], mailbox))
+
+    results = []
+    failed = set()
+    for (tag, name, response, mailbox) in sent :
+      try :
+        typ, data = self.imap._command_complete(name, tag)
+      except self.imap.abort :
+        raise
+      except self.imap.error as e :
+        typ, data = 'BAD', [str(e)]
+      if response is None :
+        # Forget the responses to EXAMINE, like imaplib does for SELECT
+        self.imap.untagged_responses = {}
+        if typ == 'OK' :
+          failed.discard(mailbox)
+        else :
+          logging.warning('Unable to open mailbox \'' + mailbox + '\'')
+          failed.add(mailbox)
+          if self.selected == mailbox :
+            self.selected = None
+            self.imap.state = 'AUTH'
+      elif typ == 'OK' and mailbox not in failed :
+        results.append(self.imap._untagged_response(typ, data, response)[1])
+      else :
+        logging.debug('IMAP ' + name + ' command failed: ' + str(data))
+        self.imap.untagged_responses.pop(response, None)
+        results.append(None)
+    return results
+
+  def run(self, mailbox, command, *args) :
+    """Sends a single command of pipeline(), with the public methods of 
+    imaplib, and returns its untagged response data, or None if it 
+    failed"""
+    words = command.split()
+    if mailbox is not None and mailbox != self.selected :
+      logging.debug('Opening mailbox \'' + mailbox + '\'')
+      try :
+        typ, data = self.imap.select(imap_quote(mailbox), readonly=True)
+      except self.imap.abort :
+        raise
+      except self.imap.error :
+        typ = 'BAD'
+      if typ != 'OK' :
+        logging.warning('Unable to open mailbox \'' + mailbox + '\'')
+        self.selected = None
+        return None
+      self.selected = mailbox
+    try :
+      if words[0] == 'UID' :
+        typ, data = self.imap.uid(words[1], *args)
+      else :
+        typ, data = getattr(self.imap, words[0].lower())(*args)
+    except self.imap.abort :
+      raise
+    except self.imap.error as e :
+      typ, data = 'BAD', [str(e)]
+    if typ != 'OK' :
+      logging.debug('IMAP ' + words[0] + ' command failed: ' + str(data))
+      return None
+    return data
+
+  def wait(self, timeout, delay=0) :
+    """Waits at most timeout seconds for new messages, and returns whether
+    they (may) have arrived.
+
+    If a single mailbox is read and the server supports it, IDLE is used,
+    and the method returns as soon as the server announces new messages, 
+    after waiting delay seconds for more messages to arrive. Otherwise, the
+    mailbox is checked with NOOP at the end of the timeout. Several 
+    mailboxes are always assumed to have changed, since messages() only 
+    opens the ones that did."""
+    if len(self.mailboxes) != 1 :
+      time.sleep(timeout)
+      return True
+    if self.selected != self.mailboxes[0] :
+      self.pipeline([(self.mailboxes[0], 'NOOP')])
+      if self.selected is None :
+        raise self.imap.error('Unable to open mailbox \'' + self.mailboxes[0] + '\'')
+    self.imap.untagged_responses.pop('EXISTS', None)
+    if 'IDLE' in self.imap.capabilities and self.INTERNALS :
+      return self.idle(min(timeout, self.IDLE_TIMEOUT), delay)
+    time.sleep(timeout)
+    self.imap.noop()
+    return self.imap.untagged_responses.pop('EXISTS', None) is not None
+
+  def idle(self, timeout, delay=0) :
+    """Waits with IDLE until the server announces new messages (and delay
+    more seconds), or until a timeout. Returns whether new messages were 
+    announced."""
+    logging.debug('Waiting for new messages')
+    tag = self.imap._new_tag()
+    self.imap.send(tag + b' IDLE\r\n')
+    while self.imap._get_response() is not None :
+      if self.imap.tagged_commands[tag] is not None :
+        raise self.imap.error('IDLE failed: ' + str(self.imap.tagged_commands.pop(tag)))
+    deadline = time.time() + timeout
+    arrived = False
+    while True :
+      if not arrived and 'EXISTS' in self.imap.untagged_responses :
+        logging.info('New messages arrived')
+        arrived = True
+        deadline = min(deadline, time.time() + delay)
+      remaining = deadline - time.time()
+      if remaining <= 0 or not self.readable(remaining) :
+        break
+      self.imap._get_response()
+    self.imap.send(b'DONE\r\n')
+    self.imap._command_complete('IDLE', tag)
+    return self.imap.untagged_responses.pop('EXISTS', None) is not None
+
+  def readable(self, timeout) :
+    """Waits at most timeout seconds until the server sent data"""
+    for connection in (self.imap.sock, getattr(self.imap, 'sslobj', None)) :
+      # Data that was already decrypted is not seen by select()
+      if hasattr(connection, 'pending') and connection.pending() :
+        return True
+    return bool(select.select([self.imap.sock], [], [], timeout)[0])
+
+  def order(self, mailboxes) :
+    """Puts the open mailbox first in a list, so it is not opened twice"""
+    return sorted(mailboxes, key=lambda name : name != self.selected)
+
+  def changed(self) :
+    """Returns the mailboxes that received messages since the previous run,
+    together with the first UID to retrieve, and updates the state"""
+    result = []
+    statuses = self.pipeline([(None, 'STATUS', imap_quote(name), '(UIDNEXT UIDVALIDITY)') for name in self.mailboxes])
+    for (name, status) in zip(self.mailboxes, statuses) :
+      status = b' '.join([b' '.join(item) if isinstance(item, tuple) else item for item in status or [] if item])
+      uidnext = re.search(br'UIDNEXT (\d+)', status)
+      uidvalidity = re.search(br'UIDVALIDITY (\d+)', status)
+      if not uidnext or not uidvalidity :
+        logging.warning('Unable to get the status of mailbox \'' + name + '\'')
+        continue
+      (uidnext, uidvalidity) = (int(uidnext.group(1)), uidvalidity.group(1).decode('ascii'))
+      # Only retrieve the messages after the last one seen, unless the UIDs
+      # of the mailbox were reset
+      key = self.key + name
+      first_uid = 1
+      if self.state.get(key, 'uidvalidity') == uidvalidity :
+        first_uid = int(self.state.get(key, 'uidnext', 1))
+      else :
+        self.state.reset(key)
+      self.state.set(key, 'uidvalidity', uidvalidity)
+      self.state.set(key, 'uidnext', uidnext)
+      if first_uid >= uidnext :
+        logging.debug('No new messages in mailbox \'' + name + '\'')
+        continue
+      result.append((name, first_uid))
+    return result
+
+  def messages(self, known=None, since=None, limit=0) :
+    if self.state :
+      logging.info('Checking the status of ' + str(len(self.mailboxes)) + ' mailboxes')
+      with self.stats.timer('probe') :
+        mailboxes = self.changed()
     else :
-      logging.info('Opening INBOX')
-      self.imap.select()
+      mailboxes = [(name, 1) for name in self.mailboxes]
+    if not mailboxes :
+      return
 
-  def messages(self) :
     logging.info('Retrieving relevant message numbers')
-    _, msgnums =  self.imap.search(None,'ALL')
-    msg_numbers = msgnums[0].split()
-    while msg_numbers :
-      msg_number = msg_numbers.pop()
-      logging.info('Fetching article ' + msg_number)
-      typ, data = self.imap.fetch(msg_number, '(RFC822)')
-      message = email.message_from_string(data[0][1])
-      if message :
-        yield message
+    criteria = []
+    if since :
+      # SINCE only compares dates (in an unknown timezone), so search from
+      # the day before. The Date headers are checked afterwards.
+      criteria = ['SINCE', imap_date(since - datetime.timedelta(days=1))]
+    with self.stats.timer('probe') :
+      results = self.pipeline([(name, 'UID SEARCH', 'UID', str(first_uid) + ':*') + tuple(criteria) for (name, first_uid) in mailboxes])
+    pending = {}
+    for ((name, first_uid), data) in zip(mailboxes, results) :
+      uids = sorted([int(uid) for item in data or [] if item for uid in item.split() if int(uid) >= first_uid])
+      if uids :
+        pending[name] = uids
+        if self.state and int(self.state.get(self.key + name, 'uidnext', 1)) <= uids[-1] :
+          self.state.set(self.key + name, 'uidnext', uids[-1] + 1)
+    names = [name for (name, first_uid) in mailboxes]
+
+    remaining = limit if limit > 0 else -1
+    seen = set()
+    while pending and remaining :
+      # Check the headers of the next batch of messages of every mailbox
+      batches = {}
+      for name in pending :
+        batches[name] = pending[name][-self.HEADER_BATCH_SIZE:]
+        del pending[name][-self.HEADER_BATCH_SIZE:]
+      for name in batches :
+        if not pending[name] :
+          del pending[name]
+      batch_names = self.order([name for name in names if name in batches])
+      count = sum(map(len, batches.values()))
+      logging.info('Fetching headers of ' + str(count) + ' messages')
+      with self.stats.timer('probe', count=count) :
+        results = self.pipeline([(name, 'UID FETCH', uid_set(batches[name]), '(UID BODY.PEEK[HEADER.FIELDS (' + self.HEADER_FIELDS + ')])') for name in batch_names])
+        candidates = []
+        for (name, data) in zip(batch_names, results) :
+          headers = imap_literals(data or [])
+          new_messages = []
+          for uid in reversed(batches[name]) :
+            if len(new_messages) == remaining :
+              # Older messages of this mailbox would not fit anymore
+              pending.pop(name, None)
+              break
+            if uid not in headers :
+              new_messages.append((0, len(new_messages), name, uid, None))
+              continue
+            header = parse_header(headers[uid])
+            if known and known(header) :
+              logging.info('Message ' + str(uid) + ' of \'' + name + '\' already known')
+              pending.pop(name, None)
+              break
+            if message_outdated(header, since) :
+              logging.debug('Message ' + str(uid) + ' of \'' + name + '\' outdated')
+              continue
+            date = calendar.timegm(message_date(header).utctimetuple())
+            new_messages.append((-date, len(new_messages), name, uid, message_key(header)))
+          new_messages.sort()
+          candidates.append(new_messages)
+
+        # Merge the new messages of all mailboxes, newest first
+        new_uids = []
+        for (_, _, name, uid, id) in heapq.merge(*candidates) :
+          if not remaining :
+            break
+          if id is not None :
+            if id in seen :
+              logging.debug('Message ' + str(uid) + ' of \'' + name + '\' already retrieved from another mailbox')
+              continue
+            seen.add(id)
+          new_uids.append((name, uid))
+          remaining -= 1
+
+      # Fetch the new messages
+      if self.max_size > 0 :
+        body = 'BODY.PEEK[]<0.' + str(self.max_size) + '>'
       else :
-        logging.warn('Unable to parse message:\n' + data[0][1])
-      
+        body = 'BODY.PEEK[]'
+      for i in range(0, len(new_uids), self.BODY_BATCH_SIZE) :
+        chunk = new_uids[i:i + self.BODY_BATCH_SIZE]
+        chunk_names = self.order([name for name in names if name in set([n for (n, uid) in chunk])])
+        logging.info('Fetching ' + str(len(chunk)) + ' messages')
+        start = time.time()
+        results = self.pipeline([(name, 'UID FETCH', uid_set([uid for (n, uid) in chunk if n == name]), '(UID ' + body + ')') for name in chunk_names])
+        bodies = {}
+        for (name, data) in zip(chunk_names, results) :
+          for (uid, text) in imap_literals(data or []).items() :
+            bodies[(name, uid)] = text
+        self.stats.add('fetch', time.time() - start, len(bodies), sum(map(len, bodies.values())))
+        for (name, uid) in chunk :
+          if (name, uid) not in bodies :
+            logging.warning('Unable to fetch message ' + str(uid) + ' of \'' + name + '\'')
+            continue
+          with self.stats.timer('parse', bytes=len(bodies[(name, uid)])) :
+            message = parse_message(bodies[(name, uid)])
+          if message :
+            yield message
+          else :
+            logging.warning('Unable to parse message:\n' + bodies[(name, uid)].decode('ascii', 'replace'))
+
+class MergedSource(MailSource) :
+  """A class that retrieves the messages of several sources at once.
+
+  Every source is read by a thread of its own, which hands its messages to
+  the merge through a small queue, so the retrieval takes as long as the 
+  slowest source rather than all of them together. The newest message of
+  all sources comes first, and messages that are in more than one source
+  (by their message id) are only returned once. Every source stops on its
+  own at the first message that is known, or when the merge is stopped. 
+  The merge only ends when all threads did, so the sources (and their 
+  connections) are not used anymore afterwards."""
+
+  QUEUE_SIZE = 10
+
+  def __init__(self, sources) :
+    self.sources = sources
+
+  def messages(self, known=None, since=None, limit=0) :
+    stop = threading.Event()
+    queues = []
+    threads = []
+    for source in self.sources :
+      messages = queue.Queue(self.QUEUE_SIZE)
+      thread = threading.Thread(target=self.read, args=(source, messages, stop, known, since, limit), name=threading.current_thread().name + '/' + str(source.key or len(queues)))
+      thread.daemon = True
+      thread.start()
+      queues.append(messages)
+      threads.append(thread)
+    try :
+      # Keep the next message of every source in a heap, newest first
+      heads = []
+      for index in range(len(queues)) :
+        self.next(heads, queues, index)
+      seen = set()
+      remaining = limit if limit > 0 else -1
+      while heads and remaining :
+        (_, index, message) = heapq.heappop(heads)
+        self.next(heads, queues, index)
+        id = message_key(message)
+        if id in seen :
+          logging.debug('Message already retrieved from another source')
+          continue
+        seen.add(id)
+        remaining -= 1
+        yield message
+    finally :
+      stop.set()
+      # Empty the queues, so no thread is blocked, until all threads ended
+      for (thread, messages) in zip(threads, queues) :
+        while thread.is_alive() :
+          try :
+            while True :
+              messages.get_nowait()
+          except queue.Empty :
+            pass
+          thread.join(0.1)
+
+  def next(self, heads, queues, index) :
+    """Adds the next message of a source to the heap of newest messages"""
+    item = queues[index].get()
+    if isinstance(item, Exception) :
+      raise item
+    if item is not None :
+      date = calendar.timegm(message_date(item).utctimetuple())
+      heapq.heappush(heads, (-date, index, item))
+
+  def read(self, source, messages, stop, known, since, limit) :
+    """Puts the messages of a source in a queue, followed by None (or by 
+    the error that stopped the retrieval)"""
+    item = None
+    try :
+      generator = iter(source.messages(known=known, since=since, limit=limit))
+      try :
+        # Only ask for the next message while the merge is running
+        while not stop.is_set() :
+          message = next(generator, None)
+          if message is None :
+            break
+          if known and known(message) :
+            logging.info('Message already in feed. Stopped retrieving.')
+            break
+          while not stop.is_set() :
+            try :
+              messages.put(message, timeout=1)
+              break
+            except queue.Full :
+              pass
+      finally :
+        if hasattr(generator, 'close') :
+          generator.close()
+    except Exception as e :
+      item = e
+    messages.put(item)
 
 ################################################################################
-# Main program
+# Feed updates
 ################################################################################
 
-if __name__ == "__main__" :
-  # Parse the arguments
+NETWORK_MODES = ('pop3','pop3-ssl','imap','imap-ssl','nntp')
+# The keys of the rules in a routing configuration file
+ROUTE_RULES = ('list-id', 'to', 'subject')
+# The options that describe the message source, rather than the feed
+SOURCE_OPTIONS = ('mode', 'file', 'max-size', 'state', 'host', 'port', 'user', 'password', 'mailbox', 'group', 'max-articles', 'spool', 'flush')
+
+def create_parser() :
+  """Returns the parser for the command line options"""
   parser = optparse.OptionParser(usage=PROGRAM_USAGESTRING, version=PROGRAM_VERSIONSTRING)
   parser.add_option('-q','--quiet', help='Turn off logging', action='store_const', dest='loglevel', const=logging.ERROR, default=logging.WARNING)
   parser.add_option('-v','--verbose', help='Turn on verbose logging', action='store_const', dest='loglevel', const=logging.INFO)
@@ -531,14 +2380,1158 @@ if __name__ == "__main__" :
   parser.add_option('-t', '--title', metavar='TITLE', help='The title of the target feed', default='AtoMail feed')
   parser.add_option('', '--max-items', metavar='ITEMS', help='The maximum number of items in the feed. Default: %default', type='int', default=10)
   parser.add_option('', '--max-time', metavar='MINUTES', help='The maximum number of elapsed minutes for items in the feed', type='int', default=-1)
+  parser.add_option('', '--archive-size', metavar='ITEMS', help='Move items that no longer fit in the feed to archive feeds of ITEMS items each, next to the feed file', type='int', default=0)
+  parser.add_option('', '--precompress', action='store_true', default=False, help='Save gzip (and, if available, brotli) compressed copies of the feed next to it')
+  parser.add_option('', '--validators', action='store_true', default=False, help='Save the ETag and Last-Modified HTTP headers of the feed in a .headers file next to it')
+  parser.add_option('', '--max-content-size', metavar='BYTES', help='The maximum number of bytes of the message body to put in the feed', type='int', default=0)
+  parser.add_option('', '--blob-dir', metavar='DIRECTORY', help='Store attachments and inline parts of messages as files in DIRECTORY, and refer to them from the feed')
+  parser.add_option('', '--blob-uri', metavar='URI', help='The URI under which the blob directory is published')
+  parser.add_option('', '--blob-threshold', metavar='CHARACTERS', help='Store message bodies larger than this in the blob directory as well', type='int', default=0)
   parser.add_option('-s', '--strip-subject', action='store_true', dest='strip_subject', default=False, help='Strip mailing-list headers from the subject')
   parser.add_option('-f','--file', metavar='FILE', help='The file or directory to read messages from (mbox,maildir)')
+  parser.add_option('','--backfill', action='store_true', default=False, help='Add all the messages of the mailbox to the feed (e.g. to import an archive), parsing them in a pool of processes (mbox)')
+  parser.add_option('','--processes', metavar='PROCESSES', type='int', default=0, help='The number of processes used by --backfill. Default: the number of CPUs')
+  parser.add_option('','--max-size', metavar='BYTES', type='int', default=0, help='The maximum number of bytes to retrieve of every message (imap,imap-ssl)')
+  parser.add_option('','--state', metavar='FILE', help='Keep the synchronization state of the message source in FILE, and only retrieve messages that arrived since the previous run (mbox,maildir,pop3,pop3-ssl,imap,imap-ssl,nntp)')
   parser.add_option('','--host', metavar='HOST', help='The host to receive messages from (pop3,pop3-ssl,imap,imap-ssl,nntp)')
   parser.add_option('','--port', metavar='PORT', type='int', help='The host port to receive messages from (pop3,pop3-ssl,imap,imap-ssl,nntp)')
   parser.add_option('','--user', metavar='USERNAME', help='The user to authenticate with (pop3,pop3-ssl,imap,imap-ssl,nntp)')
   parser.add_option('','--password', metavar='PASSWORD', help='The password to authenticate with (pop3,pop3-ssl,imap,imap-ssl,nntp)')
-  #parser.add_option('','--mailbox', metavar='PASSWORD', help='The IMAP mailbox to open (imap)')
+  parser.add_option('','--mailbox', metavar='MAILBOXES', help='A comma-separated list of IMAP mailboxes to read, which may contain the * and % wildcards (imap,imap-ssl). Default: INBOX')
   parser.add_option('','--group', metavar='GROUP', help='The group from which to retrieve messages (nntp)')
+  parser.add_option('','--max-articles', metavar='ARTICLES', type='int', default=1000, help='The maximum number of most recent articles of the group to consider (nntp). Default: %default')
+  parser.add_option('','--spool', metavar='DIRECTORY', help='Store incoming messages in DIRECTORY, and add all stored messages to the feed at once (pipe), or until they are added to their feeds (listen; default: SOCKET.spool)')
+  parser.add_option('','--flush', action='store_true', default=False, help='Only add the stored messages to the feed, without reading a message from stdin (pipe)')
+  parser.add_option('','--stats', metavar='FILE', help='Save the timings and counters of the update in FILE, as JSON')
+  parser.add_option('','--prometheus', metavar='FILE', help='Save the timings and counters of the update in FILE, for the Prometheus textfile collector')
+  parser.add_option('','--profile', metavar='FILE', help='Save a (cProfile) profile of the update in FILE (not in daemon mode)')
+  parser.add_option('','--sources', metavar='FILE', help='Retrieve the messages from all the sources in configuration FILE at the same time, instead of from a single source')
+  parser.add_option('','--routes', metavar='FILE', help='Add the messages of the source to the feeds in routing configuration FILE that they match, instead of to a single feed')
+  parser.add_option('','--config', metavar='FILE', help='Run as a daemon, updating all the feeds in configuration FILE')
+  parser.add_option('','--idle', action='store_true', default=False, help='Keep the connection open, and update the feed as soon as new messages arrive, using IDLE (imap,imap-ssl)')
+  parser.add_option('','--debounce', metavar='SECONDS', type='int', default=2, help='The number of seconds to wait for more messages after a new message arrived, before updating the feed (idle,listen). Default: %default')
+  parser.add_option('','--interval', metavar='SECONDS', type='int', default=300, help='The number of seconds between updates of a feed (daemon), or the maximum number of seconds between checks for new messages (idle). Default: %default')
+  parser.add_option('','--listen', metavar='SOCKET', help='Run as a delivery daemon, adding the messages that atomail-deliver.py sends to unix domain socket SOCKET to their feeds')
+  parser.add_option('','--workers', metavar='THREADS', type='int', default=4, help='The number of feeds updated at the same time (daemon). Default: %default')
+  parser.add_option('','--max-connections', metavar='CONNECTIONS', type='int', default=2, help='The maximum number of connections to the same host (daemon). Default: %default')
+  return parser
+
+def check_options(options) :
+  """Returns an error message if options needed for the mode are missing"""
+  if options.mode in NETWORK_MODES and not options.host :
+    return 'Host missing'
+  if options.mode in ('pop3','pop3-ssl','imap','imap-ssl') and not options.user :
+    return 'Username missing'
+  if options.mode in ('pop3','pop3-ssl','imap','imap-ssl') and not options.password :
+    return 'Password missing'
+  if options.mode in ('mbox','maildir') and not options.file :
+    return 'Mailbox file or directory missing'
+  if options.mode == 'nntp' and not options.group :
+    return 'Group missing'
+  if options.mode == 'nntp' and not nntplib :
+    return 'NNTP is not supported by this version of Python'
+  if options.backfill and options.mode != 'mbox' :
+    return 'Backfilling is only supported for mbox files'
+  if options.idle and options.mode not in ('imap','imap-ssl') :
+    return 'IDLE is only supported by IMAP'
+  if options.routes and (options.backfill or options.idle or options.spool) :
+    return 'Routing is not supported with backfilling, IDLE, or spooling'
+  if options.sources and (options.mode != 'pipe' or options.backfill or options.idle or options.spool) :
+    return 'Sources cannot be combined with a mode, backfilling, IDLE, or spooling'
+  if options.flush and not options.spool :
+    return 'Spool directory missing'
+  if options.blob_dir and not options.blob_uri :
+    return 'Blob URI missing'
+  return None
+
+def create_feed(filename, options, stats=None) :
+  """Creates the feed from the options"""
+  uri = options.uri
+  if not uri :
+    logging.warning('Feed URI missing. Using default URI.')
+    uri = 'http://example.com/' + os.path.basename(filename)
+  blobs = None
+  if options.blob_dir :
+    blobs = BlobStore(options.blob_dir, options.blob_uri)
+  return MessageFeed(filename = filename, uri = uri, title = options.title, max_items = options.max_items, max_time = options.max_time, strip_subject = options.strip_subject, max_content_size = options.max_content_size, blobs = blobs, blob_threshold = options.blob_threshold, archive_size = options.archive_size, precompress = options.precompress, validators = options.validators, stats = stats)
+
+def connect(options) :
+  """Opens an authenticated connection to the server of a network mode"""
+  if options.mode in ('pop3', 'pop3-ssl') :
+    return POP3Source.connect(options.host, options.port, options.user, options.password, ssl=(options.mode == 'pop3-ssl'))
+  elif options.mode in ('imap', 'imap-ssl') :
+    return IMAPSource.connect(options.host, options.port, options.user, options.password, ssl=(options.mode == 'imap-ssl'))
+  else :
+    return NNTPSource.connect(options.host, options.port, options.user, options.password)
+
+def create_source(options, state=None, connection=None, stats=None) :
+  """Creates the message source from the options.
+
+  For network modes, an existing connection to the server can be passed."""
+  stats = stats or NO_STATS
+  if options.sources :
+    return MergedSource(create_sources(options.sources, state, stats))
+  logging.info('Initializing the message source')
+  mailboxes = None
+  if options.mailbox :
+    mailboxes = [name.strip() for name in options.mailbox.split(',')]
+  with stats.timer('connect') :
+    if options.mode == "mbox" :
+      source = MailboxSource(options.file, mailbox.mbox, state=state)
+    elif options.mode == "maildir" :
+      source = MailboxSource(options.file, mailbox.Maildir, state=state)
+    elif options.mode == "pop3" : 
+      source = POP3Source(options.host, options.port, options.user, options.password, state=state, connection=connection)
+    elif options.mode == "pop3-ssl" : 
+      source = POP3Source(options.host, options.port, options.user, options.password, ssl=True, state=state, connection=connection)
+    elif options.mode == "imap" : 
+      source = IMAPSource(options.host, options.port, options.user, options.password, mailboxes, state=state, max_size=options.max_size, connection=connection)
+    elif options.mode == "imap-ssl" : 
+      source = IMAPSource(options.host, options.port, options.user, options.password, mailboxes, ssl=True, state=state, max_size=options.max_size, connection=connection)
+    elif options.mode == "nntp" : 
+      source = NNTPSource(options.host, options.port, options.group, options.user, options.password, state=state, max_articles=options.max_articles, connection=connection)
+    else :
+      source = PipeSource()
+  source.stats = stats
+  return source
+
+def create_sources(sources, state=None, stats=None) :
+  """Creates the message sources from a list of options (see 
+  read_sources()). The sources connect to their servers at the same time."""
+  results = [None] * len(sources)
+  def create(index) :
+    try :
+      results[index] = create_source(sources[index], state, stats=stats)
+    except Exception as e :
+      results[index] = e
+  threads = [threading.Thread(target=create, args=(index,)) for index in range(len(sources))]
+  for thread in threads :
+    thread.start()
+  for thread in threads :
+    thread.join()
+  for result in results :
+    if isinstance(result, Exception) :
+      raise result
+  return results
+
+def write_stats(stats, filename, options) :
+  """Saves the statistics of an update of a feed, in the files given by the
+  options"""
+  if options.stats :
+    logging.info('Writing statistics to ' + options.stats)
+    stats.write_json(options.stats, filename)
+  if options.prometheus :
+    logging.info('Writing statistics to ' + options.prometheus)
+    stats.write_prometheus(options.prometheus, filename)
+
+class FeedRoute :
+  """A feed that gets the messages of a source that match its rules (see 
+  update_feeds()).
+
+  A message matches if its List-Id is list_id, if to is one of its To or Cc
+  addresses, or if its subject matches the subject regular expression. A 
+  route without rules gets all messages. Until the feed is saved, the 
+  newest messages that fit in the feed are kept in a bounded heap."""
+
+  def __init__(self, feed, options, list_id=None, to=None, subject=None) :
+    self.feed = feed
+    self.options = options
+    self.list_id = list_id and list_id.strip().lstrip('<').rstrip('>').lower()
+    self.to = to and to.strip().lower()
+    if isinstance(subject, bytes) :
+      # Python 2 reads configuration files as bytes
+      subject = subject.decode('utf-8')
+    self.subject = subject and re.compile(subject, re.I | re.U)
+    self.since = None
+    self.limit = 0
+    self.newest = []
+
+  def start(self, current_time) :
+    """Determines the messages that fit in the feed. Archived feeds keep 
+    all messages."""
+    if self.options.archive_size <= 0 :
+      if self.options.max_time > 0 :
+        self.since = current_time - datetime.timedelta(minutes=self.options.max_time)
+        logging.debug('Retrieving messages since ' + str(self.since))
+      self.limit = max(self.options.max_items, 0)
+
+  def matches(self, headers) :
+    """Checks whether a message matches the rules, given its routing_headers()"""
+    if not (self.list_id or self.to or self.subject) :
+      return True
+    (list_id, addresses, subject) = headers
+    return bool((self.list_id and self.list_id == list_id) or (self.to and self.to in addresses) or (self.subject and self.subject.search(subject)))
+
+  def keep(self, message, date, order) :
+    """Keeps a message for the feed, if it is one of the newest that fit"""
+    if self.since and date < self.since :
+      logging.debug('Skipping outdated message')
+      return
+    # Ties are broken by retrieval order (newest first)
+    item = (date, -order, message)
+    if self.limit and len(self.newest) >= self.limit :
+      heapq.heappushpop(self.newest, item)
+    else :
+      heapq.heappush(self.newest, item)
+
+  def finish(self, current_time) :
+    """Adds the kept messages to the feed, and saves it. Returns the number 
+    of added messages."""
+    count = len(self.newest)
+    for (date, _, message) in sorted(self.newest, reverse=True) :
+      self.feed.add_message(message)
+    self.newest = []
+    if self.feed.modified :
+      self.feed.set_updated(current_time)
+    self.feed.save()
+    return count
+
+
+def routing_headers(message) :
+  """Returns the List-Id, the set of To and Cc addresses, and the subject of 
+  a message, as used by FeedRoute.matches()"""
+  list_id = email.utils.parseaddr(message['List-Id'] or '')[1].lower()
+  addresses = set([address.lower() for (_, address) in email.utils.getaddresses(message.get_all('To', []) + message.get_all('Cc', []))])
+  return (list_id, addresses, decode_header(message['Subject'], ''))
+
+def update_feed(feed, source, options, state=None) :
+  """Adds the new messages of a source to a feed, and saves the feed.
+
+  Returns the number of added messages."""
+  return update_feeds([FeedRoute(feed, options)], source, state)
+
+def update_feeds(routes, source, state=None) :
+  """Adds the new messages of a source to the feeds of a list of routes, and
+  saves the feeds.
+
+  Every message is retrieved and parsed once, and is added to the feeds of
+  all the routes it matches. The retrieval stops at the first message that
+  is already in one of the feeds. Unless a feed is archived, only the 
+  messages that fit in it are kept: the source gets the earliest start of
+  the time windows of the feeds (and the maximum number of items of a 
+  single feed), and only the newest of the retrieved messages are kept for
+  every feed (in a bounded heap), so that no messages are added that would
+  be trimmed right away.
+
+  Returns the number of added messages."""
+  current_time = current_datetime()
+  logging.debug('Current time: ' + str(current_time))
+  for route in routes :
+    route.start(current_time)
+  since = None
+  if all([route.since for route in routes]) :
+    since = min([route.since for route in routes])
+  limit = routes[0].limit if len(routes) == 1 else 0
+  rules = any([route.list_id or route.to or route.subject for route in routes])
+  known = lambda message : any([route.feed.contains_message(message) for route in routes])
+
+  # Collect the newest available messages. Messages that were already 
+  # retrieved (from another source, or another mailbox of the same source)
+  # are skipped, but do not stop the retrieval.
+  count = 0
+  retrieved = set()
+  for message in source.messages(known=known, since=since, limit=limit) :
+    if known(message) :
+      logging.info('Message already in feed. Stopped retrieving.')
+      break
+    id = message_key(message)
+    if id in retrieved :
+      logging.debug('Message already retrieved')
+      continue
+    retrieved.add(id)
+    date = message_date(message)
+    headers = routing_headers(message) if rules else None
+    for route in routes :
+      if route.matches(headers) :
+        route.keep(message, date, count)
+    count += 1
+    
+  # Add the messages to the feeds
+  added = 0
+  for route in routes :
+    added += route.finish(current_time)
+  if state :
+    state.commit()
+  return added
+
+
+def route_messages(routes, options) :
+  """Adds the new messages of the source described by the options to the 
+  feeds of a list of (filename, options, rules) routes, in a single pass 
+  (see update_feeds()). All the feeds are locked during the update."""
+  stats = Stats(enabled=bool(options.stats or options.prometheus))
+  locks = []
+  state = None
+  try :
+    feed_routes = []
+    for (filename, feed_options, rules) in sorted(routes, key=lambda route : route[0]) :
+      lock = FeedLock(filename)
+      lock.acquire()
+      locks.append(lock)
+      feed_routes.append(FeedRoute(create_feed(filename, feed_options, stats), feed_options, **rules))
+    if options.state and (options.mode != 'pipe' or options.sources) :
+      state = SyncState(options.state)
+    update_feeds(feed_routes, create_source(options, state, stats=stats), state)
+    write_stats(stats, options.routes, options)
+  finally :
+    if state :
+      state.close()
+    for lock in locks :
+      lock.release()
+
+def backfill_feed(feed, options, state=None) :
+  """Adds all the messages of an mbox file to a feed, using a pool of 
+  processes.
+
+  The file is split into chunks of BACKFILL_CHUNK_SIZE bytes, at message 
+  boundaries. Every process parses the messages of a chunk, creates their
+  entries, and writes them to a temporary file next to the feed; only the
+  ids and dates of the entries are sent back. The entries are merged in 
+  date order, and added to the feed without parsing them again: saving the
+  feed (and its archives) copies them from the temporary files. Messages 
+  that are already in the feed, or that are outdated, are skipped.
+
+  Returns the number of added messages."""
+  started = time.time()
+  since = None
+  if options.archive_size <= 0 and options.max_time > 0 :
+    since = current_datetime() - datetime.timedelta(minutes=options.max_time)
+  chunks = []
+  size = os.path.getsize(options.file)
+  if size :
+    file = open(options.file, 'rb')
+    try :
+      data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally :
+      file.close()
+    try :
+      chunks = mbox_chunks(data, BACKFILL_CHUNK_SIZE)
+      if state :
+        # Later runs only need to read the messages appended after this one
+        MailboxSource(options.file, mailbox.mbox, state).mbox_index(data)
+    finally :
+      data.close()
+  processes = options.processes or multiprocessing.cpu_count()
+  logging.info('Backfilling ' + str(size) + ' bytes of ' + options.file + ' in ' + str(len(chunks)) + ' chunks, using ' + str(processes) + ' processes')
+  directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(feed.filename)), prefix='.backfill')
+  # Every process creates its own instance of the feed
+  options = copy.copy(options)
+  options.uri = feed.uri
+  pool = multiprocessing.Pool(processes)
+  try :
+    tasks = [(feed.filename, options, since, chunk_start, chunk_end, directory) for (chunk_start, chunk_end) in chunks]
+    results = []
+    (done, count) = (0, 0)
+    for (filename, prefix, entries, chunk_size) in pool.imap_unordered(backfill_chunk, tasks) :
+      results.append([entry + (filename, prefix) for entry in entries])
+      done += chunk_size
+      count += len(entries)
+      logging.info('Backfilled ' + str(done * 100 // max(size, 1)) + '% (' + str(count) + ' messages)')
+    pool.close()
+    
+    # Add the entries, newest first (like update_feed())
+    added = 0
+    for (_, id, mid, updated, published, start, end, filename, prefix) in reversed(list(heapq.merge(*results))) :
+      entry = FeedEntry(id, mid, updated, published, filename=filename, start=start, end=end, prefix=prefix)
+      if feed.contains_entry(entry) :
+        continue
+      feed.add_entry(entry)
+      added += 1
+    feed.stats.add('backfill', time.time() - started, added, size)
+    if feed.modified :
+      feed.set_updated(current_datetime())
+    feed.save()
+    if state :
+      state.commit()
+    return added
+  finally :
+    pool.terminate()
+    shutil.rmtree(directory, ignore_errors=True)
+
+def backfill_chunk(task) :
+  """Creates the entries for the messages in a part of an mbox file (in a 
+  process of the pool of backfill_feed()), and writes them to a temporary
+  file.
+
+  Returns the filename and document prefix of the temporary file, a list 
+  with the date, id, Message-ID, dates, and location of every entry 
+  (oldest first), and the size of the part."""
+  (filename, options, since, start, end, directory) = task
+  feed = create_feed(filename, options)
+  prefix = document_prefix(feed.doc.toxml('utf-8'))
+  (fd, entries_filename) = tempfile.mkstemp(dir=directory, suffix='.xml')
+  out = os.fdopen(fd, 'wb')
+  file = open(options.file, 'rb')
+  try :
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  finally :
+    file.close()
+  entries = []
+  offset = 0
+  try :
+    text_end = end
+    for text_start in mbox_offsets(data, start, end) :
+      # Skip the From_ line
+      text = data[data.find(b'\n', text_start, text_end) + 1:text_end]
+      text_end = text_start
+      header = message_header(text)
+      if feed.contains_message(header) or message_outdated(header, since) :
+        continue
+      message = parse_message(text)
+      if not message :
+        continue
+      entry = feed.create_entry(message)
+      xml = entry.element.toxml('utf-8')
+      entry.element.unlink()
+      out.write(xml)
+      date = calendar.timegm(entry.date().utctimetuple())
+      entries.append((date, entry.id, entry.mid, entry.updated, entry.published, offset, offset + len(xml)))
+      offset += len(xml)
+  finally :
+    data.close()
+    out.close()
+  entries.sort()
+  return (entries_filename, prefix, entries, end - start)
+
+def flush_spool(filename, options) :
+  """Adds all the spooled messages to the feed in a single update.
+
+  If another process is already updating the feed, the messages are left
+  in the spool for that process."""
+  source = SpoolSource(options.spool)
+  while source.pending() :
+    lock = FeedLock(filename)
+    if not lock.acquire(blocking=False) :
+      logging.info('Feed is being updated by another process')
+      return
+    try :
+      stats = Stats(enabled=bool(options.stats or options.prometheus))
+      source.stats = stats
+      update_feed(create_feed(filename, options, stats), source, options)
+      source.remove()
+      write_stats(stats, filename, options)
+    finally :
+      lock.release()
+    # Messages that were spooled while the feed was locked are picked up by 
+    # checking the spool again
+
+
+class FeedLock :
+  """An exclusive lock on a feed, shared by all processes.
+
+  The lock is taken on a separate file, since the feed file itself is 
+  replaced when it is saved. The lock file only exists while the lock is 
+  held, so it does not linger in the (published) directory of the feed. A 
+  process that locked a lock file that was removed in the meantime tries 
+  again with a new one."""
+
+  def __init__(self, filename) :
+    self.filename = filename + '.lock'
+    self.file = None
+
+  def acquire(self, blocking=True, timeout=None) :
+    """Acquires the lock. Returns False if the lock is held by another 
+    process, and blocking is False, or the lock is still held after 
+    timeout seconds."""
+    deadline = time.time() + timeout if timeout is not None else None
+    while True :
+      self.file = open(self.filename, 'a')
+      try :
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | (0 if blocking and deadline is None else fcntl.LOCK_NB))
+      except IOError :
+        self.file.close()
+        self.file = None
+        if not blocking or deadline is None or time.time() >= deadline :
+          return False
+        time.sleep(0.05)
+        continue
+      # The previous holder may have removed the file before we locked it
+      info = os.fstat(self.file.fileno())
+      try :
+        current = os.stat(self.filename)
+        if (current.st_dev, current.st_ino) == (info.st_dev, info.st_ino) :
+          return True
+      except OSError :
+        pass
+      self.file.close()
+
+  def release(self) :
+    """Releases the lock, and removes the lock file"""
+    os.remove(self.filename)
+    fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+    self.file.close()
+    self.file = None
+
+
+################################################################################
+# Daemon
+################################################################################
+
+def read_config(filename, parser) :
+  """Reads the feeds from a configuration file.
+
+  Every section of the file describes a feed. The name of the section is the 
+  feed file, and the keys are long command line options (without the 
+  leading dashes). Flags take a boolean value. Keys in the DEFAULT section
+  apply to all feeds.
+
+  Returns a list of (filename, options) tuples."""
+  config = read_config_file(filename)
+  feeds = []
+  for section in config.sections() :
+    args = config_args(config, section, parser, ('config', 'logfile', 'workers', 'max-connections', 'profile', 'backfill', 'processes', 'routes'))
+    (options, _) = parser.parse_args(args)
+    error = check_options(options)
+    if error :
+      raise ValueError(error + ' for feed ' + section)
+    if options.sources :
+      options.sources = read_sources(options.sources, parser)
+    elif options.mode == 'pipe' :
+      raise ValueError('Mode pipe is not supported for feed ' + section)
+    feeds.append((section, options))
+  return feeds
+
+def read_sources(filename, parser) :
+  """Reads the message sources of a feed from a configuration file.
+
+  Every section of the file describes a source. The name of the section is
+  only used in messages, and the keys are the long command line options of
+  the source (such as mode, host, or file). All sources share the state 
+  file of the feed.
+
+  Returns a list of options, one for every source."""
+  config = read_config_file(filename)
+  excluded = [option.get_opt_string()[2:] for option in parser.option_list if option.get_opt_string()[2:] not in SOURCE_OPTIONS]
+  sources = []
+  for section in config.sections() :
+    args = config_args(config, section, parser, excluded + ['state', 'spool', 'flush'])
+    (options, _) = parser.parse_args(args)
+    error = check_options(options)
+    if error :
+      raise ValueError(error + ' for source ' + section)
+    if options.mode == 'pipe' :
+      raise ValueError('Mode pipe is not supported for source ' + section)
+    sources.append(options)
+  if not sources :
+    raise ValueError('No sources in ' + filename)
+  return sources
+
+
+def read_routes(filename, parser, options) :
+  """Reads the routes of messages to feeds from a configuration file.
+
+  Every section of the file describes a feed, like in the configuration 
+  file of the daemon (see read_config()), except that the options of the 
+  message source are taken from the given options. The list-id, to, and 
+  subject keys give the rules for the messages that go into the feed (see 
+  FeedRoute).
+
+  Returns a list of (filename, options, rules) tuples, where rules is a 
+  dictionary of FeedRoute arguments."""
+  config = read_config_file(filename)
+  feeds = []
+  for section in config.sections() :
+    rules = {}
+    for name in ROUTE_RULES :
+      if config.has_option(section, name) :
+        rules[name.replace('-', '_')] = config.get(section, name)
+    if 'subject' in rules :
+      try :
+        re.compile(rules['subject'])
+      except re.error as e :
+        raise ValueError('Invalid subject expression for feed ' + section + ': ' + str(e))
+    args = config_args(config, section, parser, SOURCE_OPTIONS + ('config', 'logfile', 'workers', 'max-connections', 'profile', 'backfill', 'processes', 'routes', 'idle', 'debounce', 'interval'), ROUTE_RULES)
+    (feed_options, _) = parser.parse_args(args, copy.copy(options))
+    feeds.append((section, feed_options, rules))
+  return feeds
+
+def read_config_file(filename) :
+  """Reads a configuration file"""
+  config = configparser.RawConfigParser()
+  if not config.read(filename) :
+    raise IOError('Unable to read configuration file ' + filename)
+  return config
+
+def config_args(config, section, parser, excluded=(), skipped=()) :
+  """Returns the command line arguments for the keys of a section of a 
+  configuration file. Keys that are excluded are an error; keys that are 
+  skipped are left out."""
+  args = []
+  for (name, value) in config.items(section) :
+    if name in skipped :
+      continue
+    option = parser.get_option('--' + name)
+    if not option or name in excluded :
+      raise ValueError('Unknown option \'' + name + '\' for feed ' + section)
+    if option.takes_value() :
+      args.append('--' + name + '=' + value)
+    elif value.lower() in ('1', 'yes', 'true', 'on') :
+      args.append('--' + name)
+  return args
+
+
+class ConnectionPool :
+  """A pool of authenticated connections, shared by threads.
+
+  Connections are kept per account (i.e. mode, host, port and user). The 
+  number of connections to the same host that are in use at the same time 
+  is limited. A feed with several sources takes the slots for all its 
+  connections at once, so two feeds cannot each hold some of the slots of a
+  host while waiting for the others."""
+
+  def __init__(self, max_connections=2) :
+    self.max_connections = max_connections
+    self.lock = threading.Lock()
+    self.condition = threading.Condition(self.lock)
+    self.idle = {}
+    self.used = {}
+
+  def acquire(self, requests) :
+    """Returns a connection for every (account, connect) tuple of a list, 
+    waiting until the hosts have free slots for all of them. An idle 
+    connection is reused if it is still alive; otherwise, a new one is 
+    opened with connect()"""
+    hosts = [account[1] for (account, connect) in requests]
+    for host in hosts :
+      if hosts.count(host) > self.max_connections :
+        raise ValueError(str(hosts.count(host)) + ' connections to ' + host + ' needed, but at most ' + str(self.max_connections) + ' allowed')
+    with self.condition :
+      while [host for host in hosts if self.used.get(host, 0) + hosts.count(host) > self.max_connections] :
+        self.condition.wait()
+      for host in hosts :
+        self.used[host] = self.used.get(host, 0) + 1
+    connections = []
+    try :
+      for (account, connect) in requests :
+        connections.append(self.connection(account, connect))
+    except :
+      for (account, connection) in zip([account for (account, connect) in requests], connections) :
+        self.release(account, connection, False)
+      for (account, connect) in requests[len(connections):] :
+        self.free(account[1])
+      raise
+    return connections
+
+  def connection(self, account, connect) :
+    """Returns an idle connection of an account, or a new one"""
+    while True :
+      with self.lock :
+        connections = self.idle.get(account)
+        if not connections :
+          break
+        connection = connections.pop()
+      try :
+        ping(connection)
+        logging.debug('Reusing connection to ' + account[1])
+        return connection
+      except Exception :
+        logging.debug('Discarding stale connection to ' + account[1])
+        close(connection)
+    logging.info('Connecting to ' + account[1])
+    return connect()
+
+  def release(self, account, connection, reuse=True) :
+    """Returns a connection to the pool, or closes it"""
+    if reuse :
+      with self.lock :
+        self.idle.setdefault(account, []).append(connection)
+    else :
+      close(connection)
+    self.free(account[1])
+
+  def free(self, host) :
+    """Frees a slot of a host"""
+    with self.condition :
+      self.used[host] -= 1
+      self.condition.notify_all()
+
+
+def ping(connection) :
+  """Checks whether a connection is still alive, and raises an exception if 
+  it is not"""
+  if isinstance(connection, imaplib.IMAP4) :
+    connection.noop()
+  elif nntplib and isinstance(connection, nntplib.NNTP) :
+    connection.date()
+
+def close(connection) :
+  """Logs out of a connection, ignoring all errors"""
+  try :
+    if isinstance(connection, imaplib.IMAP4) :
+      connection.logout()
+    else :
+      connection.quit()
+  except Exception :
+    pass
+
+
+class FeedDaemon :
+  """A long-running process that periodically updates a set of feeds.
+
+  The feeds are updated by a pool of worker threads, every feed at its own
+  interval. Connections to IMAP and NNTP servers are kept open between
+  updates, and are shared by all the feeds of the same account. POP3
+  connections cannot be reused, because a POP3 session does not see new 
+  messages. When updating a feed fails, the next update is postponed 
+  exponentially, up to MAX_BACKOFF seconds. Feeds with the idle option are
+  not scheduled, but kept up to date by a FeedWatcher thread each, with a 
+  connection of their own."""
+
+  MAX_BACKOFF = 3600
+
+  def __init__(self, feeds, workers=4, max_connections=2) :
+    for (filename, options) in feeds :
+      hosts = [source_options.host for source_options in options.sources or [options] if source_options.mode in NETWORK_MODES]
+      for host in hosts :
+        if hosts.count(host) > max_connections :
+          raise ValueError('Feed ' + filename + ' has ' + str(hosts.count(host)) + ' sources on ' + host + ', more than the ' + str(max_connections) + ' connections allowed')
+    self.feeds = feeds
+    self.workers = workers
+    self.pool = ConnectionPool(max_connections)
+    self.queue = queue.Queue()
+    self.condition = threading.Condition()
+    self.schedule = []
+    self.failures = [0] * len(feeds)
+
+  def run(self) :
+    """Updates the feeds forever"""
+    logging.info('Starting daemon for ' + str(len(self.feeds)) + ' feeds')
+    for i in range(self.workers) :
+      thread = threading.Thread(target=self.work, name='worker-' + str(i))
+      thread.daemon = True
+      thread.start()
+    now = time.time()
+    self.schedule = []
+    for (index, (filename, options)) in enumerate(self.feeds) :
+      if options.idle :
+        thread = threading.Thread(target=FeedWatcher(filename, options).run, name=os.path.basename(filename))
+        thread.daemon = True
+        thread.start()
+      else :
+        self.schedule.append((now, index))
+    while True :
+      with self.condition :
+        while not self.schedule or self.schedule[0][0] > time.time() :
+          if self.schedule :
+            self.condition.wait(max(0, self.schedule[0][0] - time.time()))
+          else :
+            # Wake up regularly, so the daemon can be interrupted
+            self.condition.wait(self.MAX_BACKOFF)
+        (_, index) = heapq.heappop(self.schedule)
+      self.queue.put(index)
+
+  def work(self) :
+    """Updates the feeds that are due"""
+    while True :
+      index = self.queue.get()
+      (filename, options) = self.feeds[index]
+      threading.current_thread().name = os.path.basename(filename)
+      try :
+        self.update(filename, options)
+        self.failures[index] = 0
+        delay = options.interval
+      except Exception :
+        logging.exception('Unable to update feed ' + filename)
+        self.failures[index] += 1
+        delay = min(options.interval * 2 ** self.failures[index], max(self.MAX_BACKOFF, options.interval))
+      with self.condition :
+        heapq.heappush(self.schedule, (time.time() + delay, index))
+        self.condition.notify()
+
+  def update(self, filename, options) :
+    """Updates a single feed"""
+    logging.info('Updating feed ' + filename)
+    lock = FeedLock(filename)
+    lock.acquire()
+    state = None
+    stats = Stats(enabled=bool(options.stats or options.prometheus))
+    try :
+      feed = create_feed(filename, options, stats)
+      if options.state :
+        state = SyncState(options.state)
+      sources = []
+      connections = []
+      try :
+        requests = []
+        for source_options in options.sources or [options] :
+          if source_options.mode in NETWORK_MODES :
+            account = (source_options.mode, source_options.host, source_options.port, source_options.user)
+            requests.append((account, lambda source_options=source_options : connect(source_options)))
+        with stats.timer('connect') :
+          acquired = self.pool.acquire(requests)
+        connections = [(account, connection, account[0] in ('imap', 'imap-ssl', 'nntp')) for ((account, _), connection) in zip(requests, acquired)]
+        acquired = iter(acquired)
+        for source_options in options.sources or [options] :
+          connection = None
+          if source_options.mode in NETWORK_MODES :
+            connection = next(acquired)
+          sources.append(create_source(source_options, state, connection, stats))
+        if options.sources :
+          update_feed(feed, MergedSource(sources), options, state)
+        else :
+          update_feed(feed, sources[0], options, state)
+      except :
+        for (account, connection, _) in connections :
+          self.pool.release(account, connection, False)
+        raise
+      for (account, connection, reuse) in connections :
+        self.pool.release(account, connection, reuse)
+      write_stats(stats, filename, options)
+    finally :
+      if state :
+        state.close()
+      lock.release()
+
+
+class FeedWatcher :
+  """Keeps a feed up to date with an IMAP account, by keeping a connection
+  open and waiting for new messages (see IMAPSource.wait()).
+
+  Messages that arrive close to each other are added in a single update. 
+  Without a state file, the synchronization state is kept in memory, so 
+  only the new messages are retrieved. When the connection is lost or an 
+  update fails, the watcher reconnects, waiting exponentially longer after
+  every failure, up to MAX_BACKOFF seconds."""
+
+  MAX_BACKOFF = 600
+
+  def __init__(self, filename, options) :
+    self.filename = filename
+    self.options = options
+    self.failures = 0
+
+  def run(self) :
+    """Updates the feed forever"""
+    logging.info('Watching ' + self.options.host + ' for feed ' + self.filename)
+    state = SyncState(self.options.state or ':memory:')
+    try :
+      while True :
+        connection = None
+        try :
+          connection = connect(self.options)
+          source = create_source(self.options, state, connection)
+          self.update(source, state)
+          self.failures = 0
+          while True :
+            if source.wait(self.options.interval, self.options.debounce) :
+              self.update(source, state)
+        except Exception :
+          logging.exception('Unable to update feed ' + self.filename)
+          state.rollback()
+          if connection :
+            close(connection)
+          self.failures += 1
+          delay = min(2 ** self.failures, self.MAX_BACKOFF)
+          logging.info('Reconnecting in ' + str(delay) + ' seconds')
+          time.sleep(delay)
+    finally :
+      state.close()
+
+  def update(self, source, state) :
+    """Adds the new messages of a source to the feed"""
+    logging.info('Updating feed ' + self.filename)
+    lock = FeedLock(self.filename)
+    lock.acquire()
+    stats = Stats(enabled=bool(self.options.stats or self.options.prometheus))
+    try :
+      source.stats = stats
+      update_feed(create_feed(self.filename, self.options, stats), source, self.options, state)
+      write_stats(stats, self.filename, self.options)
+    finally :
+      lock.release()
+
+
+class DeliveryServer :
+  """Adds the messages that atomail-deliver.py receives from a mail delivery
+  agent to their feeds, without starting AtoMail for every message.
+
+  The client sends its working directory, the command line arguments of a
+  pipe mode delivery, and the message, over a unix domain socket. The 
+  server answers OK once it stored the delivery in its spool directory, 
+  and adds the message to the feed when no messages arrived for that feed 
+  for debounce seconds, but at most MAX_DELAY seconds after the first 
+  message that is waiting. A delivery is removed from the spool once its
+  feed is saved; deliveries that are still in the spool when the server 
+  starts are added again. Feeds are kept in memory between updates, and 
+  are only read again when another process changed them. When the server 
+  stops, all feeds are saved.
+
+  Only the owner of the server can connect to the socket. A delivery is 
+  refused if its client could not write the feed (and its other files) 
+  itself. A feed that another process keeps locked for more than 
+  LOCK_TIMEOUT seconds is updated later, so it does not hold up the 
+  deliveries to other feeds."""
+
+  CLIENT_TIMEOUT = 30
+  RETRY_DELAY = 60
+  MAX_DELAY = 60
+  LOCK_TIMEOUT = 1
+  EXCLUDED_OPTIONS = ('mode', 'spool', 'flush', 'state', 'sources', 'routes', 'config', 'backfill', 'idle', 'listen', 'profile', 'logfile')
+
+  def __init__(self, path, parser, debounce=2, spool=None) :
+    self.path = path
+    self.parser = parser
+    self.debounce = debounce
+    self.spool = spool or path + '.spool'
+    self.feeds = {}
+    self.socket = None
+
+  def run(self) :
+    """Receives messages forever"""
+    self.listen()
+    self.recover()
+    logging.info('Listening on ' + self.path)
+    while True :
+      deadlines = [feed.deadline for feed in self.feeds.values() if feed.deadline]
+      timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+      if select.select([self.socket], [], [], timeout)[0] :
+        (connection, _) = self.socket.accept()
+        connection.settimeout(self.CLIENT_TIMEOUT)
+        try :
+          self.receive(connection)
+        except Exception :
+          logging.exception('Unable to receive message')
+        finally :
+          connection.close()
+      now = time.time()
+      for feed in self.feeds.values() :
+        if feed.deadline and feed.deadline <= now :
+          self.flush(feed)
+
+  def listen(self) :
+    """Creates the socket, which only its owner can connect to"""
+    if os.path.exists(self.path) :
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try :
+        probe.connect(self.path)
+        listening = True
+      except socket.error :
+        listening = False
+      probe.close()
+      if listening :
+        raise IOError('Another daemon is listening on ' + self.path)
+      # Left behind by a daemon that stopped
+      os.remove(self.path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(self.path)
+    os.chmod(self.path, 0o600)
+    server.listen(16)
+    self.socket = server
+
+  def receive(self, connection) :
+    """Reads a delivery from a client, and answers it"""
+    chunks = []
+    while True :
+      chunk = connection.recv(65536)
+      if not chunk :
+        break
+      chunks.append(chunk)
+    data = b''.join(chunks)
+    if not data :
+      # Another daemon checking whether this one is running
+      return
+    try :
+      (filename, options, arguments, text) = self.decode(data)
+      self.check_access(filename, options, self.client_uid(connection))
+    except ValueError as e :
+      connection.sendall(b'ERROR ' + str(e).encode('utf-8') + b'\n')
+      return
+    logging.info('Received message for ' + filename)
+    name = spool_data(self.spool, data)
+    self.add(filename, options, arguments, text, name)
+    connection.sendall(b'OK\n')
+
+  def recover(self) :
+    """Adds the deliveries that are still in the spool directory"""
+    directory = os.path.join(self.spool, 'new')
+    if not os.path.isdir(directory) :
+      return
+    for name in sorted(os.listdir(directory)) :
+      spool_file = open(os.path.join(directory, name), 'rb')
+      try :
+        data = spool_file.read()
+      finally :
+        spool_file.close()
+      try :
+        (filename, options, arguments, text) = self.decode(data)
+      except ValueError as e :
+        logging.warning('Invalid delivery ' + name + ' in spool: ' + str(e))
+        continue
+      logging.info('Recovered message for ' + filename)
+      self.add(filename, options, arguments, text, name)
+
+  def decode(self, data) :
+    """Returns the filename of the feed, the options, the arguments, and the
+    message of a delivery. Raises a ValueError if it is not valid."""
+    # A line with the number of arguments, the NUL-terminated arguments 
+    # (the first of which is the working directory), and the message
+    try :
+      (count, data) = data.split(b'\n', 1)
+      items = data.split(b'\0', int(count))
+    except ValueError :
+      raise ValueError('Invalid delivery')
+    (arguments, text) = (items[:-1], items[-1])
+    if not arguments :
+      raise ValueError('Invalid delivery')
+    if sys.version_info[0] >= 3 :
+      arguments = [argument.decode('utf-8', 'surrogateescape') for argument in arguments]
+    (filename, options) = self.parse(arguments[0], arguments[1:])
+    return (filename, options, arguments[1:], text)
+
+  def client_uid(self, connection) :
+    """Returns the user ID of the client of a connection"""
+    if not hasattr(socket, 'SO_PEERCRED') :
+      # Only the owner of the socket (and root) can connect
+      return os.getuid()
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1]
+
+  def check_access(self, filename, options, uid) :
+    """Raises a ValueError if the user with the given ID could not write the
+    feed, or the other files of its delivery, itself"""
+    paths = [filename] + [getattr(options, name) for name in ('blob_dir', 'stats', 'prometheus') if getattr(options, name)]
+    for path in paths :
+      path = os.path.realpath(path)
+      if not os.path.isdir(path) :
+        if os.path.exists(path) and not writable_by(path, uid) :
+          raise ValueError('Permission denied: ' + path)
+        # Files are replaced, which takes a writable directory
+        path = os.path.dirname(path)
+      while not os.path.exists(path) :
+        path = os.path.dirname(path)
+      if not writable_by(path, uid) :
+        raise ValueError('Permission denied: ' + path)
+
+  def add(self, filename, options, arguments, text, name) :
+    """Adds a delivery (stored as name in the spool) to its feed, and 
+    schedules the update of the feed"""
+    feed = self.feeds.get(filename)
+    if feed and feed.arguments != arguments :
+      # The options of the feed changed. Messages that could not be added
+      # are added with the new options.
+      self.flush(feed)
+      previous = feed
+      feed = DeliveryFeed(filename, options, arguments, self.spool)
+      (feed.source.texts, feed.names, feed.first) = (previous.source.texts, previous.names, previous.first)
+      self.feeds[filename] = feed
+    elif not feed :
+      feed = DeliveryFeed(filename, options, arguments, self.spool)
+      self.feeds[filename] = feed
+    feed.add(text, name)
+    if not feed.retrying :
+      feed.deadline = min(time.time() + self.debounce, feed.first + max(self.MAX_DELAY, self.debounce))
+
+  def parse(self, directory, arguments) :
+    """Returns the (absolute) filename of the feed and the options of a
+    delivery. Raises a ValueError if they are not valid."""
+    parser = copy.copy(self.parser)
+    def error(message) :
+      raise ValueError(message)
+    parser.error = error
+    parser.exit = lambda status=0, message=None : error(message or 'Invalid arguments')
+    # Never print to the output of the daemon
+    parser.print_help = lambda file=None : error('Option --help is not supported for deliveries')
+    parser.print_version = lambda file=None : error('Option --version is not supported for deliveries')
+    (options, args) = parser.parse_args(arguments)
+    if len(args) != 1 :
+      raise ValueError('Filename missing')
+    for name in self.EXCLUDED_OPTIONS :
+      if getattr(options, name.replace('-', '_')) != parser.defaults.get(name.replace('-', '_')) :
+        raise ValueError('Option --' + name + ' is not supported for deliveries')
+    error = check_options(options)
+    if error :
+      raise ValueError(error)
+    for name in ('blob_dir', 'stats', 'prometheus') :
+      if getattr(options, name) :
+        setattr(options, name, os.path.join(directory, getattr(options, name)))
+    return (os.path.realpath(os.path.join(directory, args[0])), options)
+
+  def flush(self, feed) :
+    """Adds the received messages to a feed. If that fails, it is tried 
+    again later."""
+    try :
+      if not feed.flush(self.LOCK_TIMEOUT) :
+        logging.info('Feed ' + feed.filename + ' is locked by another process')
+        feed.deadline = time.time() + max(self.debounce, self.LOCK_TIMEOUT)
+    except Exception :
+      logging.exception('Unable to update feed ' + feed.filename)
+      feed.feed = None
+      feed.retrying = True
+      feed.deadline = time.time() + self.RETRY_DELAY
+
+  def close(self) :
+    """Saves all feeds, and stops listening"""
+    if self.socket :
+      self.socket.close()
+      os.remove(self.path)
+    for feed in self.feeds.values() :
+      if feed.deadline :
+        self.flush(feed)
+
+
+class DeliveryFeed :
+  """A feed of a DeliveryServer, with the messages that were received for
+  it, but not yet added to it, and their names in the spool directory"""
+
+  def __init__(self, filename, options, arguments, spool) :
+    self.filename = filename
+    self.options = options
+    self.arguments = arguments
+    self.spool = spool
+    self.source = BufferSource()
+    self.names = []
+    self.feed = None
+    self.signature = None
+    self.deadline = None
+    self.first = None
+    self.retrying = False
+
+  def add(self, text, name) :
+    """Adds a received message"""
+    self.source.add(text)
+    self.names.append(name)
+    if self.first is None :
+      self.first = time.time()
+
+  def flush(self, timeout=None) :
+    """Adds the received messages to the feed, and saves it. Returns False
+    if the feed is still locked by another process after timeout seconds."""
+    logging.info('Updating feed ' + self.filename)
+    lock = FeedLock(self.filename)
+    if not lock.acquire(timeout=timeout) :
+      return False
+    try :
+      stats = Stats(enabled=bool(self.options.stats or self.options.prometheus))
+      if not self.feed or file_signature(self.filename) != self.signature :
+        self.feed = create_feed(self.filename, self.options, stats)
+      self.feed.stats = stats
+      self.source.stats = stats
+      update_feed(self.feed, self.source, self.options)
+      self.signature = file_signature(self.filename)
+      # The messages that were read are in the saved feed now
+      for name in self.names[:self.source.count] :
+        try :
+          os.remove(os.path.join(self.spool, 'new', name))
+        except OSError :
+          pass
+      del self.names[:self.source.count]
+      self.source.clear()
+      write_stats(stats, self.filename, self.options)
+    finally :
+      lock.release()
+    self.deadline = None
+    self.first = None
+    self.retrying = False
+    return True
+
+
+################################################################################
+# Main program
+################################################################################
+
+if __name__ == "__main__" :
+  # Parse the arguments
+  parser = create_parser()
   (options, args) = parser.parse_args()
 
   # Initialize the logger
@@ -546,81 +3539,110 @@ if __name__ == "__main__" :
     handler = logging.FileHandler(options.logfile)
   else :
     handler = logging.StreamHandler()
-  handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+  if options.config or options.idle or options.listen :
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: [%(threadName)s] %(message)s'))
+  else :
+    handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
   logging.getLogger().addHandler(handler)
   logging.getLogger().setLevel(options.loglevel)
 
+  # Run as a daemon
+  if options.config :
+    try :
+      feeds = read_config(options.config, parser)
+      daemon = FeedDaemon(feeds, workers = options.workers, max_connections = options.max_connections)
+    except (IOError, ValueError, configparser.Error) as e :
+      sys.exit(str(e))
+    try :
+      daemon.run()
+    except KeyboardInterrupt :
+      logging.info('Stopping daemon')
+      sys.exit(0)
+
+  # Receive messages from atomail-deliver.py
+  if options.listen :
+    server = DeliveryServer(options.listen, parser, options.debounce, options.spool)
+    # Save the feeds when the daemon is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame : sys.exit(0))
+    try :
+      server.run()
+    except KeyboardInterrupt :
+      logging.info('Stopping daemon')
+    except (IOError, socket.error) as e :
+      sys.exit(str(e))
+    finally :
+      server.close()
+    sys.exit(0)
+
+  # Read the message sources
+  if options.sources :
+    try :
+      options.sources = read_sources(options.sources, parser)
+    except (IOError, ValueError, configparser.Error) as e :
+      sys.exit(str(e))
+
+  # Add the messages to several feeds
+  if options.routes :
+    error = check_options(options)
+    if error :
+      sys.exit(error)
+    try :
+      routes = read_routes(options.routes, parser, options)
+    except (IOError, ValueError, configparser.Error) as e :
+      sys.exit(str(e))
+    route_messages(routes, options)
+    sys.exit(0)
+
   # Get the filename
   if len(args) != 1 :
     sys.exit('Filename missing')
   filename = args[0]
   
-  # Check hostname
-  if options.mode in ('pop3','pop3-ssl','imap','imap-ssl','nntp') and not options.host :
-    sys.exit('Host missing')
-  
-  if options.mode in ('pop3','pop3-ssl','imap','imap-ssl') and not options.user :
-    sys.exit('Username missing')
-  
-  if options.mode in ('pop3','pop3-ssl','imap','imap-ssl') and not options.password :
-    sys.exit('Password missing')
-
-  if options.mode in ('mbox','maildir') and not options.file :
-    sys.exit('Mailbox file or directory missing')
-
-  if options.mode == 'nntp' and not options.group :
-    sys.exit('Group missing')
-
-  # Substitute defaults if necessary
-  if not options.uri :
-    logging.warning('Feed URI missing. Using default URI.')
-    options.uri = 'http://example.com/' + os.path.basename(filename)
-    
-  # Initialize the feed
-  feed = MessageFeed(filename = filename, uri = options.uri, title = options.title, max_items = options.max_items, max_time = options.max_time, strip_subject = options.strip_subject)
-  updated_time = feed.updated()
-  current_time = current_datetime()
-  logging.debug('Current time: ' + str(current_time))
-  logging.debug('Feed last updated: ' + str(updated_time))
-  
-  # Initialize the message source
-  logging.info('Initializing the message source')
-  if options.mode == "mbox" :
-    source = MailboxSource(options.file, mailbox.PortableUnixMailbox)
-  elif options.mode == "maildir" :
-    source = MailboxSource(options.file, mailbox.Maildir)
-  elif options.mode == "pop3" : 
-    source = POP3Source(options.host, options.port, options.user, options.password)
-  elif options.mode == "pop3-ssl" : 
-    source = POP3Source(options.host, options.port, options.user, options.password, ssl=True)
-  elif options.mode == "imap" : 
-    source = IMAPSource(options.host, options.port, options.user, options.password, None)
-  elif options.mode == "imap-ssl" : 
-    source = IMAPSource(options.host, options.port, options.user, options.password, None, ssl=True)
-  elif options.mode == "nntp" : 
-    source = NNTPSource(options.host, options.port, options.group, options.user, options.password)    
-  else :
-    source = PipeSource()
-    
-  # Determine the date from which messages should be retrieved
-  if options.max_time > 0 :
-    from_time = max(current_time - datetime.timedelta(minutes=options.max_time),updated_time)
-  else :
-    from_time = updated_time
+  # Check the options
+  error = check_options(options)
+  if error :
+    sys.exit(error)
+
+  # Keep the feed up to date as messages arrive
+  if options.idle :
+    try :
+      FeedWatcher(filename, options).run()
+    except KeyboardInterrupt :
+      logging.info('Stopping')
+      sys.exit(0)
+
+  # Spool the message, and add all spooled messages to the feed
+  if options.mode == 'pipe' and options.spool :
+    if not options.flush :
+      PipeSource().spool(options.spool)
+    flush_spool(filename, options)
+    sys.exit(0)
+
+  # Initialize the statistics
+  stats = Stats(enabled=bool(options.stats or options.prometheus or options.profile))
+
+  with stats.profile(options.profile) :
+    # Initialize the feed
+    lock = FeedLock(filename)
+    lock.acquire()
+    state = None
+    try :
+      feed = create_feed(filename, options, stats)
+      
+      # Initialize the synchronization state
+      if options.state and (options.mode != 'pipe' or options.sources) :
+        state = SyncState(options.state)
 
-  # Add available messages to the feed
-  count = 0
-  for message in source.messages() :
-    if feed.contains_message(message) :
-      logging.info('Message already in feed. Stopped retrieving.')
-      break
-    else :
-      feed.add_message(message)
-      count += 1
-      if options.max_items > 0 and count > options.max_items :
-        logging.info('Maximum # of items reached. Stopped retrieving.')
-        break
-    
-  # Add the messages to the feed
-  feed.set_updated(current_time)
-  feed.save()
+      # Add the messages to the feed
+      if options.backfill :
+        backfill_feed(feed, options, state)
+      else :
+        source = create_source(options, state, stats=stats)
+        update_feed(feed, source, options, state)
+    finally :
+      if state :
+        state.close()
+      lock.release()
+
+  # Save the statistics
+  write_stats(stats, filename, options)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Measures the cost of MessageFeed.contains_message() for growing feeds.
+
+  For every feed size, a feed with that many entries is built, and the
+  average time of a lookup of a message that is in the feed (hit) and of a
+  message that is not (miss) is reported. With the entry index, both should
+  stay flat as the number of entries grows.
+
+  Usage: bench_lookup.py [size ...]
+"""
+
+import sys, os, time, tempfile, logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import atomail, corpus
+
+DEFAULT_SIZES = [10, 100, 1000, 2500, 5000]
+LOOKUPS = 2000
+
+def make_message(i) :
+  return atomail.parse_message(corpus.simple_message(i))
+
+def measure(feed, messages) :
+  start = time.time()
+  for i in range(LOOKUPS) :
+    feed.contains_message(messages[i % len(messages)])
+  return (time.time() - start) / LOOKUPS * 1e6
+
+def run(size) :
+  directory = tempfile.mkdtemp()
+  filename = os.path.join(directory, 'feed.xml')
+  feed = atomail.MessageFeed(filename, 'http://example.com/feed.xml', 'Benchmark', size, -1, False)
+  for i in range(size) :
+    feed.add_message(make_message(i))
+  hits = [make_message(i) for i in range(0, size, max(1, size // 100))]
+  misses = [make_message(size + i) for i in range(100)]
+  result = (measure(feed, hits), measure(feed, misses))
+  os.rmdir(directory)
+  return result
+
+if __name__ == "__main__" :
+  logging.getLogger().setLevel(logging.ERROR)
+  sizes = [int(x) for x in sys.argv[1:]] or DEFAULT_SIZES
+  print('%10s %15s %15s' % ('entries', 'hit (us)', 'miss (us)'))
+  for size in sizes :
+    (hit, miss) = run(size)
+    print('%10d %15.1f %15.1f' % (size, hit, miss))
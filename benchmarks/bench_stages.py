@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Measures the cost of the stages of a feed update.
+
+  Feed stages, for every feed size:
+    load      Reading the feed file
+    contains  MessageFeed.contains_message(), for messages that are in the
+              feed and messages that are not
+    add       MessageFeed.add_message(), per message
+    trim      MessageFeed.trim_entries(), after adding messages
+    save      MessageFeed.save(), after adding messages
+  Source stages, for every source:
+    mbox, maildir, imap, pop3, nntp
+              Retrieving the messages of a generated corpus, per message.
+              The network sources use the servers of stubservers.py, with
+              the given latency for every command.
+
+  Every stage runs in a separate (forked) process, so that its peak memory
+  can be measured as well. For every stage, the throughput, the latency
+  percentiles, and the peak memory are reported. With --output, the results
+  are saved as JSON, which compare.py can compare with earlier results.
+
+  Usage: bench_stages.py [options]
+"""
+
+import sys, os, time, json, shutil, tempfile, logging, resource, optparse, platform, subprocess, traceback, mailbox
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+import atomail, corpus, stubservers
+
+FEED_STAGES = ['load', 'contains', 'add', 'trim', 'save']
+SOURCE_STAGES = ['mbox', 'maildir', 'imap', 'pop3', 'nntp']
+VERBOSE = False
+
+def progress(text) :
+  if VERBOSE :
+    sys.stderr.write(text + '\n')
+
+################################################################################
+# Measurements
+################################################################################
+
+def percentile(values, fraction) :
+  values = sorted(values)
+  if not values :
+    return 0.0
+  return values[int(round(fraction * (len(values) - 1)))]
+
+def summarize(stage, parameters, result) :
+  """Turns the timings of a stage into its report"""
+  timings = result.pop('timings')
+  total = sum(timings)
+  summary = {
+      'stage' : stage,
+      'parameters' : parameters,
+      'operations' : len(timings),
+      'total' : total,
+      'throughput' : len(timings) / total if total else 0.0,
+      'mean' : total / len(timings) if timings else 0.0,
+      'p50' : percentile(timings, 0.5),
+      'p90' : percentile(timings, 0.9),
+      'p99' : percentile(timings, 0.99),
+      'max' : max(timings or [0.0]) }
+  summary.update(result)
+  return summary
+
+def isolated(function, *args) :
+  """Runs a function in a forked process, and returns its result (a
+  dictionary), with the peak memory of the process added to it"""
+  (input, output) = os.pipe()
+  pid = os.fork()
+  if pid == 0 :
+    os.close(input)
+    try :
+      start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      result = function(*args)
+      peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      result['peak_memory_kb'] = peak_memory
+      result['memory_growth_kb'] = peak_memory - start_memory
+      data = json.dumps(result).encode('utf-8')
+    except Exception :
+      data = json.dumps({'error' : traceback.format_exc()}).encode('utf-8')
+    while data :
+      data = data[os.write(output, data):]
+    os._exit(0)
+  os.close(output)
+  chunks = []
+  while True :
+    chunk = os.read(input, 65536)
+    if not chunk :
+      break
+    chunks.append(chunk)
+  os.close(input)
+  os.waitpid(pid, 0)
+  result = json.loads(b''.join(chunks).decode('utf-8'))
+  if 'error' in result :
+    raise RuntimeError(result['error'])
+  return result
+
+def timed(function, *args) :
+  start = time.time()
+  function(*args)
+  return time.time() - start
+
+################################################################################
+# Feed stages
+################################################################################
+
+def open_feed(filename, max_items=-1) :
+  return atomail.MessageFeed(filename, 'http://example.com/feed.xml', 'Benchmark', max_items, -1, False)
+
+def build_feed(filename, messages) :
+  feed = open_feed(filename)
+  for text in messages :
+    feed.add_message(atomail.parse_message(text))
+  feed.save()
+  return {}
+
+def stage_load(filename, options) :
+  timings = []
+  for i in range(options.repeat) :
+    start = time.time()
+    feed = open_feed(filename)
+    timings.append(time.time() - start)
+    del feed
+  return {'timings' : timings, 'bytes' : os.path.getsize(filename)}
+
+def stage_contains(filename, options, hits, misses) :
+  feed = open_feed(filename)
+  messages = [atomail.parse_message(text) for text in hits + misses]
+  timings = [timed(feed.contains_message, message) for message in messages]
+  return {'timings' : timings}
+
+def stage_add(filename, options, new) :
+  feed = open_feed(filename)
+  messages = [atomail.parse_message(text) for text in new]
+  timings = [timed(feed.add_message, message) for message in messages]
+  return {'timings' : timings, 'bytes' : sum([len(text) for text in new])}
+
+def stage_trim(filename, options, new, size) :
+  timings = []
+  for i in range(options.repeat) :
+    feed = open_feed(filename, size)
+    for text in new :
+      feed.add_message(atomail.parse_message(text))
+    timings.append(timed(feed.trim_entries))
+  return {'timings' : timings}
+
+def stage_save(filename, options, new, size) :
+  timings = []
+  copy = filename + '.copy'
+  for i in range(options.repeat) :
+    shutil.copyfile(filename, copy)
+    feed = open_feed(copy, size)
+    for text in new :
+      feed.add_message(atomail.parse_message(text))
+    timings.append(timed(feed.save))
+  result = {'timings' : timings, 'bytes' : os.path.getsize(copy)}
+  os.remove(copy)
+  return result
+
+def run_feed_stages(directory, options, stages) :
+  results = []
+  new = corpus.messages(options.messages, options.complexity, options.charsets.split(','), seed=options.seed + 1)
+  for size in options.sizes :
+    progress('Building feed of ' + str(size) + ' entries')
+    messages = corpus.messages(size, 'plain', options.charsets.split(','), seed=options.seed, body_size=options.body_size)
+    filename = os.path.join(directory, 'feed-' + str(size) + '.xml')
+    isolated(build_feed, filename, messages)
+    step = max(1, size // 100)
+    hits = messages[::step]
+    misses = new[:len(hits)]
+    parameters = {'size' : size}
+    for stage in stages :
+      progress('Measuring ' + stage + ' for ' + str(size) + ' entries')
+      if stage == 'load' :
+        result = isolated(stage_load, filename, options)
+      elif stage == 'contains' :
+        result = isolated(stage_contains, filename, options, hits, misses)
+      elif stage == 'add' :
+        result = isolated(stage_add, filename, options, new)
+      elif stage == 'trim' :
+        result = isolated(stage_trim, filename, options, new, size)
+      else :
+        result = isolated(stage_save, filename, options, new, size)
+      results.append(summarize(stage, parameters, result))
+  return results
+
+################################################################################
+# Source stages
+################################################################################
+
+def retrieve(source) :
+  """Retrieves all the messages of a source, and returns the time it took to
+  get every message"""
+  timings = []
+  start = time.time()
+  for message in source.messages() :
+    now = time.time()
+    timings.append(now - start)
+    start = now
+  return timings
+
+def stage_source(stage, path, options, messages) :
+  server = None
+  if stage in ('imap', 'pop3', 'nntp') :
+    server_type = {'imap' : stubservers.IMAPServer, 'pop3' : stubservers.POP3Server, 'nntp' : stubservers.NNTPServer}[stage]
+    server = server_type(messages, latency=options.latency).start()
+  try :
+    start = time.time()
+    if stage == 'mbox' :
+      source = atomail.MailboxSource(path, mailbox.mbox)
+    elif stage == 'maildir' :
+      source = atomail.MailboxSource(path, mailbox.Maildir)
+    elif stage == 'imap' :
+      source = atomail.IMAPSource('127.0.0.1', server.port, 'user', 'password', None)
+    elif stage == 'pop3' :
+      source = atomail.POP3Source('127.0.0.1', server.port, 'user', 'password')
+    else :
+      source = atomail.NNTPSource('127.0.0.1', server.port, 'group', None, None, max_articles=0)
+    connect = time.time() - start
+    result = {'timings' : retrieve(source), 'connect' : connect, 'bytes' : sum([len(text) for text in messages])}
+    if server :
+      result['commands'] = server.commands
+    return result
+  finally :
+    if server :
+      server.stop()
+
+def run_source_stages(directory, options, stages) :
+  results = []
+  messages = corpus.messages(options.messages, options.complexity, options.charsets.split(','), seed=options.seed, body_size=options.body_size)
+  mbox = os.path.join(directory, 'corpus.mbox')
+  corpus.write_mbox(mbox, messages)
+  maildir = os.path.join(directory, 'corpus')
+  corpus.write_maildir(maildir, messages)
+  for stage in stages :
+    progress('Measuring source ' + stage)
+    parameters = {'messages' : options.messages, 'complexity' : options.complexity, 'charsets' : options.charsets}
+    if stage in ('imap', 'pop3', 'nntp') :
+      parameters['latency'] = options.latency
+    path = {'mbox' : mbox, 'maildir' : maildir}.get(stage)
+    results.append(summarize(stage, parameters, isolated(stage_source, stage, path, options, messages)))
+  return results
+
+################################################################################
+# Reports
+################################################################################
+
+def revision() :
+  """Returns the Git revision of the benchmarked code, if it is known"""
+  try :
+    process = subprocess.Popen(['git', 'describe', '--always', '--dirty'], cwd=BENCHMARKS_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode == 0 :
+      return output.decode('utf-8').strip()
+  except OSError :
+    pass
+  return None
+
+def format_parameters(parameters) :
+  return ','.join([name + '=' + str(parameters[name]) for name in sorted(parameters)])
+
+def print_results(results) :
+  print('%-10s %-40s %8s %12s %10s %10s %10s %10s' % ('stage', 'parameters', 'ops', 'ops/s', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'peak (MB)'))
+  for result in results :
+    print('%-10s %-40s %8d %12.1f %10.3f %10.3f %10.3f %10.1f' % (result['stage'], format_parameters(result['parameters']), result['operations'], result['throughput'], result['p50'] * 1000, result['p90'] * 1000, result['p99'] * 1000, result['peak_memory_kb'] / 1024.0))
+
+if __name__ == "__main__" :
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('', '--sizes', default='100,1000,5000', help='The feed sizes for the feed stages. Default: %default')
+  parser.add_option('-n', '--messages', type='int', default=200, help='The number of messages to add, and in the corpus of the sources. Default: %default')
+  parser.add_option('-c', '--complexity', type='choice', choices=corpus.COMPLEXITIES, default='mixed', help='The MIME structure of the messages (' + ','.join(corpus.COMPLEXITIES) + '). Default: %default')
+  parser.add_option('', '--charsets', default=','.join(corpus.DEFAULT_CHARSETS), help='The charsets of the messages, used in turn. Default: %default')
+  parser.add_option('', '--body-size', type='int', default=2000, help='The average size of a message body. Default: %default')
+  parser.add_option('', '--latency', type='float', default=0.001, help='The latency of every command of the network sources, in seconds. Default: %default')
+  parser.add_option('-r', '--repeat', type='int', default=5, help='The number of times the load, trim and save stages are measured. Default: %default')
+  parser.add_option('', '--stages', default=','.join(FEED_STAGES + SOURCE_STAGES), help='The stages to measure. Default: %default')
+  parser.add_option('', '--seed', type='int', default=0, help='The seed of the corpus generator. Default: %default')
+  parser.add_option('-o', '--output', metavar='FILE', help='Save the results as JSON to FILE')
+  parser.add_option('-v', '--verbose', action='store_true', default=False, help='Report progress')
+  (options, args) = parser.parse_args()
+  options.sizes = [int(size) for size in options.sizes.split(',')]
+  stages = options.stages.split(',')
+  for stage in stages :
+    if stage not in FEED_STAGES + SOURCE_STAGES :
+      parser.error('Unknown stage ' + stage)
+
+  logging.getLogger().setLevel(logging.ERROR)
+  VERBOSE = options.verbose
+
+  directory = tempfile.mkdtemp()
+  try :
+    results = run_feed_stages(directory, options, [stage for stage in stages if stage in FEED_STAGES])
+    results += run_source_stages(directory, options, [stage for stage in stages if stage in SOURCE_STAGES])
+  finally :
+    shutil.rmtree(directory)
+  print_results(results)
+  if options.output :
+    report = {
+        'version' : atomail.__version__,
+        'revision' : revision(),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options' : dict([(name, getattr(options, name)) for name in ('sizes', 'messages', 'complexity', 'charsets', 'body_size', 'latency', 'repeat', 'seed')]),
+        'results' : results }
+    out = open(options.output, 'w')
+    try :
+      json.dump(report, out, indent=2, sort_keys=True)
+    finally :
+      out.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Measures the cost of a single pipe mode delivery, as seen by the mail
+  delivery agent.
+
+  Modes:
+    cli     Running atomail.py for every message
+    client  Running atomail-deliver.py for every message, with a delivery
+            daemon (atomail.py --listen) that adds the messages to the feed
+            after they are delivered
+
+  For every feed size, a feed with that many entries is built, and the
+  given number of messages is delivered to it, one process per message.
+  For every mode, the throughput and the latency percentiles of a delivery
+  are reported, and the number of delivered messages that ended up in the
+  feed (after the daemon stopped).
+
+  Usage: bench_startup.py [options]
+"""
+
+import sys, os, time, shutil, signal, tempfile, logging, optparse, subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+import atomail, corpus
+
+MODES = ['cli', 'client']
+
+def percentile(values, fraction) :
+  values = sorted(values)
+  return values[int(round(fraction * (len(values) - 1)))]
+
+def build_feed(filename, messages) :
+  feed = atomail.MessageFeed(filename, 'http://example.com/feed.xml', 'Benchmark', -1, -1, False)
+  for text in messages :
+    feed.add_message(atomail.parse_message(text))
+  feed.save()
+
+def wait_for(path, timeout=10) :
+  start = time.time()
+  while not os.path.exists(path) :
+    if time.time() - start > timeout :
+      raise RuntimeError('Daemon did not start')
+    time.sleep(0.01)
+
+def deliver(command, text, env) :
+  """Runs a delivery process, and returns the time it took"""
+  start = time.time()
+  process = subprocess.Popen(command, stdin=subprocess.PIPE, env=env)
+  process.communicate(text)
+  if process.returncode != 0 :
+    raise RuntimeError('Delivery failed: ' + ' '.join(command))
+  return time.time() - start
+
+def run(mode, directory, size, messages, options) :
+  filename = os.path.join(directory, mode + '-' + str(size) + '.xml')
+  build_feed(filename, corpus.messages(size, 'plain', seed=options.seed, body_size=options.body_size))
+  arguments = ['--max-items=' + str(size + len(messages)), filename]
+  env = dict(os.environ)
+  daemon = None
+  if mode == 'client' :
+    env['ATOMAIL_SOCKET'] = os.path.join(directory, 'socket')
+    daemon = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'atomail.py'), '-q', '--listen', env['ATOMAIL_SOCKET'], '--debounce=' + str(options.debounce)])
+    wait_for(env['ATOMAIL_SOCKET'])
+    command = [sys.executable, os.path.join(ROOT_DIR, 'atomail-deliver.py')] + arguments
+  else :
+    command = [sys.executable, os.path.join(ROOT_DIR, 'atomail.py'), '-q'] + arguments
+  try :
+    timings = [deliver(command, text, env) for text in messages]
+  finally :
+    if daemon :
+      # The daemon saves the feed when it stops
+      daemon.send_signal(signal.SIGTERM)
+      daemon.wait()
+  feed = atomail.MessageFeed(filename, 'http://example.com/feed.xml', 'Benchmark', -1, -1, False)
+  return {
+      'mode' : mode,
+      'size' : size,
+      'deliveries' : len(timings),
+      'throughput' : len(timings) / sum(timings),
+      'p50' : percentile(timings, 0.5),
+      'p90' : percentile(timings, 0.9),
+      'max' : max(timings),
+      'added' : len(feed.entries) - size }
+
+if __name__ == "__main__" :
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('', '--sizes', default='10,1000', help='The sizes of the feed. Default: %default')
+  parser.add_option('-n', '--messages', type='int', default=50, help='The number of messages to deliver. Default: %default')
+  parser.add_option('', '--modes', default=','.join(MODES), help='The modes to measure. Default: %default')
+  parser.add_option('', '--debounce', type='int', default=1, help='The debounce time of the daemon. Default: %default')
+  parser.add_option('', '--body-size', type='int', default=2000, help='The average size of a message body. Default: %default')
+  parser.add_option('', '--seed', type='int', default=0, help='The seed of the corpus generator. Default: %default')
+  (options, args) = parser.parse_args()
+  modes = options.modes.split(',')
+  for mode in modes :
+    if mode not in MODES :
+      parser.error('Unknown mode ' + mode)
+
+  logging.getLogger().setLevel(logging.ERROR)
+  # The generated Message-IDs only depend on the index of a message
+  messages = [text.replace(b'Message-ID: <message', b'Message-ID: <delivered') for text in corpus.messages(options.messages, 'plain', seed=options.seed + 1, body_size=options.body_size)]
+  directory = tempfile.mkdtemp()
+  try :
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')] :
+      for mode in modes :
+        results.append(run(mode, directory, size, messages, options))
+  finally :
+    shutil.rmtree(directory)
+  print('%-8s %8s %10s %10s %10s %10s %10s %8s' % ('mode', 'entries', 'messages', 'ops/s', 'p50 (ms)', 'p90 (ms)', 'max (ms)', 'added'))
+  for result in results :
+    print('%-8s %8d %10d %10.1f %10.1f %10.1f %10.1f %8d' % (result['mode'], result['size'], result['deliveries'], result['throughput'], result['p50'] * 1000, result['p90'] * 1000, result['max'] * 1000, result['added']))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Compares two sets of results of bench_stages.py.
+
+  For every stage that is in both sets, the median latencies and the peak
+  memory are shown, together with the ratio between the new and the old
+  median. Stages that got slower by more than the threshold are marked, and
+  make the script exit with a non-zero status.
+
+  Usage: compare.py [options] OLD.json NEW.json
+"""
+
+import sys, json, optparse
+
+def load(filename) :
+  file = open(filename)
+  try :
+    report = json.load(file)
+  finally :
+    file.close()
+  results = {}
+  for result in report['results'] :
+    results[(result['stage'], tuple(sorted(result['parameters'].items())))] = result
+  return (report, results)
+
+def format_parameters(parameters) :
+  return ','.join([name + '=' + str(value) for (name, value) in parameters])
+
+if __name__ == "__main__" :
+  parser = optparse.OptionParser(usage='%prog [options] OLD.json NEW.json')
+  parser.add_option('-t', '--threshold', type='float', default=0.1, help='The relative slowdown that counts as a regression. Default: %default')
+  (options, args) = parser.parse_args()
+  if len(args) != 2 :
+    parser.error('Result files missing')
+  (old_report, old) = load(args[0])
+  (new_report, new) = load(args[1])
+  print('old: ' + str(old_report.get('revision')) + ' (' + old_report['time'] + ', Python ' + old_report['python'] + ')')
+  print('new: ' + str(new_report.get('revision')) + ' (' + new_report['time'] + ', Python ' + new_report['python'] + ')')
+  print('%-10s %-40s %12s %12s %8s %10s %10s' % ('stage', 'parameters', 'old p50 (ms)', 'new p50 (ms)', 'ratio', 'old (MB)', 'new (MB)'))
+  regressions = 0
+  for key in sorted(old) :
+    if key not in new :
+      continue
+    (before, after) = (old[key], new[key])
+    ratio = after['p50'] / before['p50'] if before['p50'] else 1.0
+    mark = ''
+    if ratio > 1 + options.threshold :
+      mark = ' REGRESSION'
+      regressions += 1
+    print('%-10s %-40s %12.3f %12.3f %8.2f %10.1f %10.1f%s' % (key[0], format_parameters(key[1]), before['p50'] * 1000, after['p50'] * 1000, ratio, before['peak_memory_kb'] / 1024.0, after['peak_memory_kb'] / 1024.0, mark))
+  if regressions :
+    sys.exit(str(regressions) + ' stage(s) got slower')
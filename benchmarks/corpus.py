@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Generates synthetic mail corpora for the benchmarks.
+
+  The messages are generated from a seed, so the same parameters always
+  give the same corpus. The complexity of the messages is one of:
+    plain        A single text/plain part
+    alternative  A text/plain and a text/html alternative
+    attachments  An alternative body, an inline image, and a binary
+                 attachment
+    mixed        A mix of all of the above
+  The bodies are encoded in one of the given charsets, in turn.
+
+  Usage: corpus.py [options] mbox|maildir PATH
+"""
+
+import sys, os, random, optparse, time, email.utils
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+from email.mime.application import MIMEApplication
+from email.header import Header
+
+COMPLEXITIES = ['plain', 'alternative', 'attachments', 'mixed']
+DEFAULT_CHARSETS = ['us-ascii', 'utf-8', 'iso-8859-1']
+START_TIME = 1451606400 # 2016-01-01
+
+WORDS = [u'mail', u'feed', u'message', u'server', u'list', u'patch', u'release', u'build',
+  u'thread', u'reply', u'archive', u'question', u'answer', u'problem', u'fix']
+ACCENTED_WORDS = [u'café', u'naïve', u'über', u'façade', u'smörgåsbord', u'déjà']
+
+def sentence(rng, count, charset) :
+  words = WORDS
+  if charset != 'us-ascii' :
+    words = WORDS + ACCENTED_WORDS
+  return u' '.join([rng.choice(words) for i in range(count)])
+
+def body_text(rng, charset, size) :
+  lines = []
+  length = 0
+  while length < size :
+    line = sentence(rng, rng.randint(5, 12), charset)
+    lines.append(line)
+    length += len(line) + 1
+  return u'\n'.join(lines) + u'\n'
+
+def text_part(text, subtype, charset) :
+  if sys.version_info[0] >= 3 :
+    return MIMEText(text, subtype, charset)
+  return MIMEText(text.encode(charset), subtype, charset)
+
+def random_bytes(rng, count) :
+  return bytes(bytearray([rng.randint(0, 255) for i in range(count)]))
+
+def message(index, rng, complexity, charset, body_size=2000) :
+  """Returns a generated message (as bytes)"""
+  if complexity == 'mixed' :
+    complexity = rng.choice(COMPLEXITIES[:-1])
+  text = body_text(rng, charset, rng.randint(body_size // 2, body_size * 3 // 2))
+  html = u'<html><body>\n<p>' + text.replace(u'\n', u'</p>\n<p>') + u'</p>\n</body></html>'
+  if complexity == 'plain' :
+    result = text_part(text, 'plain', charset)
+  else :
+    result = MIMEMultipart('alternative')
+    result.attach(text_part(text, 'plain', charset))
+    if complexity == 'attachments' :
+      related = MIMEMultipart('related')
+      related.attach(text_part(html + u'<img src="cid:image' + str(index) + u'@example.com">', 'html', charset))
+      image = MIMEImage(b'GIF89a' + random_bytes(rng, 2048), 'gif')
+      image['Content-ID'] = '<image' + str(index) + '@example.com>'
+      related.attach(image)
+      result.attach(related)
+      body = result
+      result = MIMEMultipart('mixed')
+      result.attach(body)
+      attachment = MIMEApplication(random_bytes(rng, rng.randint(10000, 200000)), 'pdf')
+      attachment.add_header('Content-Disposition', 'attachment', filename='document' + str(index) + '.pdf')
+      result.attach(attachment)
+    else :
+      result.attach(text_part(html, 'html', charset))
+  sender = rng.randint(0, 50)
+  result['From'] = Header(u'Sender ' + sentence(rng, 1, charset).title(), charset).encode() + ' <sender' + str(sender) + '@example.com>'
+  result['Subject'] = Header(u'[list] ' + sentence(rng, rng.randint(3, 8), charset), charset).encode()
+  result['Date'] = email.utils.formatdate(START_TIME + index * 600 + rng.randint(0, 300), localtime=False)
+  result['Message-ID'] = '<message' + str(index) + '@example.com>'
+  if sys.version_info[0] >= 3 :
+    return result.as_bytes()
+  return result.as_string()
+
+def simple_message(number, subject=None, date=None, headers='') :
+  """Returns a plain message (as bytes) with Message-ID <number@example.com>.
+  Without a subject or date, ones derived from the number are used. A date of
+  False leaves out the Date header."""
+  if subject is None :
+    subject = 'Message %d' % number
+  if date is None :
+    date = email.utils.formatdate(START_TIME + number * 600, localtime=False)
+  return (
+      'From: Sender <sender@example.com>\n'
+      'Subject: ' + subject + '\n' +
+      ('Date: ' + date + '\n' if date is not False else '') +
+      'Message-ID: <%d@example.com>\n' % number + headers +
+      '\n'
+      'Body %d\n' % number).encode('ascii')
+
+def messages(count, complexity='plain', charsets=DEFAULT_CHARSETS, seed=0, body_size=2000) :
+  """Returns a list of generated messages (as bytes), oldest first"""
+  rng = random.Random(seed)
+  return [message(i, rng, complexity, charsets[i % len(charsets)], body_size) for i in range(count)]
+
+def write_mbox(path, messages) :
+  """Writes messages to an mbox file"""
+  out = open(path, 'wb')
+  try :
+    for (i, text) in enumerate(messages) :
+      out.write(('From sender@example.com ' + time.asctime(time.gmtime(START_TIME + i * 600)) + '\n').encode('ascii'))
+      # Escape From_ lines in the bodies
+      out.write(text.replace(b'\nFrom ', b'\n>From ').rstrip(b'\n') + b'\n\n')
+  finally :
+    out.close()
+
+def write_maildir(path, messages) :
+  """Writes messages to a Maildir directory (in order of modification time)"""
+  for directory in ('new', 'cur', 'tmp') :
+    if not os.path.isdir(os.path.join(path, directory)) :
+      os.makedirs(os.path.join(path, directory))
+  for (i, text) in enumerate(messages) :
+    filename = os.path.join(path, 'new', str(START_TIME + i) + '.' + str(i) + '.example')
+    out = open(filename, 'wb')
+    try :
+      out.write(text)
+    finally :
+      out.close()
+    os.utime(filename, (START_TIME + i, START_TIME + i))
+
+if __name__ == "__main__" :
+  parser = optparse.OptionParser(usage='%prog [options] mbox|maildir PATH')
+  parser.add_option('-n', '--count', type='int', default=1000, help='The number of messages. Default: %default')
+  parser.add_option('-c', '--complexity', type='choice', choices=COMPLEXITIES, default='plain', help='The MIME structure of the messages (' + ','.join(COMPLEXITIES) + '). Default: %default')
+  parser.add_option('', '--charsets', default=','.join(DEFAULT_CHARSETS), help='The charsets of the messages. Default: %default')
+  parser.add_option('', '--body-size', type='int', default=2000, help='The average size of a message body. Default: %default')
+  parser.add_option('', '--seed', type='int', default=0, help='The seed of the generator. Default: %default')
+  (options, args) = parser.parse_args()
+  if len(args) != 2 or args[0] not in ('mbox', 'maildir') :
+    parser.error('Type and path missing')
+  corpus = messages(options.count, options.complexity, options.charsets.split(','), options.seed, options.body_size)
+  if args[0] == 'mbox' :
+    write_mbox(args[1], corpus)
+  else :
+    write_maildir(args[1], corpus)
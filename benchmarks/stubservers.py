@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+  Minimal in-process IMAP, POP3 and NNTP servers.
+
+  The servers serve a list of messages (as raw bytes, oldest first), 
+  implement just enough of their protocol for AtoMail's sources, and can
+  add a fixed latency to every command, to simulate a remote server. The
+  number of commands a server handled is kept in its commands attribute.
+
+  Usage:
+    server = IMAPServer(messages, latency=0.01).start()
+    ... connect to 127.0.0.1:server.port ...
+    server.stop()
+"""
+
+import sys, re, time, threading, socket, select, email.utils
+
+try :
+  import socketserver
+except ImportError :
+  import SocketServer as socketserver
+
+def to_bytes(text) :
+  """Converts protocol text to bytes"""
+  if isinstance(text, bytes) :
+    return text
+  return text.encode('latin-1')
+
+def to_text(data) :
+  """Converts protocol bytes to text"""
+  if isinstance(data, str) :
+    return data
+  return data.decode('latin-1')
+
+def split_message(data) :
+  """Splits a raw message into its header and body"""
+  index = data.find(b'\n\n')
+  if index < 0 :
+    return (data, b'')
+  return (data[:index + 1], data[index + 2:])
+
+def message_header(data, name) :
+  """Returns the (unfolded) value of a header of a raw message"""
+  header = split_message(data)[0]
+  m = re.search(b'(?im)^' + to_bytes(name) + b':[ \t]*(.*(?:\n[ \t].*)*)', header)
+  if m :
+    return re.sub(b'\n[ \t]+', b' ', m.group(1)).strip()
+  return b''
+
+def crlf(data) :
+  """Converts the line endings of a raw message to CRLF"""
+  return re.sub(b'\r?\n', b'\r\n', data)
+
+
+class StubHandler(socketserver.StreamRequestHandler) :
+  # Every response is written one line at a time. With Nagle's algorithm,
+  # every command would wait for a delayed ACK of the client.
+  disable_nagle_algorithm = True
+
+  def send(self, line) :
+    self.wfile.write(to_bytes(line) + b'\r\n')
+
+  def read_command(self) :
+    line = self.rfile.readline()
+    if not line :
+      return None
+    if self.server.latency :
+      time.sleep(self.server.latency)
+    self.server.commands += 1
+    return to_text(line).rstrip('\r\n')
+
+
+class StubServer(socketserver.ThreadingMixIn, socketserver.TCPServer) :
+  """Base class for the stub servers"""
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def handle_error(self, request, client_address) :
+    # Clients that disconnect without logging out are not an error
+    if not isinstance(sys.exc_info()[1], socket.error) :
+      socketserver.TCPServer.handle_error(self, request, client_address)
+
+  def __init__(self, messages, latency=0) :
+    socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), self.handler)
+    self.messages = messages
+    self.latency = latency
+    self.commands = 0
+    self.lock = threading.Condition()
+
+  @property
+  def port(self) :
+    return self.server_address[1]
+
+  def start(self) :
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self) :
+    self.shutdown()
+    self.server_close()
+
+  def append(self, data) :
+    with self.lock :
+      self.messages.append(data)
+      self.lock.notify_all()
+
+
+################################################################################
+# POP3
+################################################################################
+
+class POP3Handler(StubHandler) :
+  def send_multiline(self, data) :
+    for line in crlf(data).split(b'\r\n') :
+      if line.startswith(b'.') :
+        line = b'.' + line
+      self.wfile.write(line + b'\r\n')
+    self.wfile.write(b'.\r\n')
+
+  def handle(self) :
+    messages = list(self.server.messages)
+    self.send('+OK stub POP3 server ready')
+    while True :
+      command = self.read_command()
+      if command is None :
+        return
+      words = command.split()
+      verb = words[0].upper() if words else ''
+      if verb in ('USER', 'PASS', 'NOOP', 'RSET') :
+        self.send('+OK')
+      elif verb == 'STAT' :
+        self.send('+OK %d %d' % (len(messages), sum([len(m) for m in messages])))
+      elif verb in ('LIST', 'UIDL') and len(words) == 1 :
+        self.send('+OK')
+        for (i, message) in enumerate(messages) :
+          if verb == 'LIST' :
+            self.send('%d %d' % (i + 1, len(message)))
+          else :
+            self.send('%d uid-%d' % (i + 1, self.server.uid(message)))
+        self.send('.')
+      elif verb in ('RETR', 'TOP') and len(words) >= 2 and 0 < int(words[1]) <= len(messages) :
+        message = messages[int(words[1]) - 1]
+        self.send('+OK %d octets' % len(message))
+        if verb == 'TOP' :
+          (header, body) = split_message(message)
+          lines = int(words[2]) if len(words) > 2 else 0
+          message = header + b'\n' + b'\n'.join(body.split(b'\n')[:lines])
+        self.send_multiline(message.rstrip(b'\n'))
+      elif verb == 'QUIT' :
+        self.send('+OK bye')
+        return
+      else :
+        self.send('-ERR unknown command')
+
+
+class POP3Server(StubServer) :
+  handler = POP3Handler
+
+  def __init__(self, messages, latency=0) :
+    StubServer.__init__(self, messages, latency)
+    self.uids = {}
+
+  def uid(self, message) :
+    return self.uids.setdefault(id(message), len(self.uids) + 1)
+
+
+################################################################################
+# NNTP
+################################################################################
+
+class NNTPHandler(StubHandler) :
+  def send_multiline(self, data) :
+    for line in crlf(data).split(b'\r\n') :
+      if line.startswith(b'.') :
+        line = b'.' + line
+      self.wfile.write(line + b'\r\n')
+    self.wfile.write(b'.\r\n')
+
+  def article(self, number) :
+    first = self.server.first
+    if first <= number < first + len(self.server.messages) :
+      return self.server.messages[number - first]
+    return None
+
+  def handle(self) :
+    self.send('200 stub NNTP server ready')
+    while True :
+      command = self.read_command()
+      if command is None :
+        return
+      words = command.split()
+      verb = words[0].upper() if words else ''
+      first = self.server.first
+      last = first + len(self.server.messages) - 1
+      if verb == 'CAPABILITIES' :
+        self.send('101 Capability list:')
+        for capability in ('VERSION 2', 'READER', 'OVER', 'AUTHINFO USER') :
+          self.send(capability)
+        self.send('.')
+      elif verb == 'MODE' :
+        self.send('200 reader mode')
+      elif verb == 'AUTHINFO' :
+        if words[1].upper() == 'USER' :
+          self.send('381 password required')
+        else :
+          self.send('281 authenticated')
+      elif verb == 'GROUP' :
+        self.send('211 %d %d %d %s' % (len(self.server.messages), first, last, words[1]))
+      elif verb in ('XOVER', 'OVER') :
+        (start, _, end) = words[1].partition('-')
+        start = int(start)
+        end = int(end) if end else last
+        self.send('224 overview follows')
+        for number in range(max(start, first), min(end, last) + 1) :
+          message = self.article(number)
+          fields = [str(number).encode('ascii')] + [message_header(message, name) for name in ('Subject', 'From', 'Date', 'Message-ID', 'References')]
+          fields += [str(len(message)).encode('ascii'), str(message.count(b'\n')).encode('ascii')]
+          self.wfile.write(b'\t'.join(fields) + b'\r\n')
+        self.send('.')
+      elif verb in ('ARTICLE', 'HEAD', 'BODY', 'STAT') :
+        message = self.article(int(words[1]))
+        if message is None :
+          self.send('423 no such article')
+          continue
+        mid = to_text(message_header(message, 'Message-ID'))
+        (header, body) = split_message(message)
+        if verb == 'ARTICLE' :
+          self.send('220 %s %s' % (words[1], mid))
+          self.send_multiline(message.rstrip(b'\n'))
+        elif verb == 'HEAD' :
+          self.send('221 %s %s' % (words[1], mid))
+          self.send_multiline(header.rstrip(b'\n'))
+        elif verb == 'BODY' :
+          self.send('222 %s %s' % (words[1], mid))
+          self.send_multiline(body.rstrip(b'\n'))
+        else :
+          self.send('223 %s %s' % (words[1], mid))
+      elif verb == 'QUIT' :
+        self.send('205 bye')
+        return
+      else :
+        self.send('500 unknown command')
+
+
+class NNTPServer(StubServer) :
+  handler = NNTPHandler
+
+  def __init__(self, messages, latency=0, first=1) :
+    StubServer.__init__(self, messages, latency)
+    self.first = first
+
+
+################################################################################
+# IMAP
+################################################################################
+
+class IMAPHandler(StubHandler) :
+  def parse_set(self, text, maximum) :
+    result = set()
+    for part in text.split(',') :
+      (start, _, end) = part.partition(':')
+      start = maximum if start == '*' else int(start)
+      if not end :
+        end = start
+      end = maximum if end == '*' else int(end)
+      (start, end) = (min(start, end), max(start, end))
+      result.update(range(start, end + 1))
+    return result
+
+  def select(self, name) :
+    self.mailbox = self.server.mailboxes.get(name)
+    if self.mailbox is not None :
+      self.exists = len(self.mailbox['messages'])
+    return self.mailbox is not None
+
+  def send_exists(self) :
+    """Announces the number of messages if it changed"""
+    with self.server.lock :
+      if self.mailbox is not None and len(self.mailbox['messages']) != self.exists :
+        self.exists = len(self.mailbox['messages'])
+        self.send('* %d EXISTS' % self.exists)
+
+  def search(self, criteria, use_uid) :
+    messages = list(enumerate(self.mailbox['messages']))
+    result = []
+    words = criteria.split()
+    for (index, (uid, message)) in messages :
+      match = True
+      i = 0
+      while i < len(words) :
+        word = words[i].upper()
+        if word == 'UID' :
+          match = match and uid in self.parse_set(words[i + 1], messages[-1][1][0] if messages else 0)
+          i += 2
+        elif word == 'SINCE' :
+          since = time.mktime(time.strptime(words[i + 1], '%d-%b-%Y'))
+          date = email.utils.parsedate_tz(to_text(message_header(message, 'Date')))
+          match = match and date is not None and email.utils.mktime_tz(date) >= since - 86400
+          i += 2
+        else :
+          i += 1
+      if match :
+        result.append(uid if use_uid else index + 1)
+    return result
+
+  def fetch_items(self, index, uid, message, items, use_uid) :
+    parts = []
+    literals = []
+    if use_uid and 'UID' not in items.upper() :
+      items = 'UID ' + items
+    for m in re.finditer(r'(?i)(BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|RFC822\.SIZE|RFC822|UID|FLAGS|INTERNALDATE)', items) :
+      item = m.group(1).upper()
+      if item == 'UID' :
+        parts.append(b'UID ' + str(uid).encode('ascii'))
+      elif item == 'FLAGS' :
+        parts.append(b'FLAGS ()')
+      elif item == 'RFC822.SIZE' :
+        parts.append(b'RFC822.SIZE ' + str(len(message)).encode('ascii'))
+      elif item == 'INTERNALDATE' :
+        parts.append(b'INTERNALDATE "01-Jan-2016 00:00:00 +0000"')
+      else :
+        section = (m.group(2) or '').upper()
+        data = crlf(message)
+        if section.startswith('HEADER.FIELDS') :
+          names = re.findall(r'[\w-]+', section[len('HEADER.FIELDS'):])
+          data = b''.join([to_bytes(name) + b': ' + message_header(message, name) + b'\r\n' for name in names if message_header(message, name)]) + b'\r\n'
+        elif section == 'HEADER' :
+          data = crlf(split_message(message)[0]) + b'\r\n'
+        name = b'RFC822' if item == 'RFC822' else b'BODY[' + to_bytes(m.group(2) or '') + b']'
+        if m.group(3) :
+          start = int(m.group(3))
+          data = data[start:start + int(m.group(4))]
+          name += b'<' + to_bytes(m.group(3)) + b'>'
+        parts.append(name + b' {' + str(len(data)).encode('ascii') + b'}')
+        literals.append(data)
+    # Every literal ends a line of the response
+    response = b'* ' + str(index).encode('ascii') + b' FETCH ('
+    for part in parts :
+      if not response.endswith(b'(') and not response.endswith(b'\r\n') :
+        response += b' '
+      response += part
+      if part.endswith(b'}') :
+        response += b'\r\n' + literals.pop(0)
+    self.wfile.write(response + b')\r\n')
+
+  def idle(self, tag) :
+    self.send('+ idling')
+    # A read that timed out leaves rfile unusable, so wait with select
+    while not select.select([self.connection], [], [], 0.1)[0] :
+      self.send_exists()
+    self.rfile.readline()
+    self.send(tag + ' OK IDLE terminated')
+
+  def handle(self) :
+    self.mailbox = None
+    self.send('* OK [CAPABILITY IMAP4rev1 IDLE] stub IMAP server ready')
+    while True :
+      command = self.read_command()
+      if command is None :
+        return
+      m = re.match(r'(\S+) (?:(UID) )?(\S+) ?(.*)', command, re.I)
+      if not m :
+        self.send('* BAD')
+        continue
+      (tag, use_uid, verb, args) = (m.group(1), bool(m.group(2)), m.group(3).upper(), m.group(4))
+      if verb == 'CAPABILITY' :
+        self.send('* CAPABILITY IMAP4rev1 IDLE')
+        self.send(tag + ' OK completed')
+      elif verb in ('LOGIN', 'NOOP', 'CHECK', 'CLOSE') :
+        self.send_exists()
+        self.send(tag + ' OK completed')
+      elif verb == 'LIST' :
+        pattern = re.escape(args.split()[-1].strip('"')).replace('\\*', '.*').replace('\\%', '[^/]*')
+        for name in sorted(self.server.mailboxes) :
+          if re.match(pattern + '$', name) :
+            self.send('* LIST () "/" "' + name + '"')
+        self.send(tag + ' OK completed')
+      elif verb in ('SELECT', 'EXAMINE', 'STATUS') :
+        name = args.split(' (')[0].strip('"')
+        mailbox = self.server.mailboxes.get(name)
+        if mailbox is None :
+          self.send(tag + ' NO no such mailbox')
+          continue
+        messages = mailbox['messages']
+        uidnext = (messages[-1][0] + 1) if messages else 1
+        if verb == 'STATUS' :
+          self.send('* STATUS "%s" (MESSAGES %d UIDNEXT %d UIDVALIDITY %d)' % (name, len(messages), uidnext, mailbox['uidvalidity']))
+        else :
+          self.select(name)
+          self.send('* %d EXISTS' % len(messages))
+          self.send('* 0 RECENT')
+          self.send('* OK [UIDVALIDITY %d]' % mailbox['uidvalidity'])
+          self.send('* OK [UIDNEXT %d]' % uidnext)
+          self.send('* FLAGS (\\Seen)')
+        self.send(tag + ' OK ' + ('[READ-WRITE] ' if verb == 'SELECT' else '') + 'completed')
+      elif verb == 'SEARCH' :
+        self.send('* SEARCH ' + ' '.join([str(x) for x in self.search(args, use_uid)]))
+        self.send(tag + ' OK completed')
+      elif verb == 'FETCH' :
+        (sequence, items) = args.split(' ', 1)
+        messages = self.mailbox['messages']
+        if use_uid :
+          wanted = self.parse_set(sequence, messages[-1][0] if messages else 0)
+        else :
+          wanted = self.parse_set(sequence, len(messages))
+        for (index, (uid, message)) in enumerate(messages) :
+          if (uid if use_uid else index + 1) in wanted :
+            # Fetching a body without PEEK sets the \Seen flag
+            if re.search(r'(?i)BODY\[|RFC822(?!\.SIZE|\.HEADER)', items) :
+              self.server.seen.add(uid)
+            self.fetch_items(index + 1, uid, message, items, use_uid)
+        self.send(tag + ' OK completed')
+      elif verb == 'IDLE' :
+        self.idle(tag)
+      elif verb == 'LOGOUT' :
+        self.send('* BYE')
+        self.send(tag + ' OK completed')
+        return
+      else :
+        self.send(tag + ' BAD unknown command')
+
+
+class IMAPServer(StubServer) :
+  """An IMAP server.
+
+  The messages can be a list of raw messages (for a single INBOX), or a
+  dictionary of mailbox names to lists of raw messages."""
+
+  handler = IMAPHandler
+
+  def __init__(self, messages, latency=0) :
+    if not isinstance(messages, dict) :
+      messages = {'INBOX' : messages}
+    StubServer.__init__(self, messages, latency)
+    self.seen = set()
+    self.mailboxes = {}
+    for (name, contents) in messages.items() :
+      self.mailboxes[name] = {'uidvalidity' : 1000 + len(self.mailboxes), 'messages' : [(i * 2 + 1, m) for (i, m) in enumerate(contents)]}
+
+  def append(self, data, name='INBOX') :
+    with self.lock :
+      messages = self.mailboxes[name]['messages']
+      messages.append((messages[-1][0] + 2 if messages else 1, data))
+      self.lock.notify_all()
@@ -0,0 +1,8 @@
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# The tests and the benchmarks share one message template
+from corpus import simple_message as message
@@ -0,0 +1,36 @@
+import os
+
+import atomail
+from conftest import message
+
+def update(filename, numbers) :
+  feed = atomail.MessageFeed(filename, 'http://example.com/feed.xml', 'Feed', 1, -1, False, archive_size=2)
+  for number in numbers :
+    feed.add_message(atomail.parse_message(message(number)))
+  feed.save()
+
+def links(filename) :
+  feed = atomail.MessageFeed(filename, 'http://example.com/feed.xml', 'Feed', 0, -1, False)
+  return dict([(link.getAttribute('rel'), link.getAttribute('href')) for link in feed.doc.documentElement.getElementsByTagName('link')])
+
+def entries(filename) :
+  return len(atomail.FeedReader(filename).read()[1])
+
+
+def test_archive_pages(tmp_path) :
+  filename = str(tmp_path / 'feed.xml')
+  update(filename, [1, 2, 3])
+  assert entries(str(tmp_path / 'feed-1.xml')) == 2
+  assert not os.path.exists(str(tmp_path / 'feed-2.xml'))
+  assert links(filename)['prev-archive'] == 'http://example.com/feed-1.xml'
+
+  update(filename, [4, 5, 6, 7])
+  assert entries(filename) == 1
+  assert entries(str(tmp_path / 'feed-1.xml')) == 2
+  assert entries(str(tmp_path / 'feed-2.xml')) == 2
+  assert entries(str(tmp_path / 'feed-3.xml')) == 2
+  assert links(str(tmp_path / 'feed-1.xml'))['next-archive'] == 'http://example.com/feed-2.xml'
+  assert links(str(tmp_path / 'feed-2.xml'))['prev-archive'] == 'http://example.com/feed-1.xml'
+  assert links(str(tmp_path / 'feed-2.xml'))['next-archive'] == 'http://example.com/feed-3.xml'
+  assert 'next-archive' not in links(str(tmp_path / 'feed-3.xml'))
+  assert links(filename)['prev-archive'] == 'http://example.com/feed-3.xml'
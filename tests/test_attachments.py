@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import atomail
+
+
+def message(disposition) :
+  return atomail.parse_message(
+      b'From: Sender <sender@example.com>\n'
+      b'Subject: Attachment\n'
+      b'Date: Mon, 1 Jan 2024 10:00:00 +0000\n'
+      b'MIME-Version: 1.0\n'
+      b'Content-Type: multipart/mixed; boundary=X\n'
+      b'\n'
+      b'--X\n'
+      b'Content-Type: text/plain\n'
+      b'\n'
+      b'Body\n'
+      b'--X\n'
+      b'Content-Type: application/pdf\n'
+      b'Content-Disposition: ' + disposition + b'\n'
+      b'Content-Transfer-Encoding: base64\n'
+      b'\n'
+      b'JVBERi0=\n'
+      b'--X--\n')
+
+def enclosures(tmp_path, disposition) :
+  blobs = atomail.BlobStore(str(tmp_path / 'blobs'), 'http://example.com/blobs')
+  feed = atomail.MessageFeed(str(tmp_path / 'feed.xml'), 'http://example.com/feed.xml', 'Feed', 0, -1, False, blobs=blobs)
+  feed.add_message(message(disposition))
+  return [link for link in feed.entries[0].element.getElementsByTagName('link') if link.getAttribute('rel') == 'enclosure']
+
+
+@pytest.mark.parametrize('disposition', [
+    b"attachment; filename*=utf-8''caf%C3%A9.pdf",
+    b'attachment; filename="=?utf-8?q?caf=C3=A9.pdf?="'])
+def test_encoded_filename(tmp_path, disposition) :
+  (link,) = enclosures(tmp_path, disposition)
+  assert link.getAttribute('title') == u'café.pdf'
+  assert link.getAttribute('href').endswith('.pdf')
+
+def test_unsafe_filename(tmp_path) :
+  (link,) = enclosures(tmp_path, b'attachment; filename="shell.php"')
+  assert link.getAttribute('title') == 'shell.php'
+  assert link.getAttribute('href').endswith('.pdf')
+
+def test_large_content(tmp_path) :
+  blobs = atomail.BlobStore(str(tmp_path / 'blobs'), 'http://example.com/blobs')
+  feed = atomail.MessageFeed(str(tmp_path / 'feed.xml'), 'http://example.com/feed.xml', 'Feed', 0, -1, False, blobs=blobs, blob_threshold=10)
+  feed.add_message(message(b'inline'))
+  (content,) = feed.entries[0].element.getElementsByTagName('content')
+  assert content.getAttribute('type') == 'text/html'
+  assert content.getAttribute('src').endswith('.html')
+  with open(str(tmp_path / 'blobs' / content.getAttribute('src').split('/')[-1]), 'rb') as f :
+    assert f.read() == b'<pre>Body</pre>'
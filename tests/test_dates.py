@@ -0,0 +1,52 @@
+import datetime, os
+
+import pytest
+
+import atomail
+import conftest
+
+
+def message(number, date=False, headers='') :
+  return atomail.parse_message(conftest.message(number, date=date, headers=headers))
+
+def feed(tmp_path, max_items) :
+  return atomail.MessageFeed(str(tmp_path / 'feed.xml'), 'http://example.com/feed.xml', 'Feed', max_items, -1, False)
+
+
+def test_date() :
+  date = atomail.message_date(message(1, 'Mon, 1 Jan 2024 10:00:00 +0100'))
+  assert date.isoformat() == '2024-01-01T10:00:00+01:00'
+
+@pytest.mark.parametrize('text', ['2024-01-01T10:00:00+05:30', '2024-01-01T10:00:00-03:30', '2024-01-01T10:00:00Z'])
+def test_atom_date(text) :
+  date = atomail.from_atom_date(text)
+  assert date.isoformat() == text.replace('Z', '+00:00')
+  assert atomail.from_atom_date(date.isoformat()) == date
+
+def test_received_date() :
+  headers = (
+      'Received: from relay.example.com by mx.example.com;\n'
+      ' Tue, 2 Jan 2024 12:00:00 +0000\n'
+      'Received: from client by relay.example.com; Mon, 1 Jan 2024 12:00:00 +0000\n')
+  assert atomail.message_date(message(1, 'not a date', headers)).isoformat() == '2024-01-02T12:00:00+00:00'
+
+def test_missing_date() :
+  before = atomail.current_datetime() - datetime.timedelta(seconds=1)
+  assert atomail.message_date(message(0)) >= before
+  assert not atomail.message_outdated(message(0), before)
+
+def test_keep_undated_message(tmp_path) :
+  first = feed(tmp_path, 3)
+  for day in range(1, 4) :
+    first.add_message(message(day, 'Mon, %d Jan 2024 10:00:00 +0000' % day))
+  first.add_message(message(0))
+  first.save()
+  assert first.contains_message(message(0))
+  assert not first.contains_message(message(1, 'Mon, 1 Jan 2024 10:00:00 +0000'))
+
+  # The feed is not written again if the message is retrieved again
+  inode = os.stat(str(tmp_path / 'feed.xml')).st_ino
+  second = feed(tmp_path, 3)
+  assert second.contains_message(message(0))
+  second.save()
+  assert os.stat(str(tmp_path / 'feed.xml')).st_ino == inode
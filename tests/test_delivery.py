@@ -0,0 +1,55 @@
+import os, socket, stat, time
+
+import pytest
+
+import atomail
+from conftest import message
+
+
+@pytest.fixture
+def server(tmp_path) :
+  server = atomail.DeliveryServer(str(tmp_path / 'socket'), atomail.create_parser(), spool=str(tmp_path / 'spool'))
+  yield server
+  if server.socket :
+    server.socket.close()
+
+def deliver(server, directory, filename) :
+  """Sends a delivery to the server, and returns its answer"""
+  (client, connection) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+  try :
+    client.sendall(b'2\n' + directory.encode('utf-8') + b'\0' + filename.encode('utf-8') + b'\0' + message(1))
+    client.shutdown(socket.SHUT_WR)
+    server.receive(connection)
+    return client.recv(4096)
+  finally :
+    client.close()
+    connection.close()
+
+
+def test_socket_mode(server) :
+  server.listen()
+  assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+
+def test_delivery(tmp_path, server) :
+  assert deliver(server, str(tmp_path), 'feed.xml') == b'OK\n'
+  assert list(server.feeds.keys()) == [os.path.realpath(str(tmp_path / 'feed.xml'))]
+
+def test_unwritable_feed(tmp_path, server, monkeypatch) :
+  # The directory of the feed is only writable by its owner
+  os.chmod(str(tmp_path), 0o755)
+  monkeypatch.setattr(server, 'client_uid', lambda connection : os.getuid() + 1)
+  assert deliver(server, str(tmp_path), 'feed.xml').startswith(b'ERROR Permission denied')
+  assert not server.feeds
+
+def test_locked_feed(tmp_path, server) :
+  deliver(server, str(tmp_path), 'feed.xml')
+  (feed,) = server.feeds.values()
+  lock = atomail.FeedLock(feed.filename)
+  lock.acquire()
+  start = time.time()
+  server.flush(feed)
+  assert time.time() - start < server.LOCK_TIMEOUT + 1
+  assert feed.deadline and not os.path.exists(feed.filename)
+  lock.release()
+  server.flush(feed)
+  assert not feed.deadline and os.path.exists(feed.filename)
@@ -0,0 +1,48 @@
+import os, subprocess, sys, time
+
+import atomail
+
+
+def test_lock(tmp_path) :
+  filename = str(tmp_path / 'feed.xml')
+  lock = atomail.FeedLock(filename)
+  assert lock.acquire()
+  assert os.path.exists(filename + '.lock')
+  assert not atomail.FeedLock(filename).acquire(blocking=False)
+  lock.release()
+  assert not os.path.exists(filename + '.lock')
+
+def test_removed_lock(tmp_path, monkeypatch) :
+  filename = str(tmp_path / 'feed.xml')
+  first = atomail.FeedLock(filename)
+  assert first.acquire()
+  # Another process opens the lock file just before it is released, and 
+  # then locks the removed file
+  stale = open(filename + '.lock', 'a')
+  first.release()
+  files = [stale]
+  monkeypatch.setattr(atomail, 'open', lambda name, mode : files.pop() if files else open(name, mode), raising=False)
+  second = atomail.FeedLock(filename)
+  assert second.acquire()
+  assert stale.closed
+  assert os.path.exists(filename + '.lock')
+  assert not atomail.FeedLock(filename).acquire(blocking=False)
+  second.release()
+  assert not os.path.exists(filename + '.lock')
+
+def test_failed_update(tmp_path) :
+  filename = str(tmp_path / 'feed.xml')
+  script = os.path.join(os.path.dirname(os.path.abspath(atomail.__file__)), 'atomail.py')
+  # The mbox file is missing
+  assert subprocess.call([sys.executable, script, '--mode=mbox', '--file=' + str(tmp_path / 'missing'), filename], stderr=subprocess.PIPE) != 0
+  assert not os.path.exists(filename + '.lock')
+
+def test_lock_timeout(tmp_path) :
+  filename = str(tmp_path / 'feed.xml')
+  lock = atomail.FeedLock(filename)
+  lock.acquire()
+  start = time.time()
+  assert not atomail.FeedLock(filename).acquire(timeout=0.2)
+  assert time.time() - start >= 0.2
+  lock.release()
+  assert atomail.FeedLock(filename).acquire(timeout=0.2)
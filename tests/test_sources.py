@@ -0,0 +1,148 @@
+import os
+
+import pytest
+
+import atomail, stubservers
+from conftest import message
+
+
+def messages(first, last) :
+  return [message(number, 'Message %d\n with a folded subject' % number) for number in range(first, last + 1)]
+
+
+MODES = ['imap', 'imap-public', 'pop3', 'nntp']
+
+@pytest.fixture(params=MODES)
+def mode(request, monkeypatch) :
+  if request.param == 'nntp' and not atomail.nntplib :
+    pytest.skip('nntplib is not available')
+  if request.param == 'imap-public' :
+    # Without the internals of imaplib, commands are not pipelined
+    monkeypatch.setattr(atomail.IMAPSource, 'INTERNALS', False)
+  return request.param
+
+@pytest.fixture
+def server(mode) :
+  server_type = {'imap' : stubservers.IMAPServer, 'imap-public' : stubservers.IMAPServer, 'pop3' : stubservers.POP3Server, 'nntp' : stubservers.NNTPServer}[mode]
+  server = server_type(messages(1, 5)).start()
+  yield server
+  server.stop()
+
+
+class Update :
+  """Updates a feed from a stub server, and keeps the Message-IDs of the
+  messages that the source returned"""
+
+  def __init__(self, tmp_path, server, mode, state=True, args=()) :
+    self.filename = str(tmp_path / 'feed.xml')
+    arguments = ['--mode', mode.split('-')[0], '--host', '127.0.0.1', '--port', str(server.port), '--user', 'user', '--password', 'password', '--group', 'group', '--max-items', '50']
+    if state :
+      arguments += ['--state', str(tmp_path / 'feed.state')]
+    (self.options, _) = atomail.create_parser().parse_args(arguments + list(args))
+
+  def run(self) :
+    feed = atomail.create_feed(self.filename, self.options)
+    state = atomail.SyncState(self.options.state) if self.options.state else None
+    source = atomail.create_source(self.options, state)
+    retrieved = []
+    messages = source.messages
+    def record(**arguments) :
+      for message in messages(**arguments) :
+        retrieved.append(atomail.message_mid(message))
+        yield message
+    source.messages = record
+    try :
+      atomail.update_feed(feed, source, self.options, state)
+    finally :
+      atomail.close(getattr(source, 'imap', None) or getattr(source, 'pop', None) or source.nntp)
+      if state :
+        state.close()
+    return retrieved
+
+  def entries(self) :
+    return atomail.FeedReader(self.filename).read()[1]
+
+
+@pytest.mark.parametrize('state', [True, False])
+def test_no_duplicates(tmp_path, server, mode, state) :
+  update = Update(tmp_path, server, mode, state)
+  update.run()
+  assert len(update.entries()) == 5
+  for text in messages(6, 8) :
+    server.append(text)
+  update.run()
+  assert update.run() == []
+  entries = update.entries()
+  assert sorted([entry.mid for entry in entries]) == sorted(['%d@example.com' % number for number in range(1, 9)])
+  assert len(set([entry.id for entry in entries])) == 8
+
+def test_resume_state(tmp_path, server, mode) :
+  update = Update(tmp_path, server, mode)
+  assert len(update.run()) == 5
+  # Without the feed, only the state keeps the messages from being
+  # retrieved again
+  os.remove(update.filename)
+  for text in messages(6, 7) :
+    server.append(text)
+  assert update.run() == ['7@example.com', '6@example.com']
+  assert update.run() == []
+
+def test_uncommitted_state(tmp_path, server, mode, monkeypatch) :
+  update = Update(tmp_path, server, mode)
+  def fail(*args) :
+    raise IOError('disk full')
+  monkeypatch.setattr(atomail, 'write_file', fail)
+  with pytest.raises(IOError) :
+    update.run()
+  monkeypatch.undo()
+  if mode == 'imap-public' :
+    monkeypatch.setattr(atomail.IMAPSource, 'INTERNALS', False)
+  # The messages of the failed update are retrieved again
+  assert len(update.run()) == 5
+
+@pytest.mark.parametrize('mode', ['imap', 'imap-public'])
+@pytest.mark.parametrize('max_size', [0, 100000])
+def test_not_seen(tmp_path, server, mode, max_size) :
+  update = Update(tmp_path, server, mode, args=['--max-size', str(max_size)])
+  update.run()
+  server.append(messages(6, 6)[0])
+  update.run()
+  assert len(update.entries()) == 6
+  assert not server.seen
+
+@pytest.mark.parametrize('mode', ['imap', 'imap-public'])
+def test_mailboxes(tmp_path, mode) :
+  # A message in both mailboxes is only added once
+  server = stubservers.IMAPServer({'INBOX' : messages(1, 3), 'Lists/a' : messages(3, 5), 'Lists/b' : []}).start()
+  try :
+    update = Update(tmp_path, server, mode, args=['--mailbox', 'INBOX,Lists/*'])
+    assert sorted(update.run()) == sorted(['%d@example.com' % number for number in range(1, 6)])
+    server.append(messages(6, 6)[0], 'Lists/b')
+    assert update.run() == ['6@example.com']
+    assert len(update.entries()) == 6
+    assert not server.seen
+  finally :
+    server.stop()
+
+
+def test_sync_state(tmp_path) :
+  filename = str(tmp_path / 'feed.state')
+  state = atomail.SyncState(filename)
+  state.set('a', 'last', 10)
+  state.add_keys('a', ['x', 'y'])
+  state.add_keys('b', ['z'])
+  state.commit()
+  state.set('a', 'last', 20)
+  state.remove_keys('a', ['x'])
+  state.rollback()
+  state.close()
+
+  state = atomail.SyncState(filename)
+  assert state.get('a', 'last') == '10'
+  assert state.get('a', 'missing', 'default') == 'default'
+  assert state.keys('a') == set(['x', 'y'])
+  state.reset('a')
+  assert state.get('a', 'last') is None
+  assert state.keys('a') == set()
+  assert state.keys('b') == set(['z'])
+  state.close()